@@ -1,23 +1,40 @@
 import botocore
+import hashlib
 import os
 import threading
 import time
 
 from boto3.session import Session
 
+from eventlet import greenpool
+from eventlet import tpool
+
 from nova import exception
 
 from nova.compute import power_state
 
 from oslo_log import log as logging
 
+from oslo_utils import fileutils
+
 from nova_driver.virt.hybrid.common import hybrid_task_states
 from nova_driver.virt.hybrid.common import provider_client
+from nova_driver.virt.hybrid.common import util
 
 
 LOG = logging.getLogger(__name__)
 
 
+S3_PART_SIZE = 64 * 1024 * 1024
+S3_UPLOAD_CONCURRENCY = 4
+# import formats of the disk files
+DISK_CONTAINER_FORMATS = {
+    '.vmdk': 'VMDK',
+    '.raw': 'RAW',
+    '.vhd': 'VHD',
+}
+
+
 class NodeState(object):
     RUNNING = 16
     PENDING = 0
@@ -36,12 +53,12 @@ AWS_POWER_STATE = {
 
 class ProgressPercentage(object):
 
-    def __init__(self, filename, instance):
+    def __init__(self, filename, callback):
         self._filename = filename
         self._size = float(os.path.getsize(filename))
         self._seen_so_far = 0
         self._lock = threading.Lock()
-        self._instance = instance
+        self._callback = callback
         self._last = 0
 
     def __call__(self, bytes_amount):
@@ -50,13 +67,13 @@ class ProgressPercentage(object):
         with self._lock:
             self._seen_so_far += bytes_amount
             percentage = (self._seen_so_far / self._size) * 100
-            if percentage - self._last > 1:
-                status = '%s-1 (%.1f%%)' % (
-                    hybrid_task_states.UPLOADING, percentage)
-                LOG.debug("instance %s: %s" % (self._instance.uuid, status))
-                self._instance.task_state = status
-                self._instance.save()
-                self._last = percentage
+            if percentage - self._last <= 1:
+                return
+            self._last = percentage
+        # outside of the lock, the state is saved by the progress reporter
+        status = '%s-1 (%.1f%%)' % (hybrid_task_states.UPLOADING, percentage)
+        LOG.debug("%s: %s" % (self._filename, status))
+        self._callback(task_state=status)
 
 
 class AWSClient(provider_client.ProviderClient):
@@ -89,31 +106,149 @@ class AWSClient(provider_client.ProviderClient):
                 CreateBucketConfiguration={
                     'LocationConstraint': self._region_name})
 
-    def import_image(self, name, file_names, s3_bucket, instance, image_uuid):
+    def _list_uploaded_parts(self, s3_bucket, key, upload_id):
+        parts = {}
+        paginator = self.s3.get_paginator('list_parts')
+        for page in paginator.paginate(Bucket=s3_bucket, Key=key,
+                                       UploadId=upload_id):
+            for part in page.get('Parts', []):
+                parts[part['PartNumber']] = part['ETag']
+        return parts
+
+    def _abort_upload(self, s3_bucket, key, upload_id):
+        """Abort a multipart upload, its parts are not billed anymore."""
+        try:
+            self.s3.abort_multipart_upload(Bucket=s3_bucket, Key=key,
+                                           UploadId=upload_id)
+            LOG.info('upload %s of %s aborted' % (upload_id, key))
+        except botocore.exceptions.ClientError as e:
+            LOG.warn('unable to abort the upload %s of %s: %s' % (
+                upload_id, key, e))
+
+    @staticmethod
+    def _read_part(file_name, number):
+        with open(file_name, 'rb') as f:
+            f.seek((number - 1) * S3_PART_SIZE)
+            data = f.read(S3_PART_SIZE)
+        return data, '"%s"' % hashlib.md5(data).hexdigest()
+
+    def _upload_part(self, file_name, s3_bucket, key, upload_id, number,
+                     uploaded_etag, progress):
+        # the read and the digest of the part would block the hub
+        data, etag = tpool.execute(self._read_part, file_name, number)
+        if etag != uploaded_etag:
+            etag = self.s3.upload_part(Bucket=s3_bucket,
+                                       Key=key,
+                                       UploadId=upload_id,
+                                       PartNumber=number,
+                                       Body=data)['ETag']
+        progress(len(data))
+        return {'ETag': etag, 'PartNumber': number}
+
+    def _upload_file(self, file_name, s3_bucket, key, callback,
+                     journal_path):
+        """Multipart upload of file_name, resumed after a restart.
+
+        The journal keeps the id of the multipart upload, the parts already
+        uploaded whose ETag matches the local data are not uploaded again.
+        The uploads which cannot be resumed are aborted.
+        """
+        size = os.path.getsize(file_name)
+        journal = util.TransferJournal(
+            journal_path,
+            {'bucket': s3_bucket, 'key': key, 'size': size})
+        dropped_upload_id = journal.dropped_state.get('upload_id')
+        if dropped_upload_id:
+            # upload of another version of the file
+            self._abort_upload(journal.dropped_identity['bucket'],
+                               journal.dropped_identity['key'],
+                               dropped_upload_id)
+        if not size:
+            # a multipart upload has at least one part
+            self.s3.put_object(Bucket=s3_bucket,
+                               Key=key,
+                               Body='',
+                               GrantRead='uri="http://acs.amazonaws.com/'
+                               'groups/global/AllUsers"',
+                               ContentType='text/plain')
+            journal.remove()
+            return
+        upload_id = journal.get('upload_id')
+        uploaded_parts = {}
+        if upload_id:
+            try:
+                uploaded_parts = self._list_uploaded_parts(s3_bucket, key,
+                                                           upload_id)
+                LOG.info('resume upload of %s, %d parts already uploaded' %
+                         (key, len(uploaded_parts)))
+            except botocore.exceptions.ClientError as e:
+                LOG.warn('unable to resume the upload of %s: %s' % (key, e))
+                # expired or already aborted, its parts are released
+                self._abort_upload(s3_bucket, key, upload_id)
+                upload_id = None
+        if not upload_id:
+            upload_id = self.s3.create_multipart_upload(
+                Bucket=s3_bucket,
+                Key=key,
+                GrantRead='uri="http://acs.amazonaws.com/'
+                'groups/global/AllUsers"',
+                ContentType='text/plain')['UploadId']
+            journal.update(upload_id=upload_id)
+
+        progress = ProgressPercentage(file_name, callback)
+        pool = greenpool.GreenPool(S3_UPLOAD_CONCURRENCY)
+        part_numbers = range(1, (size + S3_PART_SIZE - 1) // S3_PART_SIZE + 1)
+        parts = list(pool.imap(
+            lambda number: self._upload_part(file_name, s3_bucket, key,
+                                             upload_id, number,
+                                             uploaded_parts.get(number),
+                                             progress),
+            part_numbers))
+        try:
+            self.s3.complete_multipart_upload(
+                Bucket=s3_bucket,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={'Parts': parts})
+        except botocore.exceptions.ClientError:
+            # the parts cannot be assembled, the next upload starts over
+            self._abort_upload(s3_bucket, key, upload_id)
+            journal.remove()
+            raise
+        journal.remove()
+
+    def import_image(self, name, file_names, s3_bucket, callback, image_uuid,
+                     journal_dir, host):
+        """Import the disks as an AMI tagged with the glance image uuid.
+
+        :param callback: called with the task_state of the import
+        :param host: the compute host importing the image, the bucket is
+                     shared by the hosts importing the same image
+        """
+        keys = []
         try:
             LOG.debug(file_names)
             # check if the bucket exists
             self._create_bucket_if_not_exist(s3_bucket)
+            fileutils.ensure_tree(journal_dir)
             # upload the file to the bucket:
             disk_containers = []
-            for file_name in file_names:
-                short_file_name = os.path.basename(file_name)
-                # TODO: check the response
-                self.s3_resource.meta.client.upload_file(
-                    file_name,
-                    s3_bucket,
-                    short_file_name,
-                    ExtraArgs={
-                        'GrantRead': 'uri="http://acs.amazonaws.com/'
-                        'groups/global/AllUsers"',
-                        'ContentType': 'text/plain'
-                    },
-                    Callback=ProgressPercentage(file_name, instance))
+            for i, file_name in enumerate(file_names):
+                ext = os.path.splitext(file_name)[1]
+                disk_name = '%s-disk%d%s' % (image_uuid, i + 1, ext)
+                # the object of each host is deleted once its import is
+                # done, the upload is resumed from any spawn of the host
+                key = '%s-%s' % (host, disk_name)
+                keys.append(key)
+                self._upload_file(file_name, s3_bucket, key, callback,
+                                  '%s/%s.s3journal' % (journal_dir,
+                                                       disk_name))
                 disk_containers += [{
                     'Description': 'image %s' % name,
+                    'Format': DISK_CONTAINER_FORMATS[ext],
                     'UserBucket': {
                         'S3Bucket': s3_bucket,
-                        'S3Key': short_file_name
+                        'S3Key': key
                     }
                 }]
 
@@ -131,9 +266,8 @@ class AWSClient(provider_client.ProviderClient):
                 status = '%s (%s)' % (
                     hybrid_task_states.PROVIDER_PREPARING,
                     d_res.get('StatusMessage'))
-                LOG.debug("instance %s: %s" % (instance.uuid, status))
-                instance.task_state = status
-                instance.save()
+                LOG.debug("image %s: %s" % (name, status))
+                callback(task_state=status)
                 time.sleep(15)
                 d_res = self.ec2.describe_import_image_tasks(
                     ImportTaskIds=[import_task_id]).get('ImportImageTasks')[0]
@@ -148,11 +282,8 @@ class AWSClient(provider_client.ProviderClient):
             status = '%s (%s)' % (
                 hybrid_task_states.PROVIDER_PREPARING,
                 d_res.get('Status'))
-            LOG.debug("instance %s, %s: %s" % (instance.uuid,
-                                               image_id,
-                                               status))
-            instance.task_state = status
-            instance.save()
+            LOG.debug("image %s, %s: %s" % (name, image_id, status))
+            callback(task_state=status)
 
             waiter = self.ec2.get_waiter('image_available')
             waiter.wait(ImageIds=[image_id])
@@ -162,10 +293,11 @@ class AWSClient(provider_client.ProviderClient):
                                  Tags=[{'Key': 'hybrid_cloud_image_id',
                                         'Value': image_uuid}])
         finally:
-            self.s3.delete_object(
-                Bucket=s3_bucket,
-                Key=file_name
-            )
+            for key in keys:
+                self.s3.delete_object(
+                    Bucket=s3_bucket,
+                    Key=key
+                )
 
     def create_instance(self,
                         instance,
@@ -1,4 +1,3 @@
-import os
 import time
 
 from nova import image
@@ -11,7 +10,9 @@ from oslo_log import log as logging
 
 from nova_driver.virt.hybrid.aws import aws_client
 from nova_driver.virt.hybrid.common import abstract_driver
+from nova_driver.virt.hybrid.common import hybrid_task_states
 from nova_driver.virt.hybrid.common import image_convertor
+from nova_driver.virt.hybrid.common import image_prewarmer
 
 aws_driver_opts = [
     cfg.StrOpt('access_key_id',
@@ -47,6 +48,9 @@ IMAGE_API = image.API()
 class AWSDriver(abstract_driver.AbstractHybridNovaDriver):
     """The AWS Hybrid NOVA driver."""
 
+    # the EC2 import takes the disks as they are, no ovf package
+    image_formats = ('vmdk', 'raw', 'vhd')
+
     def __init__(self, virtapi, scheme="https"):
         self._node_name = cfg.CONF.aws.region_name
         self._provider_client = aws_client.AWSClient(
@@ -59,6 +63,58 @@ class AWSDriver(abstract_driver.AbstractHybridNovaDriver):
         image_uuid = self._get_image_uuid(image_meta)
         return self._provider_client.is_exists_image(image_uuid)
 
+    def _import_image(self, context, uuid, image_meta, vm_name,
+                      inst_st_up, task_state, flavor=None):
+        if self._image_exists_in_provider(image_meta):
+            # imported by a concurrent spawn
+            return
+
+        vmx_name = 'base-template.vmx'
+        with image_convertor.ImageConvertorToOvf(
+            context,
+            self.conversion_dir,
+            uuid,
+            self._get_image_uuid(image_meta),
+            vmx_name,
+            inst_st_up,
+            task_state,
+            flavor=flavor,
+            image_formats=self.image_formats
+        ) as img_conv:
+
+            # download
+            img_conv.download_image()
+
+            # the disks in a format imported by EC2
+            disk_format, file_names = img_conv.convert_to_provider_format()
+            LOG.debug('import the %s disks %s' % (disk_format, file_names))
+
+            # import the file as a new AMI image
+            self._provider_client.import_image(
+                vm_name,
+                file_names,
+                cfg.CONF.aws.s3_bucket_tmp,
+                inst_st_up,
+                self._get_image_uuid(image_meta),
+                '%s/partial' % self.conversion_dir,
+                cfg.CONF.host
+            )
+
+    def _prewarm_image(self, context, image_meta):
+        if self._image_exists_in_provider(image_meta):
+            return
+        image_uuid = self._get_image_uuid(image_meta)
+        # shared with the spawns of the image started meanwhile
+        self._import_jobs.do(
+            'import-%s' % image_uuid,
+            self._import_image,
+            context,
+            'prewarm-%s' % image_uuid,
+            image_meta,
+            image_uuid,
+            image_prewarmer.PrewarmStateUpdater(image_uuid),
+            None)
+
     def spawn(self,
               context,
               instance,
@@ -69,88 +125,75 @@ class AWSDriver(abstract_driver.AbstractHybridNovaDriver):
               block_device_info=None):
         LOG.info('begin time of aws create vm is %s' %
                  (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())))
-        vmx_name = 'base-template.vmx'
         inst_st_up = abstract_driver.InstanceStateUpdater(instance)
-        vm_name = self._get_vm_name(instance)
-
-        image_meta_dict = self._get_image_meta_dict(context, image_meta)
-
-        # list of networks
-        net_list = self.hyper_agent_api.get_net_list(network_info,
-                                                     image_meta_dict)
-
-        if not self._image_exists_in_provider(image_meta_dict):
-            with image_convertor.ImageConvertorToOvf(
-                context,
-                self.conversion_dir,
-                instance.uuid,
-                self._get_image_uuid(image_meta_dict),
-                vmx_name,
-                inst_st_up,
-                instance.task_state
-            ) as img_conv:
-
-                # download
-                img_conv.download_image()
-
-                ovf_name = img_conv.convert_to_ovf_format()
-
-                # upload all the disks in 1 image:
-                ovf_dir = os.path.dirname(ovf_name)
-                file_names = []
-                for x in range(1, 20):
-                    file_name = '%s/%s-disk%d.vmdk' % (
-                        ovf_dir, instance.uuid, x)
-                    if (os.path.exists(file_name)):
-                        file_names += [file_name]
-
-                # import the file as a new AMI image
-                self._provider_client.import_image(
+        try:
+            vm_name = self._get_vm_name(instance)
+
+            image_meta_dict = self._get_image_meta_dict(context, image_meta)
+
+            # list of networks
+            net_list = self.hyper_agent_api.get_net_list(network_info,
+                                                         image_meta_dict)
+
+            self._image_prewarmer.record_spawn(
+                self._get_image_uuid(image_meta_dict))
+            if not self._image_exists_in_provider(image_meta_dict):
+                # only one of the concurrent spawns of the image imports it
+                task_state = instance.task_state
+                inst_st_up(task_state=hybrid_task_states.IMPORTING)
+                self._import_jobs.do(
+                    'import-%s' % self._get_image_uuid(image_meta_dict),
+                    self._import_image,
+                    context,
+                    instance.uuid,
+                    image_meta_dict,
                     vm_name,
-                    file_names,
-                    cfg.CONF.aws.s3_bucket_tmp,
-                    instance,
-                    self._get_image_uuid(image_meta_dict)
-                )
-
-        # launch the VM
-
-        vm_flavor_name = instance.get_flavor().name
-        instance_type = cfg.CONF.aws.flavor_map[vm_flavor_name]
-        image_uuid = self._get_image_uuid(image_meta_dict)
-        
-        user_metadata = self._get_user_metadata(
-            instance, net_list, image_meta_dict)
-        user_metadata['network_device_mtu'] = 9001
-
-        if 'properties' in image_meta_dict:
-            props = image_meta_dict.get('properties')
-            if not 'agent_type' in props:
-                i = 0
-                for vif in network_info:
-                    user_metadata['eth%d_mac' % i] = vif['address']
-                    i = + 1
-
-        self._provider_client.create_instance(
-            instance=instance,
-            name=vm_name,
-            image_uuid=image_uuid,
-            user_metadata=user_metadata,
-            instance_type=instance_type,
-            net_list=net_list,
-            sec_groups=cfg.CONF.aws.security_groups
-        )
-
-        nets_conf = self._provider_client.get_net_conf(
-            instance, net_list, vm_name)
-
-        self._update_md(instance, network_info, nets_conf)
-
-        if user_metadata and len(user_metadata) > 0:
-            if 'eth0_ip' in user_metadata and 'eth1_ip' in user_metadata:
-                self.plug_vifs(context, instance, network_info,
-                               user_metadata['eth0_ip'],
-                               user_metadata['eth1_ip'])
+                    inst_st_up,
+                    task_state,
+                    instance.get_flavor())
+                inst_st_up(task_state=task_state)
+
+            # launch the VM
+
+            vm_flavor_name = instance.get_flavor().name
+            instance_type = cfg.CONF.aws.flavor_map[vm_flavor_name]
+            image_uuid = self._get_image_uuid(image_meta_dict)
+
+            user_metadata = self._get_user_metadata(
+                instance, net_list, image_meta_dict)
+            user_metadata['network_device_mtu'] = 9001
+
+            if 'properties' in image_meta_dict:
+                props = image_meta_dict.get('properties')
+                if not 'agent_type' in props:
+                    i = 0
+                    for vif in network_info:
+                        user_metadata['eth%d_mac' % i] = vif['address']
+                        i = + 1
+
+            self._provider_client.create_instance(
+                instance=instance,
+                name=vm_name,
+                image_uuid=image_uuid,
+                user_metadata=user_metadata,
+                instance_type=instance_type,
+                net_list=net_list,
+                sec_groups=cfg.CONF.aws.security_groups
+            )
+
+            nets_conf = self._provider_client.get_net_conf(
+                instance, net_list, vm_name)
+
+            self._update_md(instance, network_info, nets_conf)
+
+            if user_metadata and len(user_metadata) > 0:
+                if 'eth0_ip' in user_metadata and 'eth1_ip' in user_metadata:
+                    self.plug_vifs(context, instance, network_info,
+                                   user_metadata['eth0_ip'],
+                                   user_metadata['eth1_ip'])
+        finally:
+            # the last state is saved before nova resets it
+            inst_st_up.flush()
 
         LOG.info('end time of aws create vm is %s' %
                  (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())))
@@ -20,6 +20,10 @@ from nova.virt import hardware
 from nova.volume.cinder import API as cinder_api
 
 from nova_driver.virt.hybrid.common import hyper_agent_api
+from nova_driver.virt.hybrid.common import image_notification_listener
+from nova_driver.virt.hybrid.common import image_prewarmer
+from nova_driver.virt.hybrid.common import progress_reporter
+from nova_driver.virt.hybrid.common import single_flight
 
 from oslo_config import cfg
 
@@ -64,23 +68,41 @@ cfg.CONF.import_opt('auth_uri',
 
 
 class InstanceStateUpdater(object):
+    """Task state callback of a spawn, the states are saved by the progress
+    reporter of the host.
+    """
 
     def __init__(self, instance):
         self._instance = instance
+        self._reporter = progress_reporter.get_progress_reporter()
+        self._closed = False
 
     def __call__(self, task_state):
-        self._instance.task_state = task_state
-        self._instance.save()
+        if self._closed:
+            # late report of a transfer after the end of the spawn
+            return
+        self._reporter.report(self._instance, task_state)
+
+    def flush(self):
+        """Save the last state now, the later states are ignored."""
+        self._closed = True
+        self._reporter.flush(self._instance)
 
 
 class AbstractHybridNovaDriver(driver.ComputeDriver):
     """The VCloud host connection object."""
 
+    # formats of the images accepted by the provider (ovf, vmdk for a
+    # streamOptimized vmdk, raw, vhd): the images already in one of them
+    # are not converted, the others are converted to the first one
+    image_formats = ('ovf',)
+
     def __init__(self, virtapi):
         super(AbstractHybridNovaDriver, self).__init__(virtapi)
         self.instances = {}
         self.cinder_api = cinder_api()
-        self.conversion_dir = cfg.CONF.hybrid_driver.conversion_dir
+        self.conversion_dir = os.path.abspath(
+            cfg.CONF.hybrid_driver.conversion_dir)
         if not os.path.exists(self.conversion_dir):
             os.makedirs(self.conversion_dir)
 
@@ -90,11 +112,22 @@ class AbstractHybridNovaDriver(driver.ComputeDriver):
 
         self.hyper_agent_api = hyper_agent_api.HyperAgentAPI()
 
+        # import of an image to the provider shared by the concurrent spawns
+        self._import_jobs = single_flight.SingleFlight()
+
+        # images prepared in the provider ahead of their spawns
+        self._image_prewarmer = image_prewarmer.ImagePrewarmer(
+            self._prewarm_image, self.conversion_dir)
+
     def _get_image_meta_dict(self, context, image_meta):
         return IMAGE_API.get(context, image_meta.id)
 
     def init_host(self, host):
         LOG.debug("init_host")
+        self._image_prewarmer.start()
+        # new images imported to the provider on their activation
+        self._image_listener = image_notification_listener.start_listener(
+            self._image_prewarmer.prewarm)
 
     def list_instances(self):
         LOG.debug("list_instances")
@@ -127,12 +160,12 @@ class AbstractHybridNovaDriver(driver.ComputeDriver):
         return self.hyper_agent_api.get_user_metadata(
             instance, image_meta, nets_conf)
 
-    def _get_conversion_dir(self, instance):
-        return '%s/%s' % (self.conversion_dir, instance.uuid)
-
     def _image_exists_in_provider(self, image_meta):
         return False
 
+    def _prewarm_image(self, context, image_meta):
+        LOG.debug("_prewarm_image")
+
     def _update_vm_task_state(self, instance, task_state):
         instance.task_state = task_state
         instance.save()
@@ -1,11 +1,30 @@
 import os
 import shutil
 import subprocess
+import sys
+import time
+
+from nova import exception
 
 from oslo_log import log as logging
 
+from nova_driver.virt.hybrid.common import conversion_scheduler
+
 LOG = logging.getLogger(__name__)
 
+NBD_SOCKET_WAIT_TIME = 30
+VMDK_WRITER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'vmdk_writer.py')
+
+# qemu-img names of the glance disk formats
+QEMU_IMG_FORMATS = {
+    'vhd': 'vpc',
+}
+
+
+def _qemu_img_format(disk_format):
+    return QEMU_IMG_FORMATS.get(disk_format, disk_format)
+
 
 def create_user_data_iso(iso_name, user_data, work_dir):
     iso_dir = "%s/iso" % work_dir
@@ -47,19 +66,116 @@ def create_user_data_floppy(floppy_name, user_data, work_dir):
     return full_floppy_name
 
 
-def convert_vm(src_format, src_file, dst_format, dst_file):
-    if src_format == dst_file:
-        os.rename(src_file, dst_file)
+def convert_vm(src_format, src_file, dst_format, dst_file,
+               instance_uuid=None, callback=None, task_state=None):
+    if src_format == dst_format:
+        # the source may be a cached image, it is kept
+        os.link(src_file, dst_file)
     else:
-        convert_command = ("qemu-img convert -f %s -O %s %s %s" % (
-            src_format, dst_format, src_file, dst_file))
+        # the zero sectors of the source are not written (-S)
+        convert_command = ['qemu-img', 'convert', '-p', '-S', '4k',
+                           '-f', _qemu_img_format(src_format),
+                           '-O', _qemu_img_format(dst_format),
+                           src_file, dst_file]
 
-        convert_result = subprocess.call([convert_command], shell=True)
+        convert_result = conversion_scheduler.execute(
+            'convert %s to %s' % (src_file, dst_format),
+            convert_command,
+            instance_uuid=instance_uuid,
+            io=True,
+            callback=callback,
+            task_state=task_state)
 
         if convert_result != 0:
             LOG.error('convert %s to %s failed' % (src_format, dst_format))
 
 
+def convert_to_stream_optimized(src_format, src_file, dst_file,
+                                processes=0, level=6, instance_uuid=None,
+                                callback=None, task_state=None):
+    '''
+       convert src_file to a streamOptimized vmdk, the grains are deflated
+       by processes processes (by default the cpu share of a conversion in
+       the conversion scheduler)
+    '''
+    processes = (processes or
+                 conversion_scheduler.get_scheduler().cpus_per_job)
+    # run by path: "-m" would import the package, and nova with it
+    convert_command = [sys.executable, VMDK_WRITER,
+                       '--progress',
+                       '--processes', str(processes),
+                       '--level', str(level)]
+    setup = None
+    if src_format == 'raw':
+        convert_command += [src_file, dst_file]
+    else:
+        # the other formats are read through qemu-nbd, one connection per
+        # process, exported once the conversion is admitted
+        socket_path = '%s.sock' % dst_file
+        convert_command += ['--nbd', socket_path, dst_file]
+
+        def setup():
+            nbd_process = start_nbd_export(src_format, src_file, socket_path,
+                                           read_only=True,
+                                           shared=processes + 1)
+            return lambda: stop_nbd_export(nbd_process)
+
+    # bound by the cpus deflating the grains
+    convert_result = conversion_scheduler.execute(
+        'convert %s to streamOptimized vmdk' % src_file,
+        convert_command,
+        instance_uuid=instance_uuid,
+        cpus=processes,
+        callback=callback,
+        task_state=task_state,
+        setup=setup)
+
+    if convert_result != 0:
+        raise exception.NovaException(
+            'convert %s to streamOptimized vmdk failed' % src_format)
+
+
+def create_image(dst_format, dst_file, size):
+    create_command = "qemu-img create -f %s %s %d" % (
+        dst_format, dst_file, size)
+    create_result = subprocess.call([create_command], shell=True)
+    if create_result != 0:
+        raise exception.NovaException(
+            'create %s image %s failed' % (dst_format, dst_file))
+
+
+def start_nbd_export(image_format, image_file, socket_path, read_only=False,
+                     shared=1):
+    '''
+       serve image_file on the unix socket socket_path; qemu-nbd exits
+       when the (shared) clients disconnect
+    '''
+    nbd_command = ['qemu-nbd', '-f', _qemu_img_format(image_format),
+                   '-k', socket_path, '--cache=writeback']
+    if read_only:
+        nbd_command.append('-r')
+    if shared > 1:
+        nbd_command += ['-e', str(shared)]
+    nbd_process = subprocess.Popen(nbd_command + [image_file])
+    deadline = time.time() + NBD_SOCKET_WAIT_TIME
+    while not os.path.exists(socket_path):
+        if nbd_process.poll() is not None or time.time() > deadline:
+            stop_nbd_export(nbd_process)
+            raise exception.NovaException(
+                'unable to export %s with qemu-nbd' % image_file)
+        time.sleep(0.1)
+    return nbd_process
+
+
+def stop_nbd_export(nbd_process, timeout=0):
+    deadline = time.time() + timeout
+    while nbd_process.poll() is None and time.time() < deadline:
+        time.sleep(0.1)
+    if nbd_process.poll() is None:
+        nbd_process.terminate()
+    return nbd_process.wait()
+
+
 def copy_replace(src, dst, rep_dict):
     '''
        use only for small files
@@ -0,0 +1,239 @@
+"""
+Host level admission control of the conversion processes (qemu-img, vmdk
+writer, ovftool, ...).
+
+The conversions are queued and started in order when the running ones
+leave enough room: number of conversions, cpus and conversions doing
+heavy disk IO are bounded. The position in the queue and the progress of
+the running conversion are reported to the instance.
+
+The processes are run with the green subprocess, their output is read
+without blocking the eventlet hub.
+"""
+import collections
+import multiprocessing
+import re
+import threading
+import time
+
+from eventlet import event
+from eventlet.green import os as green_os
+from eventlet.green import subprocess
+
+from nova import exception
+
+from oslo_config import cfg
+
+from oslo_log import log as logging
+
+conversion_scheduler_opts = [
+    cfg.IntOpt('max_concurrent_conversions',
+               default=2,
+               help='Maximum number of image conversions running at once'),
+    cfg.IntOpt('conversion_max_cpus',
+               default=0,
+               help='Maximum number of cpus used by the running image '
+               'conversions, 0 for the number of cpus of the host'),
+    cfg.IntOpt('conversion_max_io_jobs',
+               default=0,
+               help='Maximum number of running image conversions bound by '
+               'the disks (qemu-img, ovftool), 0 for '
+               'max_concurrent_conversions'),
+    cfg.IntOpt('conversion_niceness',
+               default=10,
+               help='Niceness of the conversion processes, 0 to keep the '
+               'priority of nova-compute'),
+]
+
+
+cfg.CONF.register_opts(conversion_scheduler_opts, 'hybrid_driver')
+
+
+LOG = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+
+PROGRESS_REPORT_INTERVAL = 3
+# qemu-img -p: (12.34/100%), ovftool: Progress: 12%
+PROGRESS_PATTERN = re.compile(r'(\d+(?:\.\d+)?)(?:/100)?%')
+OUTPUT_READ_SIZE = 4096
+
+_SCHEDULER = None
+_SCHEDULER_LOCK = threading.Lock()
+
+
+def get_scheduler():
+    """Return the conversion scheduler of the host."""
+    global _SCHEDULER
+    with _SCHEDULER_LOCK:
+        if not _SCHEDULER:
+            max_cpus = (cfg.CONF.hybrid_driver.conversion_max_cpus or
+                        multiprocessing.cpu_count())
+            max_jobs = cfg.CONF.hybrid_driver.max_concurrent_conversions
+            _SCHEDULER = ConversionScheduler(
+                max_jobs,
+                max_cpus,
+                cfg.CONF.hybrid_driver.conversion_max_io_jobs or max_jobs)
+        return _SCHEDULER
+
+
+def execute(name, command, instance_uuid=None, cpus=1, io=False,
+            callback=None, task_state=None, setup=None):
+    """Run command through the conversion scheduler of the host.
+
+    :param io: True if the command is bound by the disks
+    :param setup: function run once the conversion is admitted, before the
+                  command, returning a function run after it (or None)
+    :returns: the exit code of the command
+    """
+    job = ConversionJob(name, command, instance_uuid, cpus, io, callback,
+                        task_state, setup)
+    return get_scheduler().run(job)
+
+
+class ConversionJob(object):
+
+    def __init__(self, name, command, instance_uuid=None, cpus=1, io=False,
+                 callback=None, task_state=None, setup=None):
+        self.name = name
+        self.command = command
+        self.setup = setup
+        self.instance_uuid = instance_uuid
+        self.cpus = cpus
+        self.io = io
+        self.state = QUEUED
+        self.position = None
+        self.progress = None
+        self.queued_at = time.time()
+        self.started_at = None
+        self._callback = callback
+        self._task_state = task_state
+        self._last_report = 0
+        self.admitted = event.Event()
+
+    def report(self, force=False):
+        if not (self._callback and self._task_state):
+            return
+        now = time.time()
+        if not force and now - self._last_report < PROGRESS_REPORT_INTERVAL:
+            return
+        self._last_report = now
+        if self.state == QUEUED:
+            status = 'queued %d' % self.position
+        elif self.progress is not None:
+            status = '%.0f%%' % self.progress
+        else:
+            return
+        self._callback(task_state='%s (%s)' % (self._task_state, status))
+
+
+class ConversionScheduler(object):
+
+    def __init__(self, max_jobs, max_cpus, max_io_jobs):
+        self._max_jobs = max(1, max_jobs)
+        self._max_cpus = max(1, max_cpus)
+        self._max_io_jobs = max(1, max_io_jobs)
+        self._lock = threading.Lock()
+        self._queue = collections.deque()
+        self._running = []
+
+    @property
+    def cpus_per_job(self):
+        """The share of the cpus of a conversion when the maximum number
+        of conversions run.
+        """
+        return max(1, self._max_cpus // self._max_jobs)
+
+    def _fits(self, job):
+        if len(self._running) >= self._max_jobs:
+            return False
+        if self._running:
+            # a job wider than the host runs alone
+            cpus = sum(j.cpus for j in self._running)
+            if cpus + min(job.cpus, self._max_cpus) > self._max_cpus:
+                return False
+        if job.io and (len([j for j in self._running if j.io]) >=
+                       self._max_io_jobs):
+            return False
+        return True
+
+    def _schedule(self):
+        admitted = []
+        with self._lock:
+            # in order, a large job is not overtaken by the small ones
+            while self._queue and self._fits(self._queue[0]):
+                job = self._queue.popleft()
+                job.state = RUNNING
+                job.started_at = time.time()
+                self._running.append(job)
+                admitted.append(job)
+            queued = list(self._queue)
+        for position, job in enumerate(queued, 1):
+            if job.position != position:
+                job.position = position
+                job.report(force=True)
+        for job in admitted:
+            job.admitted.send(True)
+
+    def run(self, job):
+        with self._lock:
+            self._queue.append(job)
+        self._schedule()
+        if job.state == QUEUED:
+            LOG.info('conversion %s queued at %d (%d running)' % (
+                job.name, job.position, len(self._running)))
+        try:
+            job.admitted.wait()
+            LOG.info('conversion %s started after %.1f s' % (
+                job.name, job.started_at - job.queued_at))
+            teardown = job.setup() if job.setup else None
+            try:
+                return self._execute(job)
+            finally:
+                if teardown:
+                    teardown()
+        finally:
+            with self._lock:
+                if job in self._queue:
+                    self._queue.remove(job)
+                if job in self._running:
+                    self._running.remove(job)
+            job.state = DONE
+            self._schedule()
+
+    def _execute(self, job):
+        command = job.command
+        shell = isinstance(command, basestring)
+        niceness = cfg.CONF.hybrid_driver.conversion_niceness
+        if niceness:
+            if shell:
+                command = 'nice -n %d %s' % (niceness, command)
+            else:
+                command = ['nice', '-n', str(niceness)] + list(command)
+        LOG.debug('begin run command %s' % command)
+        try:
+            process = subprocess.Popen(command,
+                                       shell=shell,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT)
+        except OSError as e:
+            raise exception.NovaException(
+                'unable to run %s: %s' % (job.name, e))
+        output = ''
+        while True:
+            data = green_os.read(process.stdout.fileno(), OUTPUT_READ_SIZE)
+            if not data:
+                break
+            output = (output + data)[-OUTPUT_READ_SIZE:]
+            progress = PROGRESS_PATTERN.findall(data)
+            if progress:
+                job.progress = float(progress[-1])
+                job.report()
+        returncode = process.wait()
+        LOG.debug('end run command %s: %s' % (command, returncode))
+        if returncode != 0:
+            LOG.error('%s failed (%s): %s' % (job.name, returncode,
+                                              output.strip()))
+        return returncode
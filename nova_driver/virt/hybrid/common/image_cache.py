@@ -0,0 +1,261 @@
+"""
+Bounded, content addressed cache of the image artifacts (glance downloads
+and converted disks) kept in the conversion directory.
+
+Artifacts are keyed by the glance checksum of the image and the disk format
+of the artifact. The least recently used entries are evicted when the cache
+grows over its byte budget; entries pinned by an in-flight spawn are never
+evicted.
+
+The artifacts are renamed into the cache. When the cache is on another
+filesystem they are first copied, sparse, by a native thread under a
+temporary name.
+"""
+import contextlib
+import json
+import os
+import threading
+import time
+import uuid
+
+from eventlet import tpool
+
+from oslo_config import cfg
+
+from oslo_log import log as logging
+
+from oslo_utils import fileutils
+
+from nova_driver.virt.hybrid.common import util
+
+image_cache_opts = [
+    cfg.StrOpt('image_cache_dir',
+               help='the directory of the image cache, default to '
+               '<conversion_dir>/cache'),
+    cfg.IntOpt('image_cache_max_size_mb',
+               default=102400,
+               help='maximum size of the image cache in MB, 0 for unbounded'),
+]
+
+
+cfg.CONF.register_opts(image_cache_opts, 'hybrid_driver')
+
+
+LOG = logging.getLogger(__name__)
+
+
+CACHE_INDEX = 'index.json'
+# the last accesses of the hits are saved at most every INDEX_SAVE_INTERVAL
+INDEX_SAVE_INTERVAL = 60
+COPY_CHUNK_SIZE = 1024 * 1024
+
+_IMAGE_CACHES = {}
+_IMAGE_CACHES_LOCK = threading.Lock()
+
+
+def get_image_cache(work_dir):
+    """Return the image cache shared by all the spawns of work_dir."""
+    with _IMAGE_CACHES_LOCK:
+        if work_dir not in _IMAGE_CACHES:
+            cache_dir = (cfg.CONF.hybrid_driver.image_cache_dir or
+                         '%s/cache' % work_dir)
+            max_size = cfg.CONF.hybrid_driver.image_cache_max_size_mb
+            _IMAGE_CACHES[work_dir] = ImageCache(cache_dir,
+                                                 max_size * 1024 * 1024)
+        return _IMAGE_CACHES[work_dir]
+
+
+def _allocated_size(file_name):
+    # sparse files only cost their allocated blocks
+    st = os.stat(file_name)
+    return min(st.st_size, st.st_blocks * 512)
+
+
+def _copy_sparse(src_file_name, dst_file_name):
+    with open(src_file_name, 'rb') as src:
+        with open(dst_file_name, 'wb') as dst:
+            while True:
+                data = src.read(COPY_CHUNK_SIZE)
+                if not data:
+                    break
+                util.write_sparse(dst, data)
+            dst.truncate()
+
+
+class ImageCache(object):
+
+    def __init__(self, cache_dir, max_size):
+        self._cache_dir = cache_dir
+        self._max_size = max_size
+        self._lock = threading.RLock()
+        # key -> {'checksum', 'disk_format', 'size', 'last_access', ['sha256']}
+        self._entries = {}
+        # key -> number of spawns using the entry
+        self._pins = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._index_saved_at = 0
+        fileutils.ensure_tree(self._cache_dir)
+        self._load_index()
+
+    @staticmethod
+    def make_key(checksum, disk_format):
+        return '%s.%s' % (checksum, disk_format)
+
+    def get_path(self, checksum, disk_format):
+        return '%s/%s' % (self._cache_dir,
+                          self.make_key(checksum, disk_format))
+
+    def _index_file_name(self):
+        return '%s/%s' % (self._cache_dir, CACHE_INDEX)
+
+    def _load_index(self):
+        try:
+            with open(self._index_file_name(), 'r') as f:
+                entries = json.load(f)
+        except (IOError, ValueError):
+            entries = {}
+        # the copies interrupted by a restart
+        for file_name in os.listdir(self._cache_dir):
+            if file_name.endswith('.tmp'):
+                fileutils.delete_if_exists('%s/%s' % (self._cache_dir,
+                                                      file_name))
+        # forget the entries removed behind our back
+        for key, entry in entries.iteritems():
+            if os.path.exists(self.get_path(entry['checksum'],
+                                            entry['disk_format'])):
+                self._entries[key] = entry
+
+    def _save_index(self):
+        tmp_file_name = '%s.tmp' % self._index_file_name()
+        with open(tmp_file_name, 'w') as f:
+            json.dump(self._entries, f)
+        os.rename(tmp_file_name, self._index_file_name())
+        self._index_saved_at = time.time()
+
+    def _save_index_later(self):
+        # the last access of an entry lost in a restart only changes the
+        # order of the evictions
+        if time.time() - self._index_saved_at >= INDEX_SAVE_INTERVAL:
+            self._save_index()
+
+    @property
+    def size(self):
+        return sum(entry['size'] for entry in self._entries.itervalues())
+
+    def contains(self, checksum, disk_format):
+        with self._lock:
+            return (self.make_key(checksum, disk_format) in self._entries and
+                    os.path.exists(self.get_path(checksum, disk_format)))
+
+    def lookup(self, checksum, disk_format, pin=False):
+        """Return the cached file name of the artifact or None."""
+        key = self.make_key(checksum, disk_format)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and not os.path.exists(self.get_path(checksum,
+                                                          disk_format)):
+                del self._entries[key]
+                entry = None
+            if not entry:
+                self.misses += 1
+                LOG.debug('image cache miss %s: %s' % (key, self.stats()))
+                return None
+            self.hits += 1
+            if pin:
+                self.pin(checksum, disk_format)
+            entry['last_access'] = time.time()
+            self._save_index_later()
+            LOG.debug('image cache hit %s: %s' % (key, self.stats()))
+            return self.get_path(checksum, disk_format)
+
+    def add(self, checksum, disk_format, file_name, pin=False, sha256=None):
+        """Move file_name into the cache and return its cached file name."""
+        key = self.make_key(checksum, disk_format)
+        size = _allocated_size(file_name)
+        cached_file_name = self.get_path(checksum, disk_format)
+        tmp_file_name = None
+        if os.stat(file_name).st_dev != os.stat(self._cache_dir).st_dev:
+            # a copy of many GB, outside of the lock and of the hub
+            tmp_file_name = '%s.%s.tmp' % (cached_file_name,
+                                           uuid.uuid4().hex)
+            LOG.debug('copy %s to the image cache' % file_name)
+            try:
+                tpool.execute(_copy_sparse, file_name, tmp_file_name)
+            except Exception:
+                fileutils.delete_if_exists(tmp_file_name)
+                raise
+        with self._lock:
+            if pin:
+                self.pin(checksum, disk_format)
+            self._evict(size)
+            os.rename(tmp_file_name or file_name, cached_file_name)
+            self._entries[key] = {
+                'checksum': checksum,
+                'disk_format': disk_format,
+                'size': size,
+                'last_access': time.time(),
+            }
+            if sha256:
+                self._entries[key]['sha256'] = sha256
+            self._save_index()
+        if tmp_file_name:
+            fileutils.delete_if_exists(file_name)
+        return cached_file_name
+
+    def _evict(self, needed_size):
+        if not self._max_size:
+            return
+        size = self.size
+        lru_keys = sorted(self._entries,
+                          key=lambda k: self._entries[k]['last_access'])
+        for key in lru_keys:
+            if size + needed_size <= self._max_size:
+                break
+            if self._pins.get(key):
+                continue
+            entry = self._entries.pop(key)
+            LOG.info('image cache evict %s (%d bytes)' % (key, entry['size']))
+            fileutils.delete_if_exists(self.get_path(entry['checksum'],
+                                                     entry['disk_format']))
+            size -= entry['size']
+            self.evictions += 1
+        if size + needed_size > self._max_size:
+            LOG.warn('image cache over its budget (%d > %d bytes), all the '
+                     'entries are in use' % (size + needed_size,
+                                             self._max_size))
+        self._save_index()
+
+    def pin(self, checksum, disk_format):
+        key = self.make_key(checksum, disk_format)
+        with self._lock:
+            self._pins[key] = self._pins.get(key, 0) + 1
+
+    def unpin(self, checksum, disk_format):
+        key = self.make_key(checksum, disk_format)
+        with self._lock:
+            count = self._pins.get(key, 0) - 1
+            if count > 0:
+                self._pins[key] = count
+            else:
+                self._pins.pop(key, None)
+
+    @contextlib.contextmanager
+    def pinned(self, checksum, disk_format):
+        self.pin(checksum, disk_format)
+        try:
+            yield
+        finally:
+            self.unpin(checksum, disk_format)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'size': self.size,
+                'max_size': self._max_size,
+            }
@@ -1,19 +1,82 @@
 import os
 import shutil
-import subprocess
+import tempfile
 
+from nova import exception
 from nova import image
 
+from oslo_config import cfg
+
 from oslo_log import log as logging
 
 from oslo_utils import fileutils
 
 from nova_driver.virt.hybrid.common import common_tools
+from nova_driver.virt.hybrid.common import conversion_scheduler
 from nova_driver.virt.hybrid.common import hybrid_task_states
+from nova_driver.virt.hybrid.common import image_cache
+from nova_driver.virt.hybrid.common import ovf_packager
+from nova_driver.virt.hybrid.common import single_flight
 from nova_driver.virt.hybrid.common import util
 
+image_convertor_opts = [
+    cfg.BoolOpt('stream_conversion',
+                default=False,
+                help='Convert raw images to vmdk while they are downloaded '
+                'from glance (through a qemu-nbd export of the vmdk), '
+                'instead of staging the whole raw file first'),
+    cfg.IntOpt('glance_download_connections',
+               default=1,
+               help='Number of concurrent ranged requests used to download '
+               'the large images from glance, 1 for a single stream'),
+    cfg.IntOpt('glance_download_part_size_mb',
+               default=64,
+               help='Size in MB of the ranges of a multi-connection glance '
+               'download'),
+    cfg.IntOpt('glance_ranged_download_min_size_mb',
+               default=1024,
+               help='Minimum size in MB of the images downloaded with '
+               'several connections'),
+    cfg.BoolOpt('image_digest_sha256',
+                default=False,
+                help='Compute the sha256 of the images during their download '
+                'and record it in the image cache, in addition to the '
+                'verification of the glance md5 checksum'),
+    cfg.StrOpt('ovf_packaging',
+               default='native',
+               choices=['native', 'ovftool'],
+               help='Build the OVF packages in process from the '
+               'streamOptimized vmdk (native) or with ovftool from the vmx '
+               'templates'),
+    cfg.IntOpt('vmdk_writer_processes',
+               default=0,
+               help='Number of processes deflating the grains of the '
+               'streamOptimized vmdk, 0 for the cpu share of a conversion '
+               '(conversion_max_cpus / max_concurrent_conversions)'),
+    cfg.IntOpt('vmdk_compression_level',
+               default=6,
+               help='zlib compression level of the streamOptimized vmdk, '
+               'from 1 (fastest) to 9 (smallest)'),
+]
+
+
+cfg.CONF.register_opts(image_convertor_opts, 'hybrid_driver')
+
+
 LOG = logging.getLogger(__name__)
 IMAGE_API = image.API()
+# download and conversion of an image shared by the concurrent spawns
+IMAGE_JOBS = single_flight.SingleFlight()
+
+# format of the cached image delivered in a provider format
+CACHE_FORMATS = {
+    'ovf': 'vmdk',
+    'vmdk': 'vmdk',
+    'raw': 'raw',
+    'vhd': 'vhd',
+}
+# provider formats in which a glance image is delivered as it is
+DIRECT_FORMATS = ('raw', 'vhd')
 
 
 class ImageConvertorToOvf(object):
@@ -25,12 +88,17 @@ class ImageConvertorToOvf(object):
                  image_uuid,
                  vmx_template_name,
                  callback,
-                 task_state):
+                 task_state,
+                 flavor=None,
+                 image_formats=('ovf',)):
         self._context = context
         self._image_uuid = image_uuid
-        self._work_dir = work_dir
+        # only absolute paths: the spawns run concurrently, the conversion
+        # processes are started from any directory
+        self._work_dir = os.path.abspath(work_dir)
         self._uuid = uuid
-        self._conversion_dir = "%s/%s" % (work_dir, uuid)
+        # private directory of the conversion, created on __enter__
+        self._conversion_dir = None
         self._vmx_template_name = vmx_template_name
         self._converted_file_name = 'converted-file'
         # vmx_template_params: disk0, vmname
@@ -40,46 +108,206 @@ class ImageConvertorToOvf(object):
         }
         self._callback = callback
         self._task_state = task_state
+        self._flavor = flavor
+        self._image_formats = image_formats
+        self._metadata = None
+        self._cache = image_cache.get_image_cache(self._work_dir)
+        # the cache entries used by this conversion
+        self._pinned = []
+
+    @property
+    def conversion_dir(self):
+        return self._conversion_dir
 
     def __enter__(self):
         LOG.debug('__enter__')
-        fileutils.ensure_tree(self._conversion_dir)
-        os.chdir(self._conversion_dir)
+        fileutils.ensure_tree(self._work_dir)
+        # a new directory for every conversion, even of the same instance
+        self._conversion_dir = tempfile.mkdtemp(prefix='%s-' % self._uuid,
+                                                dir=self._work_dir)
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
         shutil.rmtree(self._conversion_dir, ignore_errors=True)
+        for checksum, disk_format in self._pinned:
+            self._cache.unpin(checksum, disk_format)
+        LOG.info('image cache stats: %s' % self._cache.stats())
         self._callback(task_state=self._task_state)
 
-    def _convert_to_vmdk(self):
+    def _get_metadata(self):
+        if not self._metadata:
+            self._metadata = IMAGE_API.get(self._context, self._image_uuid)
+        return self._metadata
+
+    def _get_checksum(self):
+        # images without checksum are cached by uuid
+        return self._get_metadata().get('checksum') or self._image_uuid
+
+    def _lookup_cache(self, disk_format):
+        checksum = self._get_checksum()
+        file_name = self._cache.lookup(checksum, disk_format, pin=True)
+        if file_name:
+            self._pinned.append((checksum, disk_format))
+        return file_name
+
+    def _add_to_cache(self, disk_format, file_name, sha256=None):
+        checksum = self._get_checksum()
+        self._pinned.append((checksum, disk_format))
+        return self._cache.add(checksum, disk_format, file_name, pin=True,
+                               sha256=sha256)
+
+    def _new_digest(self):
+        if cfg.CONF.hybrid_driver.image_digest_sha256:
+            return util.ImageDigest(('md5', 'sha256'))
+        return util.ImageDigest(('md5',))
+
+    def _verify_digest(self, digest, file_size):
+        """Verify the digest computed during the download.
+
+        :returns: the sha256 of the image if computed
+        """
+        digest.verify(self._image_uuid,
+                      self._get_metadata().get('checksum'),
+                      file_size)
+        if cfg.CONF.hybrid_driver.image_digest_sha256:
+            return digest.hexdigest('sha256')
+
+    def _get_provider_format(self):
+        """Return the cheapest of the formats accepted by the provider: the
+        format of the image if accepted as it is, else the first one.
+        """
+        disk_format = self._get_metadata()['disk_format']
+        if (disk_format in DIRECT_FORMATS and
+                disk_format in self._image_formats):
+            return disk_format
+        return self._image_formats[0]
+
+    def _get_cache_format(self):
+        return CACHE_FORMATS[self._get_provider_format()]
+
+    def _convert_to(self, disk_format):
+        """Link the image converted to disk_format in the conversion dir.
+
+        The converted images are cached per image and format, the image
+        already in disk_format is not converted.
+        """
         self._callback(task_state=hybrid_task_states.CONVERTING)
 
-        converted_file_name = '%s/%s.vmdk' % (self._conversion_dir,
-                                              self._converted_file_name)
-        orig_file_name = '%s/%s' % (self._work_dir, self._image_uuid)
-        image_vmdk_file_name = '%s/%s.vmdk' % (
-            self._work_dir, self._image_uuid)
+        converted_file_name = '%s/%s.%s' % (self._conversion_dir,
+                                            self._converted_file_name,
+                                            disk_format)
+
+        # check if the image or volume is cached in the format
+        image_file_name = self._lookup_cache(disk_format)
+        if not image_file_name:
+            IMAGE_JOBS.do('convert-%s-%s' % (self._get_checksum(),
+                                             disk_format),
+                          self._do_convert,
+                          disk_format,
+                          converted_file_name)
+            image_file_name = self._lookup_cache(disk_format)
+            if not image_file_name:
+                raise exception.NovaException(
+                    'image %s is not converted' % self._image_uuid)
 
-        # check if the image or volume vmdk cached
-        if not os.path.exists(image_vmdk_file_name):
-            LOG.debug("Begin download image file %s " % self._image_uuid)
-
-            metadata = IMAGE_API.get(self._context, self._image_uuid)
+        # link the image file to conversion dir
+        os.link(image_file_name, converted_file_name)
 
-            # convert to vmdk
+        self._callback(task_state=self._task_state)
+        return converted_file_name
+
+    def _do_convert(self, disk_format, converted_file_name):
+        metadata = self._get_metadata()
+        if self._cache.contains(self._get_checksum(), disk_format):
+            # converted by a concurrent spawn
+            return
+
+        orig_file_name = self._lookup_cache(metadata['disk_format'])
+        if not orig_file_name:
+            raise exception.NovaException(
+                'image %s is not downloaded' % self._image_uuid)
+
+        # the vmdk is ready to be packaged as it is
+        if (disk_format == 'vmdk' and
+                cfg.CONF.hybrid_driver.ovf_packaging == 'native'):
+            self._convert_to_stream_optimized(metadata['disk_format'],
+                                              orig_file_name,
+                                              converted_file_name,
+                                              hybrid_task_states.CONVERTING)
+        else:
             common_tools.convert_vm(metadata['disk_format'],
                                     orig_file_name,
-                                    'vmdk',
-                                    converted_file_name)
-
-            shutil.move(converted_file_name, image_vmdk_file_name)
+                                    disk_format,
+                                    converted_file_name,
+                                    instance_uuid=self._uuid,
+                                    callback=self._callback,
+                                    task_state=hybrid_task_states.CONVERTING)
+        if not os.path.exists(converted_file_name):
+            raise exception.NovaException(
+                'unable to convert image %s to %s' % (self._image_uuid,
+                                                      disk_format))
+
+        self._add_to_cache(disk_format, converted_file_name)
+
+    def _convert_to_stream_optimized(self, src_format, src_file, dst_file,
+                                     task_state):
+        common_tools.convert_to_stream_optimized(
+            src_format,
+            src_file,
+            dst_file,
+            cfg.CONF.hybrid_driver.vmdk_writer_processes,
+            cfg.CONF.hybrid_driver.vmdk_compression_level,
+            instance_uuid=self._uuid,
+            callback=self._callback,
+            task_state=task_state)
+
+    def _get_disk_file_name(self, disk_format):
+        # named as the disks of the ovftool packages
+        return '%s/%s-disk1.%s' % (self._conversion_dir, self._uuid,
+                                   disk_format)
+
+    def _make_stream_optimized(self, converted_file_name, task_state):
+        disk_file_name = self._get_disk_file_name('vmdk')
+        if ovf_packager.is_stream_optimized(converted_file_name):
+            # the cached vmdk is used as it is
+            os.rename(converted_file_name, disk_file_name)
+        else:
+            self._convert_to_stream_optimized('vmdk',
+                                              converted_file_name,
+                                              disk_file_name,
+                                              task_state)
+        return disk_file_name
+
+    def _package_ovf(self):
+        self._callback(task_state=hybrid_task_states.PACKING)
 
-        # link the image file to conversion dir
-        os.link(image_vmdk_file_name, converted_file_name)
+        converted_file_name = '%s/%s.vmdk' % (self._conversion_dir,
+                                              self._converted_file_name)
+        disk_file_name = self._make_stream_optimized(
+            converted_file_name, hybrid_task_states.PACKING)
+
+        cpus, memory_mb = 1, 1024
+        if self._flavor:
+            cpus, memory_mb = self._flavor.vcpus, self._flavor.memory_mb
+        # no nic: the template is shared by all the instances of the image
+        # (and pre-warmed without any), the nics of an instance are created
+        # on its networks when its vapp is instantiated, as with the
+        # base-template.vmx of ovftool
+        ovf_name = ovf_packager.write_ovf(
+            '%s/%s.ovf' % (self._conversion_dir, self._uuid),
+            'vm',
+            [disk_file_name],
+            cpus,
+            memory_mb,
+            nics=0)
 
         self._callback(task_state=self._task_state)
+        return ovf_name
 
     def _convert_vmdk_to_ovf(self):
+        if cfg.CONF.hybrid_driver.ovf_packaging == 'native':
+            return self._package_ovf()
+
         self._callback(task_state=hybrid_task_states.PACKING)
 
         vmx_file_dir = '%s/%s' % (self._work_dir, 'vmx')
@@ -100,9 +328,13 @@ class ImageConvertorToOvf(object):
 
         mk_ovf_cmd = 'ovftool -o %s %s' % (vmx_full_name, ovf_name)
 
-        LOG.debug("begin run command %s" % mk_ovf_cmd)
-        mk_ovf_result = subprocess.call(mk_ovf_cmd, shell=True)
-        LOG.debug("end run command %s" % mk_ovf_cmd)
+        mk_ovf_result = conversion_scheduler.execute(
+            'make ovf %s' % ovf_name,
+            mk_ovf_cmd,
+            instance_uuid=self._uuid,
+            io=True,
+            callback=self._callback,
+            task_state=hybrid_task_states.PACKING)
 
         if mk_ovf_result != 0:
             LOG.error('make ovf failed!')
@@ -110,21 +342,122 @@ class ImageConvertorToOvf(object):
         self._callback(task_state=self._task_state)
         return ovf_name
 
-    def download_image(self):
-        dest_file_name = '%s/%s' % (self._work_dir, self._image_uuid)
-        if not os.path.exists(dest_file_name):
-            self._callback(task_state=hybrid_task_states.DOWNLOADING)
-            orig_file_name = "%s/%s.tmp" % (self._conversion_dir,
-                                            self._image_uuid)
-            LOG.debug("Begin download image file %s " % self._image_uuid)
+    def _stream_to_vmdk(self, metadata):
+        self._callback(task_state=hybrid_task_states.DOWNLOADING)
+
+        converted_file_name = '%s/%s.vmdk' % (self._conversion_dir,
+                                              self._converted_file_name)
+        socket_path = '%s/nbd.sock' % self._conversion_dir
+        file_size = int(metadata['size'])
+        LOG.debug("Begin stream image file %s to vmdk" % self._image_uuid)
+
+        common_tools.create_image('vmdk', converted_file_name, file_size)
+        nbd_process = common_tools.start_nbd_export('vmdk',
+                                                    converted_file_name,
+                                                    socket_path)
+        digest = self._new_digest()
+        try:
+            read_iter = IMAGE_API.download(self._context, self._image_uuid)
+            glance_file_handle = util.DigestFileRead(
+                util.GlanceFileRead(read_iter), digest)
 
-            metadata = IMAGE_API.get(self._context, self._image_uuid)
-            file_size = int(metadata['size'])
+            nbd_file_handle = util.NbdFileWrite(socket_path)
 
+            util.start_transfer(self._context,
+                                glance_file_handle,
+                                file_size,
+                                write_file_handle=nbd_file_handle,
+                                task_state=hybrid_task_states.DOWNLOADING,
+                                callback=self._callback)
+        finally:
+            # qemu-nbd exits once the client is disconnected
+            nbd_result = common_tools.stop_nbd_export(
+                nbd_process, common_tools.NBD_SOCKET_WAIT_TIME)
+        if nbd_result != 0:
+            raise exception.NovaException(
+                'qemu-nbd failed to write %s' % converted_file_name)
+        self._verify_digest(digest, file_size)
+
+        self._add_to_cache('vmdk', converted_file_name)
+        self._callback(task_state=self._task_state)
+
+    def _is_image_cached(self, pin=True):
+        checksum = self._get_checksum()
+        disk_format = self._get_metadata()['disk_format']
+        cache_format = self._get_cache_format()
+        if not pin:
+            return (self._cache.contains(checksum, cache_format) or
+                    self._cache.contains(checksum, disk_format))
+        # no need of the original image if the converted one is cached
+        return (self._lookup_cache(cache_format) or
+                self._lookup_cache(disk_format))
+
+    def _ranged_download(self, file_name, file_size, part_size, journal,
+                         digest):
+        connections = cfg.CONF.hybrid_driver.glance_download_connections
+        min_size = (cfg.CONF.hybrid_driver.glance_ranged_download_min_size_mb
+                    * 1024 * 1024)
+        # an interrupted download is resumed with ranged requests
+        resume = bool(journal.get('done_parts'))
+        if not resume and (connections <= 1 or file_size < min_size):
+            return False
+        LOG.debug("Begin ranged download of image file %s with %d "
+                  "connections" % (self._image_uuid, connections))
+        return util.start_ranged_download(
+            self._context,
+            self._image_uuid,
+            file_name,
+            file_size,
+            max(connections, 1),
+            part_size,
+            task_state=hybrid_task_states.DOWNLOADING,
+            callback=self._callback,
+            journal=journal,
+            digest=digest)
+
+    def _download_image(self):
+        if self._is_image_cached(pin=False):
+            # downloaded by a concurrent spawn
+            return
+        metadata = self._get_metadata()
+
+        # raw images can be written to the vmdk as they arrive
+        if (cfg.CONF.hybrid_driver.stream_conversion and
+                metadata['disk_format'] == 'raw' and
+                self._get_cache_format() == 'vmdk'):
+            self._stream_to_vmdk(metadata)
+            return
+
+        self._callback(task_state=hybrid_task_states.DOWNLOADING)
+        # the partial download survives to the conversion dir and to a
+        # restart, its journal records the parts durably written
+        partial_dir = '%s/partial' % self._work_dir
+        fileutils.ensure_tree(partial_dir)
+        orig_file_name = "%s/%s.%s" % (partial_dir,
+                                       self._get_checksum(),
+                                       metadata['disk_format'])
+        LOG.debug("Begin download image file %s " % self._image_uuid)
+
+        file_size = int(metadata['size'])
+        part_size = (cfg.CONF.hybrid_driver.glance_download_part_size_mb *
+                     1024 * 1024)
+        journal = util.TransferJournal('%s.journal' % orig_file_name, {
+            'image_id': self._image_uuid,
+            'checksum': self._get_checksum(),
+            'size': file_size,
+        })
+
+        # the checksum is computed on the data as it flows
+        digest = self._new_digest()
+        if not self._ranged_download(orig_file_name, file_size, part_size,
+                                     journal, digest):
             read_iter = IMAGE_API.download(self._context, self._image_uuid)
-            glance_file_handle = util.GlanceFileRead(read_iter)
+            glance_file_handle = util.DigestFileRead(
+                util.GlanceFileRead(read_iter), digest)
 
-            orig_file_handle = file(orig_file_name, "wb")
+            orig_file_handle = util.JournaledFileWrite(orig_file_name,
+                                                       journal,
+                                                       part_size)
 
             util.start_transfer(self._context,
                                 glance_file_handle,
@@ -132,10 +465,51 @@ class ImageConvertorToOvf(object):
                                 write_file_handle=orig_file_handle,
                                 task_state=hybrid_task_states.DOWNLOADING,
                                 callback=self._callback)
-            # move to dest_file_name
-            shutil.move(orig_file_name, dest_file_name)
-            self._callback(task_state=self._task_state)
+        try:
+            sha256 = self._verify_digest(digest, file_size)
+        except Exception:
+            # a corrupted download is not resumed
+            journal.remove()
+            fileutils.delete_if_exists(orig_file_name)
+            raise
+
+        # move to the image cache
+        journal.remove()
+        self._add_to_cache(metadata['disk_format'], orig_file_name,
+                           sha256=sha256)
+        self._callback(task_state=self._task_state)
+
+    def download_image(self):
+        if self._is_image_cached():
+            return
+        # only one of the concurrent spawns of the image downloads it
+        self._callback(task_state=hybrid_task_states.DOWNLOADING)
+        IMAGE_JOBS.do('download-%s' % self._get_checksum(),
+                      self._download_image)
+        if not self._is_image_cached():
+            raise exception.NovaException(
+                'image %s is not downloaded' % self._image_uuid)
 
     def convert_to_ovf_format(self):
-        self._convert_to_vmdk()
+        self._convert_to('vmdk')
         return self._convert_vmdk_to_ovf()
+
+    def convert_to_provider_format(self):
+        """Deliver the image in the cheapest of the formats accepted by the
+        provider.
+
+        :returns: the format and the files (ovf descriptor or disks)
+        """
+        provider_format = self._get_provider_format()
+        if provider_format == 'ovf':
+            return provider_format, [self.convert_to_ovf_format()]
+
+        converted_file_name = self._convert_to(CACHE_FORMATS[provider_format])
+        if provider_format == 'vmdk':
+            disk_file_name = self._make_stream_optimized(
+                converted_file_name, hybrid_task_states.CONVERTING)
+        else:
+            disk_file_name = self._get_disk_file_name(provider_format)
+            os.rename(converted_file_name, disk_file_name)
+        self._callback(task_state=self._task_state)
+        return provider_format, [disk_file_name]
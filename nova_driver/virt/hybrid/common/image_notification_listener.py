@@ -0,0 +1,104 @@
+"""
+Listener of the glance notifications importing the new images to the
+provider as soon as they are active.
+
+The images activated (or updated) with the properties of the filter are
+queued to the pre-warm service, their download, conversion and import run in
+the background: the publisher of the image bears the latency of the import
+instead of its first spawn.
+"""
+import oslo_messaging as messaging
+
+from oslo_config import cfg
+
+from oslo_log import log as logging
+
+image_notification_listener_opts = [
+    cfg.BoolOpt('glance_notifications',
+                default=False,
+                help='Import the images to the provider on their glance '
+                'image.activate notifications'),
+    cfg.StrOpt('glance_notifications_topic',
+               default='notifications',
+               help='Topic of the glance notifications'),
+    cfg.StrOpt('glance_notifications_exchange',
+               default='glance',
+               help='Exchange of the glance notifications'),
+    cfg.StrOpt('glance_notifications_pool',
+               help='Listener pool of the glance notifications, default to '
+               'one pool per host, every host gets all the notifications'),
+    cfg.DictOpt('glance_preimport_filter',
+                default={'hybrid_preimport': 'true'},
+                help='Properties of the images imported on their glance '
+                'notifications'),
+]
+
+
+cfg.CONF.register_opts(image_notification_listener_opts, 'hybrid_driver')
+
+
+LOG = logging.getLogger(__name__)
+
+EVENT_TYPES = ('image.activate', 'image.update')
+
+
+def matches_filter(image_payload, image_filter):
+    """Return True if the image has all the properties of the filter (the
+    values are compared case insensitively).
+    """
+    properties = image_payload.get('properties') or {}
+    for name, value in image_filter.items():
+        image_value = properties.get(name, image_payload.get(name))
+        if image_value is None:
+            return False
+        if str(image_value).lower() != str(value).lower():
+            return False
+    return True
+
+
+class ImageNotificationEndpoint(object):
+
+    def __init__(self, prewarm, image_filter):
+        """
+        :param prewarm: function(image_uuid, ctxt) queuing the import of an
+                        image, called with the context of the notification
+        """
+        self._prewarm = prewarm
+        self._image_filter = image_filter
+
+    def info(self, ctxt, publisher_id, event_type, payload, metadata):
+        if event_type not in EVENT_TYPES:
+            return
+        if payload.get('status') != 'active':
+            return
+        if not matches_filter(payload, self._image_filter):
+            return
+        LOG.info('%s of image %s (request %s), import queued' % (
+            event_type, payload.get('id'), (ctxt or {}).get('request_id')))
+        self._prewarm(payload['id'], ctxt)
+
+
+def start_listener(prewarm):
+    """Start the listener of the glance notifications if enabled.
+
+    :returns: the listener or None
+    """
+    conf = cfg.CONF.hybrid_driver
+    if not conf.glance_notifications:
+        return None
+    transport = messaging.get_notification_transport(cfg.CONF)
+    targets = [messaging.Target(topic=conf.glance_notifications_topic,
+                                exchange=conf.glance_notifications_exchange)]
+    endpoints = [ImageNotificationEndpoint(prewarm,
+                                           conf.glance_preimport_filter)]
+    pool = (conf.glance_notifications_pool or
+            'hybrid-driver-%s' % cfg.CONF.host)
+    listener = messaging.get_notification_listener(transport,
+                                                   targets,
+                                                   endpoints,
+                                                   executor='eventlet',
+                                                   pool=pool)
+    listener.start()
+    LOG.info('listening to the glance notifications on %s (pool %s)' % (
+        conf.glance_notifications_topic, pool))
+    return listener
@@ -0,0 +1,261 @@
+"""
+Background pre-warming of the images: the images are downloaded, converted
+and imported to the provider (vCloud template, AWS AMI) before their first
+spawn, the spawns of a warm image go straight to the creation of the VM.
+
+The images pre-warmed are the configured ones (by id or by tag) and the
+images the most spawned by the host recently. A bounded number of images is
+pre-warmed at once, their conversions go through the conversion scheduler as
+the ones of the spawns.
+
+The pre-warms have no request context: glance is called with the token of
+the service user of [keystone_authtoken], renewed by keystone when it
+expires.
+"""
+import collections
+import json
+import os
+import threading
+import time
+
+from eventlet import greenthread
+from eventlet import queue
+
+from keystoneauth1 import loading as ks_loading
+from keystoneauth1 import session as ks_session
+
+from nova import context as nova_context
+from nova import exception
+from nova import image
+
+from oslo_config import cfg
+
+from oslo_log import log as logging
+
+image_prewarmer_opts = [
+    cfg.ListOpt('prewarm_images',
+                default=[],
+                help='Ids of the glance images pre-warmed in the provider'),
+    cfg.ListOpt('prewarm_image_tags',
+                default=[],
+                help='Tags of the glance images pre-warmed in the provider '
+                '(glance tags or comma separated "tags" image property)'),
+    cfg.IntOpt('prewarm_learned_images',
+               default=0,
+               help='Number of the images the most spawned by the host '
+               'pre-warmed in the provider, 0 to not learn them'),
+    cfg.IntOpt('prewarm_learning_window_hours',
+               default=168,
+               help='Period of the spawns the hottest images are learned '
+               'from'),
+    cfg.IntOpt('prewarm_max_concurrent',
+               default=1,
+               help='Maximum number of images pre-warmed at once'),
+    cfg.IntOpt('prewarm_interval',
+               default=600,
+               help='Interval in seconds between two checks of the images '
+               'to pre-warm'),
+]
+
+
+cfg.CONF.register_opts(image_prewarmer_opts, 'hybrid_driver')
+cfg.CONF.import_opt('cafile', 'keystonemiddleware.auth_token',
+                    'keystone_authtoken')
+cfg.CONF.import_opt('insecure', 'keystonemiddleware.auth_token',
+                    'keystone_authtoken')
+
+
+LOG = logging.getLogger(__name__)
+IMAGE_API = image.API()
+
+SPAWN_HISTORY = 'prewarm-spawns.json'
+
+# keystone session of the service user, created on first use
+_service_session = None
+_service_session_lock = threading.Lock()
+
+
+def _get_service_session():
+    global _service_session
+    with _service_session_lock:
+        if _service_session is None:
+            auth = ks_loading.load_auth_from_conf_options(
+                cfg.CONF, 'keystone_authtoken')
+            if auth is None:
+                raise exception.NovaException(
+                    'no service credentials in [keystone_authtoken] '
+                    '(auth_type), unable to call glance')
+            conf = cfg.CONF.keystone_authtoken
+            verify = False if conf.insecure else (conf.cafile or True)
+            _service_session = ks_session.Session(auth=auth, verify=verify)
+        return _service_session
+
+
+def get_service_context(request_id=None):
+    """Return an admin context with a valid token of the service user.
+
+    :param request_id: id of the request the pre-warm comes from, generated
+                       if None
+    """
+    session = _get_service_session()
+    access = session.auth.get_access(session)
+    return nova_context.RequestContext(user_id=access.user_id,
+                                       project_id=access.project_id,
+                                       roles=access.role_names,
+                                       auth_token=access.auth_token,
+                                       request_id=request_id,
+                                       is_admin=True)
+
+
+def _image_tags(image_meta):
+    tags = set(image_meta.get('tags') or [])
+    tags_property = image_meta.get('properties', {}).get('tags')
+    if tags_property:
+        tags.update(tag.strip() for tag in tags_property.split(','))
+    return tags
+
+
+class PrewarmStateUpdater(object):
+    """Task state callback of the conversions of a pre-warm (no instance).
+    """
+
+    def __init__(self, image_uuid):
+        self._image_uuid = image_uuid
+
+    def __call__(self, task_state):
+        LOG.debug('pre-warm of image %s: %s' % (self._image_uuid, task_state))
+
+
+class ImagePrewarmer(object):
+
+    def __init__(self, prewarm_image, work_dir):
+        """
+        :param prewarm_image: function(context, image_meta) preparing the
+                              image in the provider if not already there
+        :param work_dir: directory of the history of the spawns
+        """
+        self._prewarm_image = prewarm_image
+        self._history_file_name = '%s/%s' % (work_dir, SPAWN_HISTORY)
+        self._lock = threading.Lock()
+        # [time, image uuid] of the recent spawns
+        self._spawns = self._load_history()
+        self._queue = queue.Queue()
+        # the images queued or being pre-warmed
+        self._pending = set()
+        self._started = False
+
+    def _load_history(self):
+        try:
+            with open(self._history_file_name, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return []
+
+    def _save_history(self):
+        tmp_file_name = '%s.tmp' % self._history_file_name
+        with open(tmp_file_name, 'w') as f:
+            json.dump(self._spawns, f)
+        os.rename(tmp_file_name, self._history_file_name)
+
+    def start(self):
+        """Start the pre-warm workers and the periodic check of the images.
+        """
+        if self._started:
+            return
+        self._started = True
+        for _ in range(max(1, cfg.CONF.hybrid_driver.prewarm_max_concurrent)):
+            greenthread.spawn(self._worker)
+        conf = cfg.CONF.hybrid_driver
+        if (conf.prewarm_images or conf.prewarm_image_tags or
+                conf.prewarm_learned_images):
+            greenthread.spawn(self._periodic_check)
+
+    def record_spawn(self, image_uuid):
+        """Record the spawn of an image, the hottest images are learned from
+        the recent spawns.
+        """
+        if not cfg.CONF.hybrid_driver.prewarm_learned_images:
+            return
+        now = time.time()
+        window = cfg.CONF.hybrid_driver.prewarm_learning_window_hours * 3600
+        with self._lock:
+            self._spawns = [spawn for spawn in self._spawns
+                            if spawn[0] > now - window]
+            self._spawns.append([now, image_uuid])
+            try:
+                self._save_history()
+            except (IOError, OSError) as e:
+                LOG.warn('unable to save the history of the spawns: %s' % e)
+
+    def learned_images(self, count):
+        """Return the count images the most spawned recently."""
+        since = (time.time() -
+                 cfg.CONF.hybrid_driver.prewarm_learning_window_hours * 3600)
+        with self._lock:
+            spawns = collections.Counter(image_uuid
+                                         for t, image_uuid in self._spawns
+                                         if t > since)
+        return [image_uuid for image_uuid, _ in spawns.most_common(count)]
+
+    def prewarm(self, image_uuid, ctxt=None):
+        """Queue the pre-warm of an image.
+
+        :param ctxt: context (dict) of the notification asking for the
+                     pre-warm, its token may expire before the pre-warm:
+                     only its request id is kept, the service token is used
+        """
+        with self._lock:
+            if image_uuid in self._pending:
+                return
+            self._pending.add(image_uuid)
+        LOG.debug('pre-warm of image %s queued' % image_uuid)
+        self._queue.put((image_uuid, ctxt or {}))
+
+    def _get_images(self, context):
+        conf = cfg.CONF.hybrid_driver
+        image_uuids = list(conf.prewarm_images)
+        if conf.prewarm_image_tags:
+            tags = set(conf.prewarm_image_tags)
+            for image_meta in IMAGE_API.get_all(context):
+                if (image_meta.get('status') == 'active' and
+                        _image_tags(image_meta) & tags):
+                    image_uuids.append(image_meta['id'])
+        if conf.prewarm_learned_images:
+            image_uuids += self.learned_images(conf.prewarm_learned_images)
+        return image_uuids
+
+    def check(self):
+        """Queue the pre-warm of the configured and learned images."""
+        for image_uuid in self._get_images(get_service_context()):
+            self.prewarm(image_uuid)
+
+    def _periodic_check(self):
+        while True:
+            try:
+                self.check()
+            except Exception as e:
+                LOG.error('unable to list the images to pre-warm: %s' % e)
+            greenthread.sleep(cfg.CONF.hybrid_driver.prewarm_interval)
+
+    def _prewarm_now(self, image_uuid, ctxt=None):
+        context = get_service_context((ctxt or {}).get('request_id'))
+        image_meta = IMAGE_API.get(context, image_uuid)
+        if image_meta.get('status') != 'active':
+            LOG.debug('image %s is not active (%s), not pre-warmed' %
+                      (image_uuid, image_meta.get('status')))
+            return
+        start = time.time()
+        self._prewarm_image(context, image_meta)
+        LOG.info('image %s pre-warmed in %.1f s' % (
+            image_uuid, time.time() - start))
+
+    def _worker(self):
+        while True:
+            image_uuid, ctxt = self._queue.get()
+            try:
+                self._prewarm_now(image_uuid, ctxt)
+            except Exception as e:
+                LOG.error('pre-warm of image %s failed: %s' % (image_uuid, e))
+            finally:
+                with self._lock:
+                    self._pending.discard(image_uuid)
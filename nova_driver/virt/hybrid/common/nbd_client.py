@@ -0,0 +1,126 @@
+"""
+Client of the images exported by qemu-nbd on a unix socket.
+
+Only the python standard library is used: the module is loaded by the
+vmdk writer process (and its workers) without nova.
+"""
+import socket
+import struct
+
+# NBD protocol constants (fixed newstyle and oldstyle negotiation)
+NBD_INIT_PASSWD = 'NBDMAGIC'
+NBD_OPTS_MAGIC = 0x49484156454F5054
+NBD_CLISERV_MAGIC = 0x00420281861253
+NBD_FLAG_FIXED_NEWSTYLE = 1 << 0
+NBD_FLAG_NO_ZEROES = 1 << 1
+NBD_FLAG_SEND_FLUSH = 1 << 2
+NBD_OPT_EXPORT_NAME = 1
+NBD_REQUEST_MAGIC = 0x25609513
+NBD_REPLY_MAGIC = 0x67446698
+NBD_CMD_READ = 0
+NBD_CMD_WRITE = 1
+NBD_CMD_DISC = 2
+NBD_CMD_FLUSH = 3
+NBD_MAX_REQUEST_SIZE = 32 * 1024 * 1024
+
+
+class NbdError(IOError):
+    pass
+
+
+class NbdClient(object):
+    """Client of an image exported by qemu-nbd on a unix socket."""
+
+    def __init__(self, socket_path, export_name=''):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(socket_path)
+        self._handle = 0
+        self.offset = 0
+        self.size, self._flags = self._negotiate(export_name)
+
+    def _recv(self, length):
+        data = ''
+        while len(data) < length:
+            chunk = self._sock.recv(length - len(data))
+            if not chunk:
+                raise NbdError("NBD server closed the connection")
+            data += chunk
+        return data
+
+    def _negotiate(self, export_name):
+        passwd, magic = struct.unpack('>8sQ', self._recv(16))
+        if passwd != NBD_INIT_PASSWD:
+            raise NbdError("Bad NBD server magic")
+        if magic == NBD_CLISERV_MAGIC:
+            # oldstyle negotiation: size, flags and 124 bytes of zeroes
+            size, flags = struct.unpack('>QI', self._recv(12))
+            self._recv(124)
+            return size, flags & 0xffff
+        if magic != NBD_OPTS_MAGIC:
+            raise NbdError("Unknown NBD negotiation")
+        server_flags, = struct.unpack('>H', self._recv(2))
+        client_flags = server_flags & (NBD_FLAG_FIXED_NEWSTYLE |
+                                       NBD_FLAG_NO_ZEROES)
+        self._sock.sendall(struct.pack('>I', client_flags))
+        self._sock.sendall(struct.pack('>QII', NBD_OPTS_MAGIC,
+                                       NBD_OPT_EXPORT_NAME,
+                                       len(export_name)) + export_name)
+        size, flags = struct.unpack('>QH', self._recv(10))
+        if not client_flags & NBD_FLAG_NO_ZEROES:
+            self._recv(124)
+        return size, flags
+
+    def _request(self, cmd, offset=0, data='', length=None):
+        self._handle += 1
+        if length is None:
+            length = len(data)
+        self._sock.sendall(struct.pack('>IHHQQI', NBD_REQUEST_MAGIC, 0, cmd,
+                                       self._handle, offset, length))
+        if data:
+            self._sock.sendall(data)
+        if cmd == NBD_CMD_DISC:
+            return
+        magic, error, handle = struct.unpack('>IIQ', self._recv(16))
+        if magic != NBD_REPLY_MAGIC or handle != self._handle:
+            raise NbdError("Bad NBD reply")
+        if error:
+            raise NbdError("NBD request %s at %s failed: %s" % (cmd, offset,
+                                                                error))
+        if cmd == NBD_CMD_READ:
+            return self._recv(length)
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.offset
+        elif whence == 2:
+            offset += self.size
+        self.offset = offset
+
+    def tell(self):
+        return self.offset
+
+    def close(self):
+        try:
+            self._request(NBD_CMD_DISC)
+        finally:
+            self._sock.close()
+
+
+class NbdFileRead(NbdClient):
+    """Read handle of an NBD export, used to read the content of an image
+    of any format through a (read-only) qemu-nbd export.
+    """
+
+    def pread(self, offset, length):
+        length = max(0, min(length, self.size - offset))
+        data = []
+        for pos in range(offset, offset + length, NBD_MAX_REQUEST_SIZE):
+            data.append(self._request(
+                NBD_CMD_READ, pos,
+                length=min(NBD_MAX_REQUEST_SIZE, offset + length - pos)))
+        return ''.join(data)
+
+    def read(self, chunk_size):
+        data = self.pread(self.offset, chunk_size)
+        self.offset += len(data)
+        return data
@@ -0,0 +1,225 @@
+"""
+In process OVF packaging of the converted disks.
+
+The OVF envelope is generated from the flavor of the instance and references
+the streamOptimized disks as they are, so the package is built without any
+pass over the disk data (ovftool reads and compresses the disks again).
+"""
+import itertools
+import os
+import re
+import struct
+from xml.etree import ElementTree
+
+from nova import exception
+
+from oslo_log import log as logging
+
+LOG = logging.getLogger(__name__)
+
+OVF_NS = 'http://schemas.dmtf.org/ovf/envelope/1'
+RASD_NS = ('http://schemas.dmtf.org/wbem/wscim/1/cim-schema/2/'
+           'CIM_ResourceAllocationSettingData')
+VSSD_NS = ('http://schemas.dmtf.org/wbem/wscim/1/cim-schema/2/'
+           'CIM_VirtualSystemSettingData')
+VMW_NS = 'http://www.vmware.com/schema/ovf'
+VMDK_STREAM_OPTIMIZED = ('http://www.vmware.com/interfaces/specifications/'
+                         'vmdk.html#streamOptimized')
+
+for prefix, ns in (('ovf', OVF_NS), ('rasd', RASD_NS), ('vssd', VSSD_NS),
+                   ('vmw', VMW_NS)):
+    ElementTree.register_namespace(prefix, ns)
+
+# rasd resource types
+RESOURCE_CPU = 3
+RESOURCE_MEMORY = 4
+RESOURCE_IDE_CONTROLLER = 5
+RESOURCE_SCSI_CONTROLLER = 6
+RESOURCE_ETHERNET_ADAPTER = 10
+RESOURCE_CD_DRIVE = 15
+RESOURCE_DISK_DRIVE = 17
+
+# same virtual hardware as the base vmx template
+VIRTUAL_SYSTEM_TYPE = 'vmx-10'
+OS_TYPE_ID = 101
+OS_TYPE = 'otherLinux64Guest'
+SCSI_CONTROLLER = 'lsilogic'
+ETHERNET_ADAPTER = 'E1000'
+NETWORK_NAME = 'VM Network'
+# the OVF environment of the vm (user data properties) is read by the guest
+# from guestinfo.ovfEnv
+OVF_ENV_TRANSPORT = 'com.vmware.guestInfo'
+
+VMDK_MAGIC = 0x564d444b
+SECTOR_SIZE = 512
+
+
+def read_vmdk_descriptor(vmdk_file_name):
+    """Return the capacity (bytes) and the create type of a sparse vmdk."""
+    with open(vmdk_file_name, 'rb') as f:
+        header = f.read(SECTOR_SIZE)
+        (magic, version, flags, capacity, grain_size, descriptor_offset,
+         descriptor_size) = struct.unpack('<IIIQQQQ', header[:44])
+        if magic != VMDK_MAGIC:
+            raise exception.NovaException(
+                '%s is not a sparse vmdk' % vmdk_file_name)
+        f.seek(descriptor_offset * SECTOR_SIZE)
+        descriptor = f.read(descriptor_size * SECTOR_SIZE)
+    create_type = re.search(r'createType\s*=\s*"([^"]*)"', descriptor)
+    return {
+        'capacity': capacity * SECTOR_SIZE,
+        'create_type': create_type and create_type.group(1),
+    }
+
+
+def is_stream_optimized(vmdk_file_name):
+    try:
+        descriptor = read_vmdk_descriptor(vmdk_file_name)
+    except (IOError, struct.error, exception.NovaException):
+        return False
+    return descriptor['create_type'] == 'streamOptimized'
+
+
+def _ovf(tag):
+    return '{%s}%s' % (OVF_NS, tag)
+
+
+def _sub(parent, tag, text=None, **attrs):
+    element = ElementTree.SubElement(parent, tag, attrs)
+    if text is not None:
+        element.text = str(text)
+    return element
+
+
+def _item(parent, **rasd):
+    item = _sub(parent, _ovf('Item'))
+    # the schema wants the rasd elements in alphabetic order
+    for name in sorted(rasd):
+        _sub(item, '{%s}%s' % (RASD_NS, name), rasd[name])
+    return item
+
+
+def make_ovf(vm_name, disk_file_names, cpus=1, memory_mb=1024, nics=0):
+    """Return the OVF envelope of a vm with the given streamOptimized disks.
+
+    :param nics: number of ethernet adapters, the vm is connected to its
+                 networks when created
+    """
+    envelope = ElementTree.Element(_ovf('Envelope'))
+    references = _sub(envelope, _ovf('References'))
+    disk_section = _sub(envelope, _ovf('DiskSection'))
+    _sub(disk_section, _ovf('Info'), 'Virtual disk information')
+    for i, disk_file_name in enumerate(disk_file_names, 1):
+        _sub(references, _ovf('File'), **{
+            _ovf('href'): os.path.basename(disk_file_name),
+            _ovf('id'): 'file%d' % i,
+            _ovf('size'): str(os.path.getsize(disk_file_name)),
+        })
+        descriptor = read_vmdk_descriptor(disk_file_name)
+        _sub(disk_section, _ovf('Disk'), **{
+            _ovf('capacity'): str(descriptor['capacity']),
+            _ovf('capacityAllocationUnits'): 'byte',
+            _ovf('diskId'): 'vmdisk%d' % i,
+            _ovf('fileRef'): 'file%d' % i,
+            _ovf('format'): VMDK_STREAM_OPTIMIZED,
+        })
+    if nics:
+        network_section = _sub(envelope, _ovf('NetworkSection'))
+        _sub(network_section, _ovf('Info'), 'The list of logical networks')
+        network = _sub(network_section, _ovf('Network'),
+                       **{_ovf('name'): NETWORK_NAME})
+        _sub(network, _ovf('Description'),
+             'The %s network' % NETWORK_NAME)
+
+    system = _sub(envelope, _ovf('VirtualSystem'), **{_ovf('id'): vm_name})
+    _sub(system, _ovf('Info'), 'A virtual machine')
+    _sub(system, _ovf('Name'), vm_name)
+    os_section = _sub(system, _ovf('OperatingSystemSection'), **{
+        _ovf('id'): str(OS_TYPE_ID),
+        '{%s}osType' % VMW_NS: OS_TYPE,
+    })
+    _sub(os_section, _ovf('Info'), 'The kind of installed guest operating '
+         'system')
+
+    hardware = _sub(system, _ovf('VirtualHardwareSection'),
+                    **{_ovf('transport'): OVF_ENV_TRANSPORT})
+    _sub(hardware, _ovf('Info'), 'Virtual hardware requirements')
+    hw_system = _sub(hardware, _ovf('System'))
+    _sub(hw_system, '{%s}ElementName' % VSSD_NS, 'Virtual Hardware Family')
+    _sub(hw_system, '{%s}InstanceID' % VSSD_NS, 0)
+    _sub(hw_system, '{%s}VirtualSystemIdentifier' % VSSD_NS, vm_name)
+    _sub(hw_system, '{%s}VirtualSystemType' % VSSD_NS, VIRTUAL_SYSTEM_TYPE)
+
+    instance_ids = itertools.count(1)
+    _item(hardware,
+          AllocationUnits='hertz * 10^6',
+          Description='Number of Virtual CPUs',
+          ElementName='%d virtual CPU(s)' % cpus,
+          InstanceID=next(instance_ids),
+          ResourceType=RESOURCE_CPU,
+          VirtualQuantity=cpus)
+    _item(hardware,
+          AllocationUnits='byte * 2^20',
+          Description='Memory Size',
+          ElementName='%dMB of memory' % memory_mb,
+          InstanceID=next(instance_ids),
+          ResourceType=RESOURCE_MEMORY,
+          VirtualQuantity=memory_mb)
+    scsi_id = next(instance_ids)
+    _item(hardware,
+          Address=0,
+          Description='SCSI Controller',
+          ElementName='SCSI controller 0',
+          InstanceID=scsi_id,
+          ResourceSubType=SCSI_CONTROLLER,
+          ResourceType=RESOURCE_SCSI_CONTROLLER)
+    ide_id = next(instance_ids)
+    _item(hardware,
+          Address=0,
+          Description='IDE Controller',
+          ElementName='IDE 0',
+          InstanceID=ide_id,
+          ResourceType=RESOURCE_IDE_CONTROLLER)
+    for i in range(1, len(disk_file_names) + 1):
+        _item(hardware,
+              AddressOnParent=i - 1,
+              ElementName='Hard disk %d' % i,
+              HostResource='ovf:/disk/vmdisk%d' % i,
+              InstanceID=next(instance_ids),
+              Parent=scsi_id,
+              ResourceType=RESOURCE_DISK_DRIVE)
+    # the user data iso is inserted in the cdrom
+    _item(hardware,
+          AddressOnParent=0,
+          AutomaticAllocation='false',
+          ElementName='CD/DVD drive 1',
+          InstanceID=next(instance_ids),
+          Parent=ide_id,
+          ResourceType=RESOURCE_CD_DRIVE)
+    for i in range(nics):
+        _item(hardware,
+              AddressOnParent=i,
+              AutomaticAllocation='true',
+              Connection=NETWORK_NAME,
+              ElementName='Network adapter %d' % (i + 1),
+              InstanceID=next(instance_ids),
+              ResourceSubType=ETHERNET_ADAPTER,
+              ResourceType=RESOURCE_ETHERNET_ADAPTER)
+
+    # the properties are set on the vapp when the user data is delivered
+    product = _sub(system, _ovf('ProductSection'))
+    _sub(product, _ovf('Info'), 'Information about the installed software')
+
+    return ElementTree.tostring(envelope, encoding='UTF-8')
+
+
+def write_ovf(ovf_name, vm_name, disk_file_names, cpus=1, memory_mb=1024,
+              nics=0):
+    """Write the OVF descriptor of the disks, stored in the same directory.
+    """
+    LOG.debug('write ovf %s for %s' % (ovf_name, disk_file_names))
+    ovf = make_ovf(vm_name, disk_file_names, cpus, memory_mb, nics)
+    with open(ovf_name, 'w') as f:
+        f.write(ovf)
+    return ovf_name
+
@@ -0,0 +1,164 @@
+"""
+Reporting of the task state (stage and progress) of the spawns.
+
+The task states are saved by a single greenthread: the updates of an
+instance are coalesced (only the last one is saved, at most once per
+interval) and the saves of the host are bounded by a global rate.
+
+report() only records the state under a native lock, it may be called from
+any greenthread or native thread (tpool, boto transfers), the saves always
+run on the eventlet hub.
+"""
+import collections
+import threading
+import time
+
+from eventlet import event
+from eventlet import greenthread
+from eventlet import patcher
+
+from oslo_config import cfg
+
+from oslo_log import log as logging
+
+progress_reporter_opts = [
+    cfg.IntOpt('task_state_max_saves_per_second',
+               default=10,
+               help='Maximum number of saves of the instance task states '
+               'per second for the whole host'),
+    cfg.IntOpt('task_state_save_interval',
+               default=3,
+               help='Minimum interval in seconds between two saves of the '
+               'task state of an instance'),
+]
+
+
+cfg.CONF.register_opts(progress_reporter_opts, 'hybrid_driver')
+
+
+LOG = logging.getLogger(__name__)
+
+# the pending states are checked every tick
+REPORT_TICK = 0.5
+
+native_threading = patcher.original('threading')
+
+_REPORTER = None
+_REPORTER_LOCK = threading.Lock()
+
+
+def get_progress_reporter():
+    """Return the progress reporter of the host (started on first use)."""
+    global _REPORTER
+    with _REPORTER_LOCK:
+        if not _REPORTER:
+            _REPORTER = ProgressReporter(
+                cfg.CONF.hybrid_driver.task_state_max_saves_per_second,
+                cfg.CONF.hybrid_driver.task_state_save_interval)
+            _REPORTER.start()
+        return _REPORTER
+
+
+class ProgressReporter(object):
+
+    def __init__(self, max_rate, interval):
+        self._max_rate = max(1, max_rate)
+        self._interval = interval
+        # never held across a greenthread switch, safe from native threads
+        self._lock = native_threading.Lock()
+        # uuid -> (instance, task_state), in report order
+        self._pending = collections.OrderedDict()
+        # uuid -> (time, task_state) of the last save
+        self._saved = {}
+        # uuid -> event sent at the end of the save in progress
+        self._saving = {}
+        self._tokens = self._max_rate
+        self.saves = 0
+        self.coalesced = 0
+
+    def start(self):
+        greenthread.spawn(self._run)
+
+    def report(self, instance, task_state):
+        """Record the task state of the instance, saved later."""
+        with self._lock:
+            if instance.uuid in self._pending:
+                self.coalesced += 1
+                # the latest state takes the place of the pending one
+                del self._pending[instance.uuid]
+            self._pending[instance.uuid] = (instance, task_state)
+
+    def flush(self, instance):
+        """Save now the pending state of the instance and forget it.
+
+        Called from the hub at the end of the spawn: no save of the instance
+        is in progress or pending once it returns.
+        """
+        while True:
+            with self._lock:
+                saving = self._saving.get(instance.uuid)
+                if not saving:
+                    pending = self._pending.pop(instance.uuid, None)
+                    if pending:
+                        self._saving[instance.uuid] = event.Event()
+                    break
+            saving.wait()
+        if pending:
+            self._save(*pending)
+        with self._lock:
+            self._saved.pop(instance.uuid, None)
+
+    def _take(self, now):
+        taken = []
+        with self._lock:
+            for uuid, (instance, task_state) in self._pending.items():
+                if self._tokens < 1:
+                    break
+                if uuid in self._saving:
+                    continue
+                last_time, last_state = self._saved.get(uuid, (0, None))
+                if task_state == last_state:
+                    del self._pending[uuid]
+                    continue
+                if now - last_time < self._interval:
+                    continue
+                del self._pending[uuid]
+                self._tokens -= 1
+                # saving from now, a flush waits for it
+                self._saving[uuid] = event.Event()
+                taken.append((instance, task_state))
+            # the saves older than the interval do not delay anything
+            for uuid in [uuid for uuid, (t, _) in self._saved.items()
+                         if now - t >= self._interval and
+                         uuid not in self._pending]:
+                del self._saved[uuid]
+        return taken
+
+    def _save(self, instance, task_state):
+        try:
+            instance.task_state = task_state
+            instance.save()
+            self.saves += 1
+        except Exception as e:
+            LOG.warn('unable to save the task state %s of %s: %s' % (
+                task_state, instance.uuid, e))
+        finally:
+            with self._lock:
+                done = self._saving.pop(instance.uuid)
+                self._saved[instance.uuid] = (time.time(), task_state)
+            done.send(True)
+
+    def _run(self):
+        last = time.time()
+        while True:
+            greenthread.sleep(REPORT_TICK)
+            try:
+                now = time.time()
+                self._tokens = min(self._max_rate,
+                                   self._tokens +
+                                   (now - last) * self._max_rate)
+                last = now
+                for instance, task_state in self._take(now):
+                    self._save(instance, task_state)
+            except Exception as e:
+                LOG.exception(e)
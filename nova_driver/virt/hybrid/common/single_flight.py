@@ -0,0 +1,45 @@
+"""
+Run a unit of work once for all the concurrent callers sharing its key.
+
+The first caller does the work, the others wait for it and get the same
+result (or exception).
+"""
+import threading
+
+from eventlet import event
+
+from oslo_log import log as logging
+
+LOG = logging.getLogger(__name__)
+
+
+class SingleFlight(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # key -> event sent when the in-flight call completes
+        self._calls = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = event.Event()
+                self._calls[key] = call
+
+        if not leader:
+            LOG.debug('waiting for the in-flight %s' % key)
+            return call.wait()
+
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            call.send_exception(e)
+            raise
+        else:
+            call.send(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
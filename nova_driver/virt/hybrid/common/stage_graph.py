@@ -0,0 +1,83 @@
+"""
+Run the stages of an operation as a dependency graph.
+
+Each stage runs in its own greenthread as soon as the stages it requires are
+done, the independent branches of the operation overlap. A stage gets the
+results of the stages already done.
+
+When a stage fails the stages depending on it are skipped, the others run to
+completion and run() raises the first exception raised by a stage, with
+its traceback.
+"""
+import collections
+import sys
+import time
+
+import six
+
+from eventlet import event
+from eventlet import greenthread
+
+from oslo_log import log as logging
+
+LOG = logging.getLogger(__name__)
+
+
+class _Skipped(Exception):
+    pass
+
+
+class StageGraph(object):
+
+    def __init__(self, name):
+        self._name = name
+        # stage name -> (function(results), names of the stages required)
+        self._stages = collections.OrderedDict()
+
+    def add(self, name, fn, requires=()):
+        """Add a stage, the stages required must be added before it."""
+        for required in requires:
+            if required not in self._stages:
+                raise ValueError('%s: unknown stage %s required by %s' % (
+                    self._name, required, name))
+        self._stages[name] = (fn, tuple(requires))
+
+    def _run_stage(self, name, fn, requires, done, results, failures):
+        try:
+            for required in requires:
+                done[required].wait()
+        except Exception:
+            done[name].send_exception(_Skipped())
+            return
+        start = time.time()
+        try:
+            results[name] = fn(results)
+        except Exception as e:
+            # in the order they are raised
+            failures.append(sys.exc_info())
+            LOG.error('%s: stage %s failed after %.1f s' % (
+                self._name, name, time.time() - start), exc_info=True)
+            done[name].send_exception(e)
+        else:
+            LOG.debug('%s: stage %s done in %.1f s' % (
+                self._name, name, time.time() - start))
+            done[name].send(True)
+
+    def run(self):
+        """Run the stages and return their results by stage name."""
+        done = dict((name, event.Event()) for name in self._stages)
+        results = {}
+        failures = []
+        for name, (fn, requires) in self._stages.items():
+            greenthread.spawn(self._run_stage, name, fn, requires, done,
+                              results, failures)
+        for name in self._stages:
+            try:
+                done[name].wait()
+            except _Skipped:
+                LOG.debug('%s: stage %s skipped' % (self._name, name))
+            except Exception:
+                pass
+        if failures:
+            six.reraise(*failures[0])
+        return results
@@ -26,26 +26,79 @@ Collection of classes to handle image upload/download to/from Image service
 
 """
 from eventlet import event
+from eventlet import greenpool
 from eventlet import greenthread
 from eventlet import queue
+from eventlet import tpool
 
 from nova.i18n import _
 from nova import image
 
 from nova import exception
+from nova_driver.virt.hybrid.common import nbd_client
+from oslo_config import cfg
 from oslo_log import log as logging
+import hashlib
+import json
+import os
+import requests
+import stat
+import time
 import urllib2
 import thread
 
 
 LOG = logging.getLogger(__name__)
 IMAGE_API = image.API()
-IO_THREAD_SLEEP_TIME = .01
 GLANCE_POLL_INTERVAL = 5
 PROGRESS_REPORT_THREAD_SLEEP_TIME = 3
 
 READ_CHUNKSIZE = 65536
+MAX_READ_CHUNKSIZE = 4 * 1024 * 1024
+# the chunk size grows while a chunk is moved faster than this (in seconds)
+IO_CHUNK_TARGET_TIME = .05
 QUEUE_BUFFER_SIZE = 10
+RANGE_RETRY_COUNT = 3
+# granularity of the zero detection, the zero blocks are left as holes
+SPARSE_BLOCK_SIZE = 4096
+ZERO_BLOCK = '\0' * SPARSE_BLOCK_SIZE
+
+
+def data_runs(data):
+    """Return the (start, end) of the runs of data between the zero blocks.
+
+    The zero blocks don't need to be written in a new (sparse) image.
+    """
+    runs = []
+    start = None
+    for i in range(0, len(data), SPARSE_BLOCK_SIZE):
+        block = data[i:i + SPARSE_BLOCK_SIZE]
+        if block == ZERO_BLOCK[:len(block)]:
+            if start is not None:
+                runs.append((start, i))
+                start = None
+        elif start is None:
+            start = i
+    if start is not None:
+        runs.append((start, len(data)))
+    return runs
+
+
+def write_sparse(file_handle, data):
+    """Write data at the current position of file_handle, seeking over the
+    zero blocks so that the file stays sparse.
+
+    The file has to be extended (truncate) to its final size once written,
+    it may end with a hole.
+    """
+    offset = file_handle.tell()
+    for start, end in data_runs(data):
+        file_handle.seek(offset + start)
+        if start == 0 and end == len(data):
+            file_handle.write(data)
+        else:
+            file_handle.write(data[start:end])
+    file_handle.seek(offset + len(data))
 
 
 class GlanceFileRead(object):
@@ -76,6 +129,53 @@ class GlanceFileRead(object):
         pass
 
 
+class ImageDigest(object):
+    """Incremental digests of the image data flowing through a transfer."""
+
+    def __init__(self, algorithms=('md5',)):
+        self._hashes = dict((algorithm, hashlib.new(algorithm))
+                            for algorithm in algorithms)
+        self.offset = 0
+
+    def update(self, data):
+        for h in self._hashes.itervalues():
+            h.update(data)
+        self.offset += len(data)
+
+    def hexdigest(self, algorithm='md5'):
+        return self._hashes[algorithm].hexdigest()
+
+    def verify(self, image_id, checksum, size):
+        """Check the md5 digest against the glance checksum."""
+        if self.offset != size:
+            raise exception.ImageUnacceptable(
+                image_id=image_id,
+                reason=_("digest of %(offset)d bytes of %(size)d") %
+                {'offset': self.offset, 'size': size})
+        if checksum and self.hexdigest('md5') != checksum:
+            raise exception.ImageUnacceptable(
+                image_id=image_id,
+                reason=_("checksum mismatch, expected %(expected)s, got "
+                         "%(got)s") % {'expected': checksum,
+                                       'got': self.hexdigest('md5')})
+
+
+class DigestFileRead(object):
+    """Read handle updating a digest with the data read."""
+
+    def __init__(self, read_file_handle, digest):
+        self._read_file_handle = read_file_handle
+        self._digest = digest
+
+    def read(self, chunk_size):
+        data = self._read_file_handle.read(chunk_size)
+        self._digest.update(data)
+        return data
+
+    def close(self):
+        self._read_file_handle.close()
+
+
 class HybridFileHandle(file):
 
     def __init__(self, *args):
@@ -85,6 +185,32 @@ class HybridFileHandle(file):
         return self.file.read(READ_CHUNKSIZE)
 
 
+class NbdFileWrite(nbd_client.NbdClient):
+    """Write handle streaming data sequentially into an NBD export.
+
+    It is used to feed an image served by qemu-nbd while the data is
+    still being downloaded, so no intermediate copy is staged on disk.
+    The export is a new image: the zero blocks are not written.
+    """
+
+    def write(self, data):
+        max_size = nbd_client.NBD_MAX_REQUEST_SIZE
+        for start, end in data_runs(data):
+            for pos in range(start, end, max_size):
+                self._request(nbd_client.NBD_CMD_WRITE, self.offset + pos,
+                              data[pos:min(pos + max_size, end)])
+        self.offset += len(data)
+
+    def close(self):
+        try:
+            if self._flags & nbd_client.NBD_FLAG_SEND_FLUSH:
+                self._request(nbd_client.NBD_CMD_FLUSH)
+        except Exception:
+            self._sock.close()
+            raise
+        super(NbdFileWrite, self).close()
+
+
 class GlanceWriteThread(object):
     """Ensures that image data is written to in the glance client and that
     it is in correct ('active')state.
@@ -159,9 +285,28 @@ class GlanceWriteThread(object):
         pass
 
 
+def _get_fd(file_handle):
+    """Return the file descriptor of a real file/socket/pipe handle."""
+    try:
+        fd = file_handle.fileno()
+        os.fstat(fd)
+        return fd
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+
+
+def _is_regular_file(file_handle):
+    fd = _get_fd(file_handle)
+    return fd is not None and stat.S_ISREG(os.fstat(fd).st_mode)
+
+
 class IOThread(object):
     """Class that reads chunks from the input file and writes them to the
     output file till the transfer is completely done.
+
+    The chunk size adapts to the throughput of the transfer, the regular
+    file reads/writes (which would block the eventlet hub) are offloaded to
+    native threads and the hub is yielded to between every chunk.
     """
 
     def __init__(self, input, output):
@@ -169,6 +314,12 @@ class IOThread(object):
         self.output = output
         self._running = False
         self.got_exception = False
+        self._read = input.read
+        self._write = output.write
+        if _is_regular_file(input):
+            self._read = lambda size: tpool.execute(input.read, size)
+        if _is_regular_file(output):
+            self._write = lambda data: tpool.execute(output.write, data)
 
     def start(self):
         self.done = event.Event()
@@ -178,15 +329,35 @@ class IOThread(object):
             until the transfer completes.
             """
             self._running = True
+            chunk_size = READ_CHUNKSIZE
             while self._running:
                 try:
-                    data = self.input.read(READ_CHUNKSIZE)
+                    start = time.time()
+                    data = self._read(chunk_size)
 
                     if not data:
+                        if (isinstance(self.output, ThreadSafePipe) and
+                                self.output.received <
+                                self.output.transfer_size):
+                            # wake up the writer waiting for the data
+                            self.output.write('')
+                            raise exception.NovaException(
+                                'end of the data after %d of %d bytes' % (
+                                    self.output.received,
+                                    self.output.transfer_size))
                         self.stop()
                         self.done.send(True)
-                    self.output.write(data)
-                    greenthread.sleep(IO_THREAD_SLEEP_TIME)
+                        break
+                    self._write(data)
+
+                    elapsed = time.time() - start
+                    if (len(data) >= chunk_size and
+                            elapsed < IO_CHUNK_TARGET_TIME):
+                        chunk_size = min(chunk_size * 2, MAX_READ_CHUNKSIZE)
+                    elif elapsed > 4 * IO_CHUNK_TARGET_TIME:
+                        chunk_size = max(chunk_size // 2, READ_CHUNKSIZE)
+                    # be fair with the other greenthreads
+                    greenthread.sleep(0)
                 except Exception as exc:
                     self.stop()
                     LOG.exception(exc)
@@ -211,6 +382,8 @@ class ThreadSafePipe(queue.LightQueue):
         queue.LightQueue.__init__(self, maxsize)
         self.transfer_size = transfer_size
         self.transferred = 0
+        # bytes written by the reader
+        self.received = 0
 
     def read(self, chunk_size):
         """Read data from the pipe.
@@ -228,6 +401,7 @@ class ThreadSafePipe(queue.LightQueue):
 
     def write(self, data):
         """Put a data item in the pipe."""
+        self.received += len(data)
         self.put(data)
 
     def seek(self, offset, whence=0):
@@ -275,10 +449,12 @@ def start_transfer(context, read_file_handle, data_size,
     elif image_id:
         write_thread = GlanceWriteThread(context, thread_safe_pipe,
                                          image_id, image_meta)
+    transfer_threads = [read_thread, write_thread]
+
     # Start the read and write threads.
-    read_event = read_thread.start()
-    write_event = write_thread.start()
+    transfer_events = [t.start() for t in transfer_threads]
 
+    progressReportThread = None
     if task_state:
         progressReportThread = ProgressReportThread(thread_safe_pipe,
                                                     callback,
@@ -288,14 +464,14 @@ def start_transfer(context, read_file_handle, data_size,
 
     try:
         # Wait on the read and write events to signal their end
-        read_event.wait()
-        write_event.wait()
+        for transfer_event in transfer_events:
+            transfer_event.wait()
     except Exception as exc:
         # In case of any of the reads or writes raising an exception,
         # stop the threads so that we un-necessarily don't keep the other one
         # waiting.
-        read_thread.stop()
-        write_thread.stop()
+        for transfer_thread in transfer_threads:
+            transfer_thread.stop()
 
         if progressReportThread:
             progressReportThread.stop()
@@ -311,6 +487,309 @@ def start_transfer(context, read_file_handle, data_size,
             write_file_handle.close()
 
 
+class TransferJournal(object):
+    """Persistent state of a transfer, used to resume it after a restart.
+
+    The recorded state is ignored when the identity of the transfer (source,
+    size, ...) is not the recorded one, it is kept in dropped_identity and
+    dropped_state to release what it holds.
+    """
+
+    def __init__(self, file_name, identity):
+        self.file_name = file_name
+        self._identity = identity
+        self._state = {}
+        self.dropped_identity = None
+        self.dropped_state = {}
+        try:
+            with open(file_name, 'r') as f:
+                journal = json.load(f)
+            if journal.get('identity') == identity:
+                self._state = journal.get('state', {})
+            else:
+                self.dropped_identity = journal.get('identity')
+                self.dropped_state = journal.get('state', {})
+        except (IOError, ValueError):
+            pass
+
+    def get(self, key, default=None):
+        return self._state.get(key, default)
+
+    def update(self, **kwargs):
+        self._state.update(kwargs)
+        tmp_file_name = '%s.tmp' % self.file_name
+        with open(tmp_file_name, 'w') as f:
+            json.dump({'identity': self._identity, 'state': self._state}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_file_name, self.file_name)
+
+    def remove(self):
+        self._state = {}
+        if os.path.exists(self.file_name):
+            os.remove(self.file_name)
+
+
+class JournaledFileWrite(object):
+    """File write handle recording in a journal the parts of the file
+    durably written, so that the download can be resumed after a restart.
+
+    The zero blocks are not written, the file is sparse.
+    """
+
+    def __init__(self, file_name, journal, part_size):
+        self._file = open(file_name, 'wb')
+        self._journal = journal
+        self._part_size = part_size
+        self._synced_parts = 0
+        self.offset = 0
+        self._journal.update(part_size=part_size, done_parts=[])
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def write(self, data):
+        write_sparse(self._file, data)
+        self.offset += len(data)
+        parts = self.offset // self._part_size
+        if parts > self._synced_parts:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._journal.update(done_parts=[
+                i * self._part_size for i in range(parts)])
+            self._synced_parts = parts
+
+    def close(self):
+        # the file may end with a hole
+        self._file.truncate(self.offset)
+        self._file.close()
+
+
+class GlanceRangedDownload(object):
+    """Download a glance image with concurrent ranged requests.
+
+    Every part is written at its offset in a preallocated sparse file, so
+    the image is reassembled in order whatever the completion order of the
+    parts. The zero blocks of the parts are left as holes.
+    """
+
+    def __init__(self, context, image_id, file_name, file_size,
+                 connections, part_size, journal=None, digest=None):
+        self.context = context
+        self.image_id = image_id
+        self.file_name = file_name
+        self.transfer_size = file_size
+        self.transferred = 0
+        self._connections = connections
+        self._part_size = part_size
+        self._url = '%s/v2/images/%s/file' % (
+            cfg.CONF.glance.api_servers[0].rstrip('/'), image_id)
+        self._verify = not cfg.CONF.glance.api_insecure
+        self._running = False
+        self._journal = journal
+        self._done_parts = set()
+        if journal and journal.get('part_size') == part_size:
+            self._done_parts = set(journal.get('done_parts', []))
+        self._digest = digest
+        self._digesting = False
+
+    def _get(self, session, start, end):
+        headers = {
+            'X-Auth-Token': self.context.auth_token,
+            'Range': 'bytes=%d-%d' % (start, end),
+        }
+        return session.get(self._url, headers=headers, stream=True,
+                           verify=self._verify)
+
+    def _write_response(self, response, offset, length, digest=None):
+        written = 0
+        try:
+            with open(self.file_name, 'r+b') as f:
+                f.seek(offset)
+                for data in response.iter_content(MAX_READ_CHUNKSIZE):
+                    if not self._running:
+                        raise exception.NovaException(
+                            _("Download of %s stopped") % self.image_id)
+                    if digest:
+                        digest.update(data)
+                    tpool.execute(write_sparse, f, data)
+                    written += len(data)
+                    self.transferred += len(data)
+                if self._journal:
+                    f.flush()
+                    tpool.execute(os.fsync, f.fileno())
+            if written != length:
+                raise exception.NovaException(
+                    _("Got %(written)d bytes of %(length)d at %(offset)d") %
+                    {'written': written, 'length': length, 'offset': offset})
+        except Exception:
+            # the part will be downloaded again
+            self.transferred -= written
+            raise
+        finally:
+            response.close()
+
+    def _download_part(self, session, part):
+        start, end = part
+        for attempt in range(1, RANGE_RETRY_COUNT + 1):
+            try:
+                response = self._get(session, start, end)
+                if response.status_code != requests.codes.partial_content:
+                    response.close()
+                    raise exception.NovaException(
+                        _("Unexpected status %(status)s for range "
+                          "%(start)d-%(end)d") %
+                        {'status': response.status_code,
+                         'start': start, 'end': end})
+                self._write_response(response, start, end - start + 1)
+                self._part_done(start)
+                return
+            except Exception as exc:
+                if attempt == RANGE_RETRY_COUNT or not self._running:
+                    raise
+                LOG.warn("Download of range %d-%d of %s failed (%s), "
+                         "retrying" % (start, end, self.image_id, exc))
+
+    def _part_done(self, start):
+        self._done_parts.add(start)
+        if self._journal:
+            self._journal.update(part_size=self._part_size,
+                                 done_parts=sorted(self._done_parts))
+        self._update_digest()
+
+    def _digest_file(self, start, length):
+        with open(self.file_name, 'rb') as f:
+            f.seek(start)
+            while length > 0:
+                data = f.read(min(length, MAX_READ_CHUNKSIZE))
+                if not data:
+                    break
+                self._digest.update(data)
+                length -= len(data)
+
+    def _update_digest(self):
+        # The digest is computed in order, on the contiguous parts already
+        # written (read back while they are still in the page cache).
+        if not self._digest or self._digesting:
+            return
+        self._digesting = True
+        try:
+            while (self._digest.offset < self.transfer_size and
+                   self._digest.offset in self._done_parts):
+                start = self._digest.offset
+                tpool.execute(self._digest_file, start,
+                              min(self._part_size,
+                                  self.transfer_size - start))
+        finally:
+            self._digesting = False
+
+    def _worker(self, parts, session=None):
+        session = session or requests.Session()
+        while self._running:
+            try:
+                part = parts.get_nowait()
+            except queue.Empty:
+                return
+            self._download_part(session, part)
+
+    def download(self):
+        """Download the image.
+
+        :returns: False if the glance server can't be used directly, the
+                  image has then to be downloaded through the image API.
+        """
+        if not os.path.exists(self.file_name):
+            self._done_parts = set()
+        if self._done_parts:
+            LOG.info("Resume the download of %s, %d parts already done" % (
+                self.image_id, len(self._done_parts)))
+        with open(self.file_name, 'r+b' if self._done_parts else 'wb') as f:
+            f.truncate(self.transfer_size)
+        self._running = True
+
+        parts = queue.LightQueue()
+        for start in range(0, self.transfer_size, self._part_size):
+            end = min(start + self._part_size, self.transfer_size) - 1
+            if start in self._done_parts:
+                self.transferred += end - start + 1
+            else:
+                parts.put((start, end))
+        if parts.empty():
+            self._update_digest()
+            return True
+        first_start, first_end = parts.get()
+
+        session = requests.Session()
+        try:
+            response = self._get(session, first_start, first_end)
+        except requests.RequestException as exc:
+            LOG.warn("Unable to reach glance for %s: %s" % (self.image_id,
+                                                             exc))
+            return False
+        if response.status_code == requests.codes.ok:
+            # the backend ignores the range, it sends the whole image
+            LOG.info("Glance ignores the range requests, download %s in a "
+                     "single stream" % self.image_id)
+            self._done_parts = set()
+            self.transferred = 0
+            self._write_response(response, 0, self.transfer_size,
+                                 self._digest)
+            return True
+        if response.status_code != requests.codes.partial_content:
+            LOG.warn("Unable to download a range of %s: %s" % (
+                self.image_id, response.status_code))
+            response.close()
+            return False
+        # digest of the parts downloaded before a restart
+        self._update_digest()
+
+        pool = greenpool.GreenPool(self._connections)
+        workers = [pool.spawn(self._worker, parts)
+                   for i in range(self._connections - 1)]
+        try:
+            self._write_response(response, first_start,
+                                 first_end - first_start + 1)
+            self._part_done(first_start)
+            self._worker(parts, session)
+            for worker in workers:
+                worker.wait()
+        except Exception:
+            self.stop()
+            pool.waitall()
+            raise
+        return True
+
+    def stop(self):
+        self._running = False
+
+
+def start_ranged_download(context, image_id, file_name, data_size,
+                          connections, part_size, task_state=None,
+                          callback=None, journal=None, digest=None):
+    """Download a glance image in file_name with concurrent connections.
+
+    :returns: False if the image has to be downloaded through the image API
+    """
+    ranged_download = GlanceRangedDownload(context, image_id, file_name,
+                                           data_size, connections, part_size,
+                                           journal, digest)
+    progressReportThread = None
+    if task_state:
+        progressReportThread = ProgressReportThread(ranged_download,
+                                                    callback,
+                                                    data_size,
+                                                    task_state)
+        progressReportThread.start()
+    try:
+        return ranged_download.download()
+    except Exception as exc:
+        LOG.exception(exc)
+        raise exception.NovaException(exc)
+    finally:
+        if progressReportThread:
+            progressReportThread.stop()
+
+
 def download_file_in_new_thread(remote_url, local_filename):
 
     def _download_file(remote_url, local_filename):
@@ -0,0 +1,282 @@
+"""
+streamOptimized VMDK writer deflating the grains on all the cores.
+
+The image is read by batches of grains by a pool of processes which
+deflate the non zero grains, the main process writes the compressed grains
+in order followed by the grain tables, the grain directory and the footer
+(VMware Virtual Disk Format 1.1).
+
+The raw images are read directly, the other formats are read through a
+read-only qemu-nbd export (one connection per process).
+
+It runs in its own process, without eventlet nor nova (the script is run by
+its path, only the python standard library is loaded):
+
+    python .../nova_driver/virt/hybrid/common/vmdk_writer.py [--nbd] SRC DST
+"""
+import argparse
+import array
+import collections
+import multiprocessing
+import os
+import random
+import struct
+import sys
+import zlib
+
+if __package__:
+    from nova_driver.virt.hybrid.common import nbd_client
+else:
+    # run as a script, the nova_driver package (and nova) is not imported
+    import nbd_client
+
+SECTOR_SIZE = 512
+GRAIN_SECTORS = 128
+GRAIN_SIZE = GRAIN_SECTORS * SECTOR_SIZE
+ZERO_GRAIN = '\0' * GRAIN_SIZE
+NUM_GTES_PER_GT = 512
+GT_SECTORS = NUM_GTES_PER_GT * 4 // SECTOR_SIZE
+# grains read and deflated by a process at once
+BATCH_GRAINS = 64
+
+VMDK_MAGIC = 0x564d444b
+VMDK_VERSION = 3
+# valid new line detection, compressed grains, markers
+VMDK_FLAGS = 1 | 1 << 16 | 1 << 17
+COMPRESSION_DEFLATE = 1
+GD_AT_END = 0xffffffffffffffff
+DESCRIPTOR_OFFSET = 1
+DESCRIPTOR_SECTORS = 20
+OVERHEAD_SECTORS = 128
+
+MARKER_EOS = 0
+MARKER_GT = 1
+MARKER_GD = 2
+MARKER_FOOTER = 3
+
+DESCRIPTOR = '''# Disk DescriptorFile
+version=1
+CID=%(cid)08x
+parentCID=ffffffff
+createType="streamOptimized"
+
+# Extent description
+RW %(sectors)d SPARSE "%(file_name)s"
+
+# The Disk Data Base
+#DDB
+
+ddb.virtualHWVersion = "4"
+ddb.geometry.cylinders = "%(cylinders)d"
+ddb.geometry.heads = "255"
+ddb.geometry.sectors = "63"
+ddb.adapterType = "lsilogic"
+'''
+
+
+def _div_round_up(n, d):
+    return (n + d - 1) // d
+
+
+class StreamOptimizedVmdk(object):
+    """Sequential writer of a streamOptimized vmdk."""
+
+    def __init__(self, file_name, size):
+        self._file = open(file_name, 'wb')
+        self._sectors = _div_round_up(size, SECTOR_SIZE)
+        self.num_grains = _div_round_up(self._sectors, GRAIN_SECTORS)
+        self._num_gts = _div_round_up(self.num_grains, NUM_GTES_PER_GT)
+        self._gtes = array.array('I', [0]) * (self._num_gts * NUM_GTES_PER_GT)
+        self._sector = 0
+
+        self._write(self._header(GD_AT_END))
+        descriptor = DESCRIPTOR % {
+            'cid': random.randint(0, 0xfffffffe),
+            'sectors': self._sectors,
+            'file_name': os.path.basename(file_name),
+            'cylinders': min(self._sectors // (255 * 63), 65535),
+        }
+        self._write(descriptor.ljust(DESCRIPTOR_SECTORS * SECTOR_SIZE, '\0'))
+        self._write('\0' * (OVERHEAD_SECTORS - self._sector) * SECTOR_SIZE)
+
+    def _header(self, gd_offset):
+        return struct.pack('<IIIQQQQIQQQB4sH433x',
+                           VMDK_MAGIC,
+                           VMDK_VERSION,
+                           VMDK_FLAGS,
+                           self._sectors,
+                           GRAIN_SECTORS,
+                           DESCRIPTOR_OFFSET,
+                           DESCRIPTOR_SECTORS,
+                           NUM_GTES_PER_GT,
+                           0,
+                           gd_offset,
+                           OVERHEAD_SECTORS,
+                           0,
+                           '\n \r\n',
+                           COMPRESSION_DEFLATE)
+
+    def _write(self, data):
+        # everything is written by whole sectors
+        remainder = len(data) % SECTOR_SIZE
+        if remainder:
+            data += '\0' * (SECTOR_SIZE - remainder)
+        self._file.write(data)
+        self._sector += len(data) // SECTOR_SIZE
+
+    def _write_marker(self, num_sectors, marker_type):
+        self._write(struct.pack('<QII', num_sectors, 0, marker_type))
+
+    @staticmethod
+    def _table(entries):
+        if sys.byteorder != 'little':
+            entries = array.array('I', entries)
+            entries.byteswap()
+        return entries.tostring()
+
+    def write_grain(self, grain, compressed):
+        self._gtes[grain] = self._sector
+        self._write(struct.pack('<QI', grain * GRAIN_SECTORS,
+                                len(compressed)) + compressed)
+
+    def close(self):
+        gd = array.array('I')
+        for gt in range(self._num_gts):
+            self._write_marker(GT_SECTORS, MARKER_GT)
+            gd.append(self._sector)
+            self._write(self._table(
+                self._gtes[gt * NUM_GTES_PER_GT:(gt + 1) * NUM_GTES_PER_GT]))
+        self._write_marker(_div_round_up(len(gd) * 4, SECTOR_SIZE),
+                           MARKER_GD)
+        gd_offset = self._sector
+        self._write(self._table(gd))
+        self._write_marker(1, MARKER_FOOTER)
+        self._write(self._header(gd_offset))
+        self._write_marker(0, MARKER_EOS)
+        self._file.close()
+
+
+class _FileReader(object):
+
+    def __init__(self, file_name):
+        self._file = open(file_name, 'rb')
+        self.size = os.fstat(self._file.fileno()).st_size
+
+    def pread(self, offset, length):
+        self._file.seek(offset)
+        return self._file.read(length)
+
+    def close(self):
+        self._file.close()
+
+
+def _open_reader(source, nbd):
+    if nbd:
+        return nbd_client.NbdFileRead(source)
+    return _FileReader(source)
+
+
+# reader of the pool processes
+_reader = None
+
+
+def _init_worker(source, nbd):
+    global _reader
+    _reader = _open_reader(source, nbd)
+
+
+def _deflate_grains(first_grain, count, level, reader=None):
+    """Return the (grain, compressed grain) of the non zero grains."""
+    data = (reader or _reader).pread(first_grain * GRAIN_SIZE,
+                                     count * GRAIN_SIZE)
+    grains = []
+    for i in range(count):
+        grain = data[i * GRAIN_SIZE:(i + 1) * GRAIN_SIZE]
+        if grain == ZERO_GRAIN[:len(grain)]:
+            continue
+        if len(grain) < GRAIN_SIZE:
+            grain = grain.ljust(GRAIN_SIZE, '\0')
+        grains.append((first_grain + i, zlib.compress(grain, level)))
+    return grains
+
+
+def _report_progress(done, total):
+    # same output as qemu-img -p
+    sys.stdout.write('    (%.2f/100%%)\r' % (done * 100.0 / max(total, 1)))
+    sys.stdout.flush()
+
+
+def convert(source, dst_file, nbd=False, processes=None,
+            level=zlib.Z_DEFAULT_COMPRESSION, progress=False):
+    """Convert the raw file (or the NBD export) source to a streamOptimized
+    vmdk.
+    """
+    processes = processes or multiprocessing.cpu_count()
+    reader = _open_reader(source, nbd)
+    try:
+        vmdk = StreamOptimizedVmdk(dst_file, reader.size)
+        batches = [(first_grain,
+                    min(BATCH_GRAINS, vmdk.num_grains - first_grain),
+                    level)
+                   for first_grain in range(0, vmdk.num_grains,
+                                            BATCH_GRAINS)]
+        if processes == 1:
+            for i, batch in enumerate(batches, 1):
+                for grain, compressed in _deflate_grains(*batch,
+                                                         reader=reader):
+                    vmdk.write_grain(grain, compressed)
+                if progress:
+                    _report_progress(i, len(batches))
+        else:
+            pool = multiprocessing.Pool(processes, _init_worker,
+                                        (source, nbd))
+            try:
+                # a bounded window of batches, written in order
+                pending = collections.deque()
+                written = 0
+                for batch in batches:
+                    pending.append(pool.apply_async(_deflate_grains, batch))
+                    while (len(pending) > 2 * processes or
+                           (pending and pending[0].ready())):
+                        for grain, compressed in pending.popleft().get():
+                            vmdk.write_grain(grain, compressed)
+                        written += 1
+                        if progress:
+                            _report_progress(written, len(batches))
+                while pending:
+                    for grain, compressed in pending.popleft().get():
+                        vmdk.write_grain(grain, compressed)
+                    written += 1
+                    if progress:
+                        _report_progress(written, len(batches))
+            finally:
+                pool.terminate()
+                pool.join()
+        vmdk.close()
+    finally:
+        reader.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Convert an image to a streamOptimized vmdk')
+    parser.add_argument('source',
+                        help='raw image file, or NBD unix socket with --nbd')
+    parser.add_argument('dst_file', help='vmdk file')
+    parser.add_argument('--nbd', action='store_true',
+                        help='read the image from a qemu-nbd export')
+    parser.add_argument('--processes', type=int, default=0,
+                        help='number of deflating processes, default to the '
+                        'number of cpus')
+    parser.add_argument('--level', type=int,
+                        default=zlib.Z_DEFAULT_COMPRESSION,
+                        help='zlib compression level')
+    parser.add_argument('--progress', action='store_true',
+                        help='print the progress of the conversion')
+    args = parser.parse_args()
+    convert(args.source, args.dst_file, args.nbd, args.processes, args.level,
+            args.progress)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
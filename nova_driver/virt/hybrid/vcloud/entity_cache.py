@@ -0,0 +1,186 @@
+"""
+Short lived cache of the vCD entities (VDC and vApps, with their VMs).
+
+An operation on a vApp reads it several times (status, first VM, task, every
+poll), the entities are reused for a few seconds instead of being fetched
+again with the VDC. Once expired, an entity is revalidated with a conditional
+GET when vCD gave it an ETag. The entities changed by a task are invalidated
+when the task is issued and when it completes.
+
+The parsed entities are cached, not the pyvcloud objects bound to the
+headers of a session: a session created again is used right away.
+
+A vApp whose href is answered with a 403 or a 404 does not exist anymore,
+the other failed GETs raise.
+"""
+import threading
+import time
+
+import requests
+
+from nova import exception
+
+from oslo_log import log as logging
+
+from pyvcloud import Http
+from pyvcloud.schema.vcd.v1_5.schemas.vcloud import vAppType
+from pyvcloud.schema.vcd.v1_5.schemas.vcloud import vdcType
+from pyvcloud.vapp import VAPP
+
+LOG = logging.getLogger(__name__)
+
+VAPP_TYPE = 'application/vnd.vmware.vcloud.vApp+xml'
+# vCD answers 403 for the entities deleted or not visible anymore
+GONE_STATUS_CODES = (requests.codes.forbidden, requests.codes.not_found)
+
+
+class _Entry(object):
+
+    def __init__(self, href, entity, etag):
+        self.href = href
+        self.entity = entity
+        self.etag = etag
+        self.fetched_at = time.time()
+
+
+class VCloudEntityCache(object):
+
+    def __init__(self, session, ttl, verify):
+        """
+        :param session: the VCloudAPISession
+        :param ttl: seconds an entity is used without revalidation, 0 to
+                    fetch the entities on every read
+        """
+        self._session = session
+        self._ttl = ttl
+        self._verify = verify
+        self._lock = threading.Lock()
+        # ('vdc'|'vapp', name) -> _Entry
+        self._entries = {}
+        # vApp name -> href, the href of a vApp does not change
+        self._vapp_hrefs = {}
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+
+    def _headers(self):
+        return self._session.vca.vcloud_session.get_vcloud_headers()
+
+    def _fresh(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and time.time() - entry.fetched_at < self._ttl:
+                self.hits += 1
+                return entry
+        return None
+
+    def _fetch(self, key, href, parse):
+        """GET the entity at href, conditional if its ETag is known.
+
+        :returns: the entity or None if it does not exist anymore
+        :raises: NovaException if the GET failed
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+        headers = self._headers()
+        if entry and entry.href == href and entry.etag:
+            headers = dict(headers)
+            headers['If-None-Match'] = entry.etag
+        response = Http.get(href, headers=headers, verify=self._verify)
+        if response.status_code == requests.codes.not_modified:
+            with self._lock:
+                self.revalidations += 1
+                entry.fetched_at = time.time()
+            return entry.entity
+        with self._lock:
+            self.misses += 1
+        if response.status_code != requests.codes.ok:
+            self.invalidate(key)
+            if response.status_code in GONE_STATUS_CODES:
+                LOG.debug('GET %s: %s' % (href, response.status_code))
+                return None
+            raise exception.NovaException(
+                "Unable to get %s: %s" % (href, response.status_code))
+        entity = parse(response.content, True)
+        with self._lock:
+            self._entries[key] = _Entry(href, entity,
+                                        response.headers.get('ETag'))
+        return entity
+
+    def get_vdc(self, vdc_name):
+        key = ('vdc', vdc_name)
+        entry = self._fresh(key)
+        if entry:
+            return entry.entity
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry:
+            return self._fetch(key, entry.href, vdcType.parseString)
+        # the href of the vdc is in the organization of the session
+        vdc = self._session.invoke_api(self._session.vca, 'get_vdc',
+                                       vdc_name)
+        with self._lock:
+            self.misses += 1
+            if vdc is not None:
+                self._entries[key] = _Entry(vdc.get_href(), vdc, None)
+        return vdc
+
+    def _find_vapp_href(self, vdc_name, vapp_name, refresh=False):
+        if refresh:
+            self.invalidate(('vdc', vdc_name))
+        vdc = self.get_vdc(vdc_name)
+        if not vdc or not vdc.ResourceEntities:
+            return None
+        for entity in vdc.ResourceEntities.ResourceEntity:
+            if entity.name == vapp_name and entity.type_ == VAPP_TYPE:
+                return entity.href
+        return None
+
+    def get_vapp(self, vdc_name, vapp_name):
+        """Return the pyvcloud VAPP of the vApp or None."""
+        key = ('vapp', vapp_name)
+        entry = self._fresh(key)
+        if entry:
+            vapp = entry.entity
+        else:
+            vapp = None
+            with self._lock:
+                href = self._vapp_hrefs.get(vapp_name)
+            if href:
+                vapp = self._fetch(key, href, vAppType.parseString)
+            if vapp is None:
+                # new vApp, not yet in the cached vdc
+                href = (self._find_vapp_href(vdc_name, vapp_name) or
+                        self._find_vapp_href(vdc_name, vapp_name,
+                                             refresh=True))
+                if href:
+                    with self._lock:
+                        self._vapp_hrefs[vapp_name] = href
+                    vapp = self._fetch(key, href, vAppType.parseString)
+            if vapp is None:
+                with self._lock:
+                    self._vapp_hrefs.pop(vapp_name, None)
+                return None
+        return VAPP(vapp, self._headers(), self._verify)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def invalidate_vapp(self, vapp_name, vdc_name=None):
+        """Forget the vApp (and the vdc listing it if created or deleted).
+        """
+        with self._lock:
+            self._entries.pop(('vapp', vapp_name), None)
+            if vdc_name:
+                self._vapp_hrefs.pop(vapp_name, None)
+                self._entries.pop(('vdc', vdc_name), None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'revalidations': self.revalidations,
+                'misses': self.misses,
+                'entries': len(self._entries),
+            }
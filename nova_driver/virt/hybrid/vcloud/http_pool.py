@@ -0,0 +1,116 @@
+"""
+Pool of keep-alive HTTP connections to the vCD hosts.
+
+The requests to a vCD host (the ones of pyvcloud and the raw ones of the
+client, both made by pyvcloud.Http) share the connections of a
+requests.Session of the host instead of opening a TLS connection for each of
+them.
+
+A request rejected with a 401 is sent again once with the token of the
+session re-created, the vCloud sessions using the host are registered to the
+pool for it.
+"""
+import threading
+import urlparse
+
+import requests
+
+from requests import adapters
+
+from oslo_log import log as logging
+
+import pyvcloud
+
+LOG = logging.getLogger(__name__)
+
+AUTH_HEADER = 'x-vcloud-authorization'
+
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+_REQUESTS = {
+    'get': requests.get,
+    'post': requests.post,
+    'put': requests.put,
+    'delete': requests.delete,
+}
+
+
+def _netloc(url):
+    return urlparse.urlparse(url).netloc
+
+
+def get_pool(host, pool_size, keep_alive):
+    """Return the pool of the vCD host (url), created on first use."""
+    with _POOLS_LOCK:
+        if not _POOLS:
+            _install()
+        netloc = _netloc(host)
+        if netloc not in _POOLS:
+            _POOLS[netloc] = HttpPool(pool_size, keep_alive)
+        return _POOLS[netloc]
+
+
+def _request(method, url, data=None, logger=None, **kwargs):
+    if logger is not None:
+        pyvcloud.Http._log_request(logger, data=data,
+                                   headers=kwargs.get('headers'))
+    pool = _POOLS.get(_netloc(url))
+    if pool:
+        response = pool.request(method, url, data=data, **kwargs)
+    else:
+        response = _REQUESTS[method](url, data=data, **kwargs)
+    pyvcloud.Http._log_response(logger, response)
+    return response
+
+
+def _install():
+    """Route the requests of pyvcloud.Http to the pools of their host."""
+    def method(name):
+        def send(url, data=None, logger=None, **kwargs):
+            return _request(name, url, data=data, logger=logger, **kwargs)
+        return staticmethod(send)
+
+    for name in _REQUESTS:
+        setattr(pyvcloud.Http, name, method(name))
+
+
+class HttpPool(object):
+
+    def __init__(self, pool_size, keep_alive):
+        self._http = requests.Session()
+        adapter = adapters.HTTPAdapter(pool_connections=1,
+                                       pool_maxsize=pool_size)
+        self._http.mount('https://', adapter)
+        self._http.mount('http://', adapter)
+        if not keep_alive:
+            self._http.headers['Connection'] = 'close'
+        self._sessions = []
+
+    def add_session(self, session):
+        """Register a VCloudAPISession whose token may be renewed on a 401.
+        """
+        self._sessions.append(session)
+
+    def _renew_token(self, token):
+        for session in self._sessions:
+            if token in (session.session_id, session.previous_session_id):
+                return session.renew_session(token)
+        return None
+
+    def request(self, method, url, **kwargs):
+        response = self._http.request(method, url, **kwargs)
+        if response.status_code != requests.codes.unauthorized:
+            return response
+        headers = kwargs.get('headers') or {}
+        token = headers.get(AUTH_HEADER)
+        if not token:
+            return response
+        new_token = self._renew_token(token)
+        if not new_token or new_token == token:
+            return response
+        LOG.debug('%s %s sent again with the renewed token' % (
+            method.upper(), url))
+        headers = dict(headers)
+        headers[AUTH_HEADER] = new_token
+        kwargs['headers'] = headers
+        return self._http.request(method, url, **kwargs)
@@ -0,0 +1,218 @@
+"""
+Poller of the vCD tasks and of the status of the vCD entities.
+
+One greenthread polls the tasks and the statuses waited for by all the
+concurrent operations. The polls of a wait start below one second and back
+off exponentially, a short task is seen completed within a second and a long
+one is not polled every second. The status of the vApps due at the same time
+is read by a single request to the query service.
+
+The waits return an eventlet Event: its result is True when the task
+succeeded or the status was reached, False if the task failed or the wait
+timed out. An error status raises from wait().
+"""
+import time
+
+import requests
+
+from eventlet import event
+from eventlet import greenthread
+from eventlet import queue
+
+from nova import exception
+
+from oslo_log import log as logging
+
+from pyvcloud import Http
+from pyvcloud.schema.vcd.v1_5.schemas.vcloud import taskType
+
+LOG = logging.getLogger(__name__)
+
+BACKOFF_FACTOR = 1.5
+# a wait fails after this number of consecutive errors of its polls
+MAX_POLL_ERRORS = 10
+
+TASK_FAILED = ('error', 'aborted', 'canceled')
+
+
+class _Watch(object):
+
+    def __init__(self, description, interval, timeout):
+        self.description = description
+        self.interval = interval
+        self.next_poll = time.time() + interval
+        self.deadline = time.time() + timeout if timeout else None
+        self.errors = 0
+        self.done = event.Event()
+
+    def backoff(self, max_interval):
+        self.interval = min(self.interval * BACKOFF_FACTOR, max_interval)
+        self.next_poll = time.time() + self.interval
+
+
+class _TaskWatch(_Watch):
+
+    def __init__(self, task, interval):
+        super(_TaskWatch, self).__init__('task %s' % task.get_href(),
+                                         interval, None)
+        self.href = task.get_href()
+
+
+class _StatusWatch(_Watch):
+
+    def __init__(self, description, get_status, expected_status,
+                 failed_status, interval, timeout):
+        super(_StatusWatch, self).__init__(description, interval, timeout)
+        self.get_status = get_status
+        self.expected_status = expected_status
+        self.failed_status = failed_status
+
+
+class _VAppStatusWatch(_StatusWatch):
+
+    def __init__(self, vapp_name, expected_status, failed_status, interval,
+                 timeout):
+        super(_VAppStatusWatch, self).__init__('vapp %s' % vapp_name, None,
+                                               expected_status,
+                                               failed_status, interval,
+                                               timeout)
+        self.vapp_name = vapp_name
+
+
+class TaskPoller(object):
+
+    def __init__(self, session, verify, query_vapp_statuses,
+                 initial_interval, max_interval):
+        """
+        :param session: the VCloudAPISession
+        :param query_vapp_statuses: function(vapp_names) returning the status
+                                    of the vApps by name
+        """
+        self._session = session
+        self._verify = verify
+        self._query_vapp_statuses = query_vapp_statuses
+        self._initial_interval = initial_interval
+        self._max_interval = max(initial_interval, max_interval)
+        self._watches = []
+        # the new watches, wakes up the poller
+        self._new_watches = queue.Queue()
+        self._started = False
+
+    def _add(self, watch):
+        if not self._started:
+            self._started = True
+            greenthread.spawn(self._run)
+        self._new_watches.put(watch)
+        return watch.done
+
+    def watch_task(self, task):
+        """Wait for the completion of a task."""
+        return self._add(_TaskWatch(task, self._initial_interval))
+
+    def watch_status(self, description, get_status, expected_status,
+                     failed_status=None, timeout=None):
+        """Wait for get_status() to return the expected status."""
+        return self._add(_StatusWatch(description, get_status,
+                                      expected_status, failed_status,
+                                      self._initial_interval, timeout))
+
+    def watch_vapp_status(self, vapp_name, expected_status,
+                          failed_status=None, timeout=None):
+        """Wait for the vApp to reach the expected status, the status of the
+        vApps waited for are read together.
+        """
+        return self._add(_VAppStatusWatch(vapp_name, expected_status,
+                                          failed_status,
+                                          self._initial_interval, timeout))
+
+    def _poll_task(self, watch):
+        response = Http.get(
+            watch.href,
+            headers=self._session.vca.vcloud_session.get_vcloud_headers(),
+            verify=self._verify)
+        if response.status_code != requests.codes.ok:
+            raise exception.NovaException(
+                'unable to get the %s: %s' % (watch.description,
+                                              response.status_code))
+        task = taskType.parseString(response.content, True)
+        status = task.get_status()
+        if status == 'success':
+            watch.done.send(True)
+        elif status in TASK_FAILED:
+            error = task.get_Error()
+            LOG.error('%s %s: %s' % (watch.description, status,
+                                     error.get_message() if error else ''))
+            watch.done.send(False)
+
+    def _check_status(self, watch, status):
+        if status == watch.expected_status:
+            watch.done.send(True)
+        elif (watch.failed_status is not None and
+                status == watch.failed_status):
+            watch.done.send_exception(exception.NovaException(
+                '%s on status Error' % watch.description))
+        else:
+            LOG.debug('%s status: %s, expected: %s' % (
+                watch.description, status, watch.expected_status))
+
+    def _poll_vapp_statuses(self, watches):
+        statuses = self._query_vapp_statuses(
+            set(watch.vapp_name for watch in watches))
+        for watch in watches:
+            watch.errors = 0
+            self._check_status(watch, statuses.get(watch.vapp_name))
+
+    def _failed(self, watches, e):
+        for watch in watches:
+            watch.errors += 1
+            LOG.warn('unable to poll the %s: %s' % (watch.description, e))
+            if watch.errors >= MAX_POLL_ERRORS:
+                watch.done.send_exception(e)
+
+    def _poll(self, now):
+        due = [watch for watch in self._watches if watch.next_poll <= now]
+        vapp_watches = [watch for watch in due
+                        if isinstance(watch, _VAppStatusWatch)]
+        if vapp_watches:
+            try:
+                self._poll_vapp_statuses(vapp_watches)
+            except Exception as e:
+                self._failed(vapp_watches, e)
+        for watch in due:
+            if isinstance(watch, _VAppStatusWatch):
+                continue
+            try:
+                if isinstance(watch, _TaskWatch):
+                    self._poll_task(watch)
+                else:
+                    self._check_status(watch, watch.get_status())
+                watch.errors = 0
+            except Exception as e:
+                self._failed([watch], e)
+        for watch in due:
+            if watch.done.ready():
+                continue
+            if watch.deadline and watch.deadline <= now:
+                LOG.warn('%s: timeout' % watch.description)
+                watch.done.send(False)
+            else:
+                watch.backoff(self._max_interval)
+        self._watches = [watch for watch in self._watches
+                         if not watch.done.ready()]
+
+    def _run(self):
+        while True:
+            if self._watches:
+                delay = max(0, min(watch.next_poll
+                                   for watch in self._watches) - time.time())
+            else:
+                delay = None
+            try:
+                self._watches.append(self._new_watches.get(timeout=delay))
+                continue
+            except queue.Empty:
+                pass
+            try:
+                self._poll(time.time())
+            except Exception as e:
+                LOG.exception(e)
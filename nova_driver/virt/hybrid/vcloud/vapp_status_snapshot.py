@@ -0,0 +1,132 @@
+"""
+Snapshot of the status of all the vApps of the vdc.
+
+The status of the vApps is read periodically by a paged request to the query
+service (one request per page of vApps) instead of reading the vdc and the
+vApp for each instance: the cost of the sync of the power states does not
+grow with the number of instances.
+"""
+import time
+import urllib
+
+import requests
+
+from eventlet import greenthread
+from lxml import etree
+
+from oslo_log import log as logging
+
+from pyvcloud import Http
+
+LOG = logging.getLogger(__name__)
+
+QUERY_TYPE = 'vApp'
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def _query_page(session, query_filter, page, page_size, verify):
+    params = [
+        ('type', QUERY_TYPE),
+        ('format', 'records'),
+        ('page', page),
+        ('pageSize', page_size),
+        ('fields', 'name,status'),
+        ('filter', urllib.quote(query_filter, safe='=;,()')),
+    ]
+    response = Http.get(
+        '%s/api/query?%s' % (session.vca.host,
+                             '&'.join('%s=%s' % param for param in params)),
+        headers=session.vca.vcloud_session.get_vcloud_headers(),
+        verify=verify)
+    if response.status_code != requests.codes.ok:
+        raise Exception('query of the vApps failed: %s' %
+                        response.status_code)
+    return etree.fromstring(response.content)
+
+
+def query_vapp_statuses(session, vdc_name, page_size, verify,
+                        vapp_names=None):
+    """Return the status name of the vApps of the vdc (or of the vApps named)
+    by vApp name.
+    """
+    query_filter = 'vdcName==%s' % vdc_name
+    if vapp_names:
+        query_filter += ';(%s)' % ','.join('name==%s' % vapp_name
+                                          for vapp_name in vapp_names)
+    statuses = {}
+    page = 1
+    while True:
+        records = _query_page(session, query_filter, page, page_size, verify)
+        for record in records:
+            if _local_name(record.tag) == 'VAppRecord':
+                statuses[record.get('name')] = record.get('status')
+        if page * page_size >= int(records.get('total', 0)):
+            return statuses
+        page += 1
+
+
+class VAppStatusSnapshot(object):
+
+    def __init__(self, session, vdc_name, interval, page_size, verify):
+        """
+        :param session: the VCloudAPISession
+        :param interval: seconds between two refreshes of the snapshot
+        """
+        self._session = session
+        self._vdc_name = vdc_name
+        self._interval = interval
+        self._page_size = page_size
+        self._verify = verify
+        # vApp name -> status name (POWERED_ON, POWERED_OFF...)
+        self._statuses = {}
+        self._refreshed_at = 0
+        # vApp name -> time its status was changed by a task
+        self._changed_at = {}
+        self._started = False
+
+    def start(self):
+        if self._started:
+            return
+        self._started = True
+        greenthread.spawn(self._run)
+
+    def get_status(self, vapp_name):
+        """Return the status name of the vApp, None if the snapshot is not
+        up to date or does not know the vApp.
+        """
+        if time.time() - self._refreshed_at > 2 * self._interval:
+            return None
+        return self._statuses.get(vapp_name)
+
+    def invalidate(self, vapp_name):
+        """Forget the status of a vApp changed by a task, until the next
+        refresh started after the change.
+        """
+        self._changed_at[vapp_name] = time.time()
+        self._statuses.pop(vapp_name, None)
+
+    def refresh(self):
+        started_at = time.time()
+        statuses = query_vapp_statuses(self._session, self._vdc_name,
+                                       self._page_size, self._verify)
+        for vapp_name, changed_at in self._changed_at.items():
+            if changed_at >= started_at:
+                # changed during the query, the status read may be the old one
+                statuses.pop(vapp_name, None)
+            else:
+                del self._changed_at[vapp_name]
+        self._statuses = statuses
+        self._refreshed_at = started_at
+        LOG.debug('status of %d vApps read in %.1f s' % (
+            len(statuses), time.time() - started_at))
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                LOG.warn('unable to refresh the status of the vApps: %s' % e)
+            greenthread.sleep(self._interval)
@@ -12,12 +12,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import itertools
+import json
+import os
+import time
+
 from nova import exception
 from nova.i18n import _LW
-from oslo_concurrency import lockutils
+from nova_driver.virt.hybrid.vcloud import http_pool
 from oslo_log import log as logging
 from oslo_service import loopingcall
+from pyvcloud import Http
 from pyvcloud.vcloudair import VCA
+from threading import local
 from threading import Lock
 
 LOG = logging.getLogger(__name__)
@@ -32,7 +39,8 @@ class VCloudAPISession(object):
     def __init__(self, host_ip, host_port, server_username, server_password,
                  org, vdc, version, verify, service_type,
                  retry_count, create_session=True, scheme="https",
-                 task_poll_interval=1):
+                 task_poll_interval=1, http_pool_size=10,
+                 http_keep_alive=True, token_file=None):
         self._host_ip = host_ip
         self._server_username = server_username
         self._server_password = server_password
@@ -46,47 +54,160 @@ class VCloudAPISession(object):
         self._host_port = host_port
         self._session_username = None
         self._session_id = None
+        # token replaced by the last login, the calls still made with it are
+        # sent again with the current one
+        self._previous_session_id = None
+        self._logged_in_at = None
         self._vca = None
+        # the token is reused by the next start if still valid
+        self._token_file = token_file
         self._task_poll_interval = task_poll_interval
         self._auto_lock = Lock()
+        self._renew_lock = Lock()
+        self._local = local()
+        # the requests of the session go through the pool of the host
+        http_pool.get_pool(self.vca.host,
+                           http_pool_size,
+                           http_keep_alive).add_session(self)
         if create_session:
             self._create_session()
 
-    @lockutils.synchronized('hypernode-plug-unplug')
     def _create_session(self):
         """Establish session with the server."""
 
-        if self._session_id and self.is_current_session_active():
-            LOG.debug("Current session: %s is active.",
-                      self._session_id)
+        with self._auto_lock:
+            if self._session_id and self.is_current_session_active():
+                LOG.debug("Current session: %s is active.",
+                          self._session_id)
+                return
+            self._login(use_cached_token=True)
+
+    def refresh_session(self):
+        """Log in again before the token expires.
+
+        The current session serves the calls until the new one replaces it.
+        """
+        with self._auto_lock:
+            self._login(use_cached_token=False)
+
+    def _new_vca(self):
+        return VCA(host=self._host_ip, username=self._server_username,
+                   service_type=self._service_type,
+                   version=self._version,
+                   verify=self._verify)
+
+    def _load_token(self):
+        if not self._token_file:
+            return None
+        try:
+            with open(self._token_file, 'r') as f:
+                cached = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if (cached.get('username') != self._server_username or
+                cached.get('org') != self._org):
+            return None
+        return cached
+
+    def _save_token(self, vca):
+        if not self._token_file:
             return
+        try:
+            fd = os.open(self._token_file,
+                         os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            os.fchmod(fd, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'username': self._server_username,
+                           'org': self._org,
+                           'token': vca.token,
+                           'org_url': vca.vcloud_session.org_url}, f)
+        except (IOError, OSError) as e:
+            LOG.warn("Unable to cache the session token: %s", e)
 
-        # Login and create new session with the server for making API calls.
-        LOG.debug("Logging in with username = %s.", self._server_username)
-        result = self.vca.login(password=self._server_password, org=self._org)
-        if not result:
-            raise exception.NovaException(
-                "Logging error with username:%s " % self._server_username)
-        result = self.vca.login(
-            token=self.vca.token,
-            org=self._org,
-            org_url=self.vca.vcloud_session.org_url)
-        if not result:
-            raise exception.NovaException(
-                "Logging error with username:%s with token " %
-                self._server_username)
-
-        self._session_id = self.vca.token
+    def _login(self, use_cached_token):
+        vca = self._new_vca()
+        cached = self._load_token() if use_cached_token else None
+        if cached and vca.login(token=cached['token'],
+                                org=self._org,
+                                org_url=cached['org_url']):
+            # the token login does not set the token of the VCA
+            vca.token = cached['token']
+            LOG.debug("Reusing the cached session token.")
+        else:
+            # Login and create new session with the server for making API
+            # calls.
+            LOG.debug("Logging in with username = %s.",
+                      self._server_username)
+            result = vca.login(password=self._server_password, org=self._org)
+            if not result:
+                raise exception.NovaException(
+                    "Logging error with username:%s " % self._server_username)
+            result = vca.login(
+                token=vca.token,
+                org=self._org,
+                org_url=vca.vcloud_session.org_url)
+            if not result:
+                raise exception.NovaException(
+                    "Logging error with username:%s with token " %
+                    self._server_username)
+            self._save_token(vca)
+
+        replaced_vca, replaced_id = self._vca, self._session_id
+        self._vca = vca
+        self._session_id = vca.token
+        self._logged_in_at = time.time()
+        if replaced_id and replaced_id != self._session_id:
+            self._previous_session_id = replaced_id
+            self._logout(replaced_vca)
 
         # We need to save the username in the session since we may need it
         # later to check active session. The SessionIsActive method requires
         # the username parameter to be exactly same as that in the session
         # object. We can't use the username used for login since the Login
         # method ignores the case.
-        self._session_username = self.vca.username
+        self._session_username = vca.username
         LOG.info("Successfully established new session; session ID is %s.",
                  self._session_id)
 
+    def _logout(self, vca):
+        """Delete the vCD session of a replaced VCA, pyvcloud only forgets
+        it and the session would stay open until its timeout.
+        """
+        # a rejected token must not be replaced by the current one
+        renewing = getattr(self._local, 'renewing', False)
+        self._local.renewing = True
+        try:
+            response = Http.delete(
+                vca.host + '/api/session',
+                headers=vca.vcloud_session.get_vcloud_headers(),
+                verify=self._verify)
+            LOG.debug("Logged out the session %s: %s.", vca.token,
+                      response.status_code)
+        except Exception as e:
+            LOG.warn("Unable to log out the session %s: %s", vca.token, e)
+        finally:
+            self._local.renewing = renewing
+
+    def renew_session(self, expired_token):
+        """Re-create the session if its token is the expired one.
+
+        :returns: the token of the session
+        """
+        if getattr(self._local, 'renewing', False):
+            # a request of the login itself
+            return None
+        with self._renew_lock:
+            if expired_token == self._session_id:
+                LOG.info("Session %s expired, re-creating it.",
+                         expired_token)
+                self._local.renewing = True
+                try:
+                    # the cached token is the expired one
+                    self.refresh_session()
+                finally:
+                    self._local.renewing = False
+        return self._session_id
+
     def is_current_session_active(self):
         """Check if current session is active.
 
@@ -146,12 +267,21 @@ class VCloudAPISession(object):
     @property
     def vca(self):
         if not self._vca:
-            self._vca = VCA(host=self._host_ip, username=self._server_username,
-                            service_type=self._service_type,
-                            version=self._version,
-                            verify=self._verify)
+            self._vca = self._new_vca()
         return self._vca
 
+    @property
+    def session_id(self):
+        return self._session_id
+
+    @property
+    def previous_session_id(self):
+        return self._previous_session_id
+
+    @property
+    def logged_in_at(self):
+        return self._logged_in_at
+
     @property
     def vdc(self):
         return self._vdc
@@ -175,3 +305,90 @@ class VCloudAPISession(object):
     @property
     def org(self):
         return self._org
+
+
+class VCloudSessionPool(object):
+
+    """Pool of vcloud sessions, the calls are spread over them.
+
+    The sessions log in again in the background before their token expires
+    and a session re-created after an error does not block the calls made
+    through the other sessions.
+    """
+
+    def __init__(self, size, refresh_interval, token_dir=None, **kwargs):
+        """
+        :param size: number of sessions
+        :param refresh_interval: seconds after which a session logs in again
+        :param token_dir: directory of the cached tokens, None to not cache
+                          them
+        :param kwargs: the arguments of the VCloudAPISession
+        """
+        self._sessions = []
+        for index in range(max(1, size)):
+            token_file = None
+            if token_dir:
+                token_file = os.path.join(token_dir,
+                                          'vcloud-session-%d.token' % index)
+            self._sessions.append(
+                VCloudAPISession(token_file=token_file, **kwargs))
+        self._next_session = itertools.cycle(self._sessions)
+        self._refresh_interval = refresh_interval
+        if refresh_interval > 0:
+            loopingcall.FixedIntervalLoopingCall(
+                self._refresh_sessions).start(
+                    interval=min(60, refresh_interval),
+                    initial_delay=min(60, refresh_interval))
+
+    def _refresh_sessions(self):
+        # one session at a time, the others serve the calls
+        for session in self._sessions:
+            logged_in_at = session.logged_in_at
+            if (logged_in_at and
+                    time.time() - logged_in_at >= self._refresh_interval):
+                try:
+                    session.refresh_session()
+                except Exception as e:
+                    LOG.warn("Unable to refresh the session %s: %s",
+                             session.session_id, e)
+
+    def session(self):
+        """Return the next session of the pool."""
+        return next(self._next_session)
+
+    def invoke_api(self, module, method, *args, **kwargs):
+        """Invoke the API through the session of the module (VCA) or through
+        the next session.
+        """
+        for session in self._sessions:
+            if module is session.vca:
+                return session.invoke_api(module, method, *args, **kwargs)
+        return self.session().invoke_api(module, method, *args, **kwargs)
+
+    @property
+    def vca(self):
+        return self.session().vca
+
+    @property
+    def vdc(self):
+        return self._sessions[0].vdc
+
+    @property
+    def username(self):
+        return self._sessions[0].username
+
+    @property
+    def password(self):
+        return self._sessions[0].password
+
+    @property
+    def host_ip(self):
+        return self._sessions[0].host_ip
+
+    @property
+    def host_port(self):
+        return self._sessions[0].host_port
+
+    @property
+    def org(self):
+        return self._sessions[0].org
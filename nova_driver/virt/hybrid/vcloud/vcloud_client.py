@@ -1,23 +1,51 @@
+import copy
+import os
 import re
 import requests
 import subprocess
-import time
 
 from lxml import etree
 from nova import exception
 from nova.compute import power_state
 from nova_driver.virt.hybrid.common import provider_client
+from nova_driver.virt.hybrid.vcloud import entity_cache
+from nova_driver.virt.hybrid.vcloud import task_poller
+from nova_driver.virt.hybrid.vcloud import vapp_status_snapshot
 from nova_driver.virt.hybrid.vcloud import vcloud
 from oslo_config import cfg
 from oslo_log import log as logging
 from pyvcloud import Http
 from StringIO import StringIO
+from xml.sax import saxutils
 from pyvcloud.schema.vcd.v1_5.schemas.vcloud import vcloudType,vAppType,\
     taskType
 
 LOG = logging.getLogger(__name__)
 CONF = cfg.CONF
 TAG_PATTERN = re.compile(r'({.*})?(.*)')
+# seconds to wait for a vapp or a media to reach a status
+STATUS_WAIT_TIMEOUT = 1000
+# the vm is customized (name, network connections, cpu and memory) by the
+# instantiation from this version, the instantiation is sent with the first
+# version from it supported by the server
+CUSTOMIZATION_API_VERSION = (5, 6)
+VCLOUD_NS = 'http://www.vmware.com/vcloud/v1.5'
+VERSIONS_NS = 'http://www.vmware.com/vcloud/versions'
+OVF_NS = 'http://schemas.dmtf.org/ovf/envelope/1'
+RASD_NS = ('http://schemas.dmtf.org/wbem/wscim/1/cim-schema/2/'
+           'CIM_ResourceAllocationSettingData')
+# rasd:ResourceType of the items of a VirtualHardwareSection
+RESOURCE_TYPE_CPU = '3'
+RESOURCE_TYPE_MEMORY = '4'
+VAPP_TEMPLATE_TYPE = 'application/vnd.vmware.vcloud.vAppTemplate+xml'
+INSTANTIATE_PARAMS_TYPE = (
+    'application/vnd.vmware.vcloud.instantiateVAppTemplateParams+xml')
+PRODUCT_SECTIONS_TYPE = 'application/vnd.vmware.vcloud.productSections+xml'
+
+
+def _parse_api_version(version):
+    """Return the API version '5.6' as (5, 6)."""
+    return tuple(int(v) for v in version.strip().split('.'))
 
 
 class VCLOUD_STATUS:
@@ -77,7 +105,15 @@ class VCloudClient(provider_client.ProviderClient):
 
     def __init__(self, scheme):
         self._catalog_name = CONF.vcloud.catalog_name
-        self._session = vcloud.VCloudAPISession(
+        token_dir = None
+        if CONF.vcloud.session_token_cache:
+            token_dir = os.path.abspath(CONF.vcloud.session_token_dir)
+            if not os.path.exists(token_dir):
+                os.makedirs(token_dir, 0o700)
+        self._session = vcloud.VCloudSessionPool(
+            CONF.vcloud.session_pool_size,
+            CONF.vcloud.session_refresh_interval,
+            token_dir=token_dir,
             host_ip=CONF.vcloud.host_ip,
             host_port=CONF.vcloud.host_port,
             server_username=CONF.vcloud.host_username,
@@ -89,7 +125,29 @@ class VCloudClient(provider_client.ProviderClient):
             service_type=CONF.vcloud.service_type,
             retry_count=CONF.hybrid_driver.api_retry_count,
             create_session=True,
-            scheme=scheme)
+            scheme=scheme,
+            http_pool_size=CONF.vcloud.http_pool_size,
+            http_keep_alive=CONF.vcloud.http_keep_alive)
+        self._entity_cache = entity_cache.VCloudEntityCache(
+            self._session,
+            CONF.vcloud.entity_cache_ttl,
+            CONF.vcloud.verify)
+        self._status_snapshot = None
+        if CONF.vcloud.vapp_status_refresh_interval > 0:
+            self._status_snapshot = vapp_status_snapshot.VAppStatusSnapshot(
+                self._session,
+                CONF.vcloud.vdc,
+                CONF.vcloud.vapp_status_refresh_interval,
+                CONF.vcloud.query_page_size,
+                CONF.vcloud.verify)
+        self._task_poller = task_poller.TaskPoller(
+            self._session,
+            CONF.vcloud.verify,
+            self._query_vapp_statuses,
+            CONF.vcloud.task_poll_initial_interval,
+            CONF.vcloud.task_poll_max_interval)
+        # API versions supported by the server, read on first use
+        self._server_api_versions = None
 
     @property
     def org(self):
@@ -112,13 +170,10 @@ class VCloudClient(provider_client.ProviderClient):
         return self._session.host_ip
 
     def _get_vcloud_vdc(self):
-        return self._invoke_api("get_vdc",
-                                self._session.vdc)
+        return self._entity_cache.get_vdc(self._session.vdc)
 
     def _get_vcloud_vapp(self, vapp_name):
-        the_vapp = self._invoke_api("get_vapp",
-                                    self._get_vcloud_vdc(),
-                                    vapp_name)
+        the_vapp = self._entity_cache.get_vapp(self._session.vdc, vapp_name)
 
         if not the_vapp:
             LOG.info("can't find the vapp %s" % vapp_name)
@@ -135,7 +190,31 @@ class VCloudClient(provider_client.ProviderClient):
                 a = '%s, %s' % (a, arg)
             raise exception.NovaException(
                 "Unable to call %s.%s(%s)" % (str(the_vapp), method_name , a))
-        self._invoke_api("block_until_completed", task)
+        self._block_until_completed(task, vapp_name)
+
+    def _block_until_completed(self, task, vapp_name, vapp_listed=False):
+        """Wait for a task changing the vApp, the cached vApp (and the vdc
+        listing it if the vApp is created or deleted) is outdated.
+        """
+        vdc_name = self._session.vdc if vapp_listed else None
+        self._entity_cache.invalidate_vapp(vapp_name, vdc_name)
+        try:
+            self._task_poller.watch_task(task).wait()
+        finally:
+            self._entity_cache.invalidate_vapp(vapp_name, vdc_name)
+            if self._status_snapshot:
+                self._status_snapshot.invalidate(vapp_name)
+
+    def _query_vapp_statuses(self, vapp_names):
+        statuses = vapp_status_snapshot.query_vapp_statuses(
+            self._session,
+            self._session.vdc,
+            CONF.vcloud.query_page_size,
+            CONF.vcloud.verify,
+            vapp_names)
+        return dict((vapp_name, getattr(VCLOUD_STATUS, status,
+                                        VCLOUD_STATUS.UNKNOWN))
+                    for vapp_name, status in statuses.items())
 
     def _invoke_api(self, method_name, *args, **kwargs):
         res = self._session.invoke_api(self._session.vca,
@@ -152,6 +231,13 @@ class VCloudClient(provider_client.ProviderClient):
         return res
 
     def get_vm_status(self, instance, name):
+        if self._status_snapshot:
+            self._status_snapshot.start()
+            status = self._status_snapshot.get_status(name)
+            if status is not None:
+                return STATUS_DICT_VAPP_TO_INSTANCE[
+                    getattr(VCLOUD_STATUS, status, VCLOUD_STATUS.UNKNOWN)]
+        # not in the snapshot (new vapp or snapshot not up to date)
         return STATUS_DICT_VAPP_TO_INSTANCE[
             self._get_vcloud_vapp(name).me.status]
 
@@ -184,19 +270,16 @@ class VCloudClient(provider_client.ProviderClient):
         return self._get_first_vm(vapp_name).get_status()
 
     def wait_for_status(self, instance, name, expected_vapp_status):
-        vapp_status = self._get_vcloud_vapp(name).me.status
-        LOG.debug('vapp status: %s' % vapp_status)
-        retry_times = 100
-        while vapp_status != expected_vapp_status and retry_times > 0:
-            time.sleep(10)
-            vapp_status = self._get_vcloud_vapp(name).me.status
-            # add error status check and throw exception
-            if vapp_status == VCLOUD_STATUS.FAILED_CREATION:
-                raise exception.NovaException(
-                    "VApp %s on status Error" % (name))
-            LOG.debug('vapp status: %s, expected: %s, it remains %s tries' % (
-                vapp_status, expected_vapp_status, retry_times))
-            retry_times = retry_times - 1
+        reached = self._task_poller.watch_vapp_status(
+            name,
+            expected_vapp_status,
+            failed_status=VCLOUD_STATUS.FAILED_CREATION,
+            timeout=STATUS_WAIT_TIMEOUT).wait()
+        # the status of the cached vapp is outdated
+        self._entity_cache.invalidate_vapp(name)
+        if not reached:
+            LOG.warn('vapp %s did not reach the status %s' % (
+                name, expected_vapp_status))
 
     def power_on(self, instance, name):
         the_vapp = self._get_vcloud_vapp(name)
@@ -213,7 +296,12 @@ class VCloudClient(provider_client.ProviderClient):
         return the_vapp
 
     def delete(self, instance, name):
-        self._invoke_vapp_task_api(name, "delete")
+        the_vapp = self._get_vcloud_vapp(name)
+        task = self._invoke_obj_api(the_vapp, "delete")
+        if not task:
+            raise exception.NovaException(
+                "Unable to call %s.delete()" % str(the_vapp))
+        self._block_until_completed(task, name, vapp_listed=True)
 
     def reboot(self, instance, name):
         self._invoke_vapp_task_api(name, "reboot")
@@ -259,11 +347,14 @@ class VCloudClient(provider_client.ProviderClient):
             return response
         return None
 
-    def _put(self, href, body):
+    def _put(self, href, body, content_type=None):
+        headers = self._session.vca.vcloud_session.get_vcloud_headers()
+        if content_type:
+            headers['Content-type'] = content_type
         response = Http.put(
             href,
             data=body,
-            headers=self._session.vca.vcloud_session.get_vcloud_headers(),
+            headers=headers,
             verify=CONF.vcloud.verify)
         if response.status_code == requests.codes.accepted:
             return taskType.parseString(response.content, True)
@@ -298,22 +389,17 @@ class VCloudClient(provider_client.ProviderClient):
         return None
 
     def wait_media_for_status(self, name, expected_status):
-        media_status = self.get_media_status(name)
-        LOG.debug('media %s status: %s' % (name, media_status))
-        retry_times = 100
-        while media_status != expected_status and retry_times > 0:
-            time.sleep(10)
-            media_status = self.get_media_status(name)
-            # add error status check and throw exception
-            if media_status == VCLOUD_STATUS.FAILED_CREATION:
-                raise exception.NovaException(
-                    "Media %s on status Error" % (name))
-            LOG.debug('media status: %s, expected: %s, '
-                      'it remains %s tries' % (
-                            media_status,
-                            expected_status,
-                            retry_times))
-            retry_times = retry_times - 1
+        if self.get_media_status(name) == expected_status:
+            return
+        reached = self._task_poller.watch_status(
+            'media %s' % name,
+            lambda: self.get_media_status(name),
+            expected_status,
+            failed_status=VCLOUD_STATUS.FAILED_CREATION,
+            timeout=STATUS_WAIT_TIMEOUT).wait()
+        if not reached:
+            LOG.warn('media %s did not reach the status %s' % (
+                name, expected_status))
 
     def get_item(self, item_name):
         catalogs = self._invoke_api("get_catalogs")
@@ -333,33 +419,203 @@ class VCloudClient(provider_client.ProviderClient):
                                   net_list):
         # wait for status catalog item ready
         self.wait_media_for_status(template_name, VCLOUD_STATUS.POWERED_OFF)
-        # no cpu/vm_name network change is supported during instance creation
-        # API version 5.5 
-        task = self._invoke_api("create_vapp",
-                                self._session.vdc,
-                                vapp_name,
-                                template_name,
-                                self._catalog_name)
-        if not task:
-            raise exception.NovaException(
-                "Unable to create instance %s from template %s" % (
-                        vapp_name, template_name))
-        self._invoke_api("block_until_completed", task)
-
-        # change cpu and memory
+        # the vapp networks, and from API version 5.6 the vm name, network
+        # connections, cpu and memory, are set by the instantiation
+        customize_version = self._customization_api_version()
+        task = self._instantiate_vapp_template(vapp_name,
+                                               template_name,
+                                               mem_size,
+                                               cpus,
+                                               net_list,
+                                               customize_version)
+        self._block_until_completed(task, vapp_name, vapp_listed=True)
+        if customize_version:
+            return
+
+        # change cpu and memory, item by item: a partial
+        # VirtualHardwareSection would remove the other devices of the vm
         self._customize_vm( vapp_name, mem_size, cpus)
-        task = self._connect_vapp_to_networks(vapp_name, net_list)
-        if not task:
-            raise exception.NovaException(
-                "Unable to connect vapp to networks (%s)" % vapp_name)
-        self._invoke_api("block_until_completed", task)
 
         # change the vm configuration
         task = self._connect_vm(vapp_name, net_list)
         if not task:
             raise exception.NovaException(
                 "Unable to connect vm to networks (%s)" % vapp_name)
-        self._invoke_api("block_until_completed", task)
+        self._block_until_completed(task, vapp_name)
+
+    def _get_server_api_versions(self):
+        """Return the API versions supported by the server (GET
+        /api/versions, no authentication required).
+        """
+        if self._server_api_versions is None:
+            response = Http.get(self._session.vca.host + '/api/versions',
+                                verify=CONF.vcloud.verify)
+            if response.status_code != requests.codes.ok:
+                LOG.warn('unable to get the API versions of the server: %s' %
+                         response.status_code)
+                return set()
+            self._server_api_versions = set(
+                _parse_api_version(version.text)
+                for version in etree.fromstring(response.content).iter(
+                    '{%s}Version' % VERSIONS_NS))
+        return self._server_api_versions
+
+    def _customization_api_version(self):
+        """Return the API version the vapps are instantiated with when it
+        can customize the vm, None if the server does not support it.
+        """
+        version = _parse_api_version(CONF.vcloud.version)
+        if version >= CUSTOMIZATION_API_VERSION:
+            return version
+        try:
+            versions = self._get_server_api_versions()
+        except Exception as e:
+            LOG.warn('unable to get the API versions of the server: %s' % e)
+            return None
+        # the first one able to customize the vm
+        versions = sorted(v for v in versions
+                          if v >= CUSTOMIZATION_API_VERSION)
+        return versions[0] if versions else None
+
+    def _get_template_vm(self, template_name):
+        """Return the href of the vapp template and its vm (element)."""
+        catalog_item = self.get_item(template_name)
+        if not catalog_item:
+            raise exception.NovaException(
+                "Unable to find the template %s" % template_name)
+        response = self._get(catalog_item.href)
+        if not response:
+            raise exception.NovaException(
+                "Unable to get the template %s" % template_name)
+        template_href = [
+            entity.get('href')
+            for entity in etree.fromstring(response.content)
+            if entity.get('type') == VAPP_TEMPLATE_TYPE][0]
+        response = self._get(template_href)
+        if not response:
+            raise exception.NovaException(
+                "Unable to get the template %s" % template_name)
+        vm = [vm for vm in etree.fromstring(response.content).iter(
+            '{%s}Vm' % VCLOUD_NS)][0]
+        return template_href, vm
+
+    def _network_connection_section(self, net_list):
+        section = etree.Element('{%s}NetworkConnectionSection' % VCLOUD_NS,
+                                nsmap={None: VCLOUD_NS, 'ovf': OVF_NS})
+        section.set('{%s}required' % OVF_NS, 'false')
+        etree.SubElement(section, '{%s}Info' % OVF_NS).text = (
+            'Network connections')
+        etree.SubElement(
+            section,
+            '{%s}PrimaryNetworkConnectionIndex' % VCLOUD_NS).text = '0'
+        for index, net in enumerate(net_list):
+            connection = etree.SubElement(
+                section, '{%s}NetworkConnection' % VCLOUD_NS,
+                network=net['id'])
+            etree.SubElement(
+                connection,
+                '{%s}NetworkConnectionIndex' % VCLOUD_NS).text = str(index)
+            etree.SubElement(
+                connection, '{%s}IsConnected' % VCLOUD_NS).text = 'true'
+            if 'mac' in net:
+                etree.SubElement(
+                    connection, '{%s}MACAddress' % VCLOUD_NS).text = net['mac']
+            etree.SubElement(
+                connection,
+                '{%s}IpAddressAllocationMode' % VCLOUD_NS).text = (
+                    'DHCP' if net['mode'].startswith('dhcp') else 'POOL')
+        return section
+
+    def _virtual_hardware_section(self, vm, mem_size, cpus):
+        """Return a copy of the complete VirtualHardwareSection of the
+        template vm with its cpu and memory items changed: the devices
+        missing from the section would be removed from the vm.
+        """
+        section = vm.find('{%s}VirtualHardwareSection' % OVF_NS)
+        if section is None:
+            raise exception.NovaException(
+                "No virtual hardware in the template of %s" % vm.get('name'))
+        section = copy.deepcopy(section)
+        # the links and the hrefs of the section are the template ones
+        for link in section.findall('{%s}Link' % VCLOUD_NS):
+            section.remove(link)
+        for element in section.iter():
+            for name in ('href', 'type', '{%s}href' % VCLOUD_NS,
+                         '{%s}type' % VCLOUD_NS):
+                element.attrib.pop(name, None)
+        for item in section.findall('{%s}Item' % OVF_NS):
+            resource_type = item.findtext('{%s}ResourceType' % RASD_NS)
+            if resource_type == RESOURCE_TYPE_CPU:
+                item.find('{%s}VirtualQuantity' % RASD_NS).text = str(
+                    int(cpus))
+                for name, value in item.attrib.items():
+                    # the cores per socket must divide the cpus
+                    if (name.endswith('}CoresPerSocket') and
+                            int(cpus) % int(value)):
+                        item.set(name, '1')
+            elif resource_type == RESOURCE_TYPE_MEMORY:
+                item.find('{%s}AllocationUnits' % RASD_NS).text = (
+                    'byte * 2^20')
+                item.find('{%s}VirtualQuantity' % RASD_NS).text = str(
+                    int(mem_size))
+        return section
+
+    def _sourced_vm_item(self, vm, vm_name, mem_size, cpus, net_list):
+        item = etree.Element('{%s}SourcedItem' % VCLOUD_NS,
+                             nsmap={None: VCLOUD_NS})
+        etree.SubElement(item, '{%s}Source' % VCLOUD_NS, href=vm.get('href'))
+        general_params = etree.SubElement(item,
+                                          '{%s}VmGeneralParams' % VCLOUD_NS)
+        etree.SubElement(general_params, '{%s}Name' % VCLOUD_NS).text = vm_name
+        params = etree.SubElement(item, '{%s}InstantiationParams' % VCLOUD_NS)
+        params.append(self._network_connection_section(net_list))
+        params.append(self._virtual_hardware_section(vm, mem_size, cpus))
+        return etree.tostring(item)
+
+    def _instantiate_vapp_template(self, vapp_name, template_name, mem_size,
+                                   cpus, net_list, customize_version=None):
+        """Create the vapp, with its networks and, if customize_version
+        (the API version of the request), its vm named, connected and
+        sized, in a single task.
+
+        :returns: the task of the instantiation
+        """
+        template_href, vm = self._get_template_vm(template_name)
+        sourced_item = ''
+        if customize_version:
+            sourced_item = self._sourced_vm_item(vm, vapp_name, mem_size,
+                                                 cpus, net_list)
+        body = (
+            '<InstantiateVAppTemplateParams xmlns=%s name=%s deploy="false" '
+            'powerOn="false">'
+            '<InstantiationParams>%s</InstantiationParams>'
+            '<Source href=%s/>'
+            '%s'
+            '<AllEULAsAccepted>true</AllEULAsAccepted>'
+            '</InstantiateVAppTemplateParams>' % (
+                saxutils.quoteattr(VCLOUD_NS),
+                saxutils.quoteattr(vapp_name),
+                self._network_config_section(net_list),
+                saxutils.quoteattr(template_href),
+                sourced_item))
+        headers = self._session.vca.vcloud_session.get_vcloud_headers()
+        headers['Content-type'] = INSTANTIATE_PARAMS_TYPE
+        if customize_version:
+            # the token of the session is valid for all the versions
+            headers['Accept'] = 'application/*+xml;version=%s' % '.'.join(
+                str(v) for v in customize_version)
+        response = Http.post(
+            self._get_vcloud_vdc().get_href() +
+            '/action/instantiateVAppTemplate',
+            data=body,
+            headers=headers,
+            verify=CONF.vcloud.verify)
+        if response.status_code != requests.codes.created:
+            raise exception.NovaException(
+                "Unable to create instance %s from template %s: %s" % (
+                    vapp_name, template_name, response.content))
+        the_vapp = vAppType.parseString(response.content, True)
+        return the_vapp.get_Tasks().get_Task()[0]
 
     def get_net_conf(self, instance, net_list, name):
         nets_conf = list()
@@ -402,7 +658,8 @@ class VCloudClient(provider_client.ProviderClient):
         return nets_conf
 
     def _connect_vm(self, vapp_name, net_list):
-        vm = self._get_first_vm(vapp_name)
+        # the vm of the cached vapp is not changed
+        vm = copy.deepcopy(self._get_first_vm(vapp_name))
         href = vm.get_href()
         
         # vm name
@@ -449,18 +706,7 @@ class VCloudClient(provider_client.ProviderClient):
                           body,
                           'application/vnd.vmware.vcloud.vm+xml')
 
-    def _connect_vapp_to_networks(self, vapp_name, net_list):
-        the_vapp = self._get_vcloud_vapp(vapp_name)
-        vApp_NetworkConfigSection = [
-            section
-            for section in the_vapp.me.get_Section()
-            if section.__class__.__name__ == "NetworkConfigSectionType"][0]
-        link = [
-            link
-            for link in vApp_NetworkConfigSection.get_Link()
-            if link.get_type() ==
-                "application/vnd.vmware.vcloud.networkConfigSection+xml"][0]
-
+    def _network_config_section(self, net_list):
         networkConfigSection = vcloudType.NetworkConfigSectionType()
         networkConfigSection.set_Info(
             vAppType.cimString(valueOf_="Network config"))
@@ -563,7 +809,7 @@ class VCloudClient(provider_client.ProviderClient):
             "Info", "ovf:Info").replace(":vmw", "").replace(
                 "vmw:","").replace("RetainNetovf", "ovf").replace(
                     "ovf:InfoAcrossDeployments","RetainNetInfoAcrossDeployments")
-        return self._put(link.get_href(), body)
+        return body
 
 
     def _customize_vm(self, vapp_name, mem_size, cpus):
@@ -616,6 +862,33 @@ class VCloudClient(provider_client.ProviderClient):
                 "Unable to upload meta-data iso file %s" % vapp_name)
         return media_name
 
+    def set_user_data_properties(self, vapp_name, user_data):
+        """Set the user data as the properties of the product section of the
+        vapp, its vm reads them from its OVF environment (guestinfo.ovfEnv)
+        instead of a metadata iso.
+        """
+        section_list = etree.Element('{%s}ProductSectionList' % VCLOUD_NS,
+                                     nsmap={None: VCLOUD_NS, 'ovf': OVF_NS})
+        section = etree.SubElement(section_list,
+                                   '{%s}ProductSection' % OVF_NS)
+        section.set('{%s}required' % OVF_NS, 'false')
+        etree.SubElement(section, '{%s}Info' % OVF_NS).text = (
+            'Hybrid VM user data')
+        for key, value in sorted(user_data.items()):
+            prop = etree.SubElement(section, '{%s}Property' % OVF_NS)
+            prop.set('{%s}key' % OVF_NS, key)
+            prop.set('{%s}type' % OVF_NS, 'string')
+            prop.set('{%s}userConfigurable' % OVF_NS, 'true')
+            prop.set('{%s}value' % OVF_NS, '%s' % value)
+        the_vapp = self._get_vcloud_vapp(vapp_name)
+        task = self._put(the_vapp.me.get_href() + '/productSections/',
+                         etree.tostring(section_list),
+                         PRODUCT_SECTIONS_TYPE)
+        if not task:
+            raise exception.NovaException(
+                "Unable to set the user data of %s" % vapp_name)
+        self._block_until_completed(task, vapp_name)
+
     def delete_metadata_iso(self, vapp_name):
         media_name = "metadata_%s.iso" % vapp_name
         return self._invoke_api("delete_catalog_item",
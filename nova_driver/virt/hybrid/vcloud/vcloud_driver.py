@@ -7,11 +7,14 @@ from oslo_config import cfg
 from oslo_log import log as logging
 
 from nova import image
+from nova import paths
 
 from nova_driver.virt.hybrid.common import abstract_driver
 from nova_driver.virt.hybrid.common import common_tools
 from nova_driver.virt.hybrid.common import hybrid_task_states
 from nova_driver.virt.hybrid.common import image_convertor
+from nova_driver.virt.hybrid.common import image_prewarmer
+from nova_driver.virt.hybrid.common import stage_graph
 from nova_driver.virt.hybrid.vcloud import vcloud_client
 
 vcloud_driver_opts = [
@@ -61,6 +64,57 @@ vcloud_driver_opts = [
     cfg.StrOpt('catalog_name',
                default='metadata-isos',
                help='The catalog name for metadada isos and vapps templates.'),
+    cfg.StrOpt('user_data_delivery',
+               default='iso',
+               choices=['iso', 'guestinfo'],
+               help='How the user data reaches the vm: a metadata iso '
+               'inserted in the vm, or the properties of the product section '
+               'of the vapp read from the guestinfo of the vm'),
+    cfg.IntOpt('entity_cache_ttl',
+               default=5,
+               help='Seconds the vdc and vapps read from VCD are reused '
+               'before being revalidated, 0 to read them on every use'),
+    cfg.IntOpt('vapp_status_refresh_interval',
+               default=60,
+               help='Interval in seconds between two reads of the status of '
+               'all the vapps of the vdc the power states are got from, 0 to '
+               'read the vapp of each instance'),
+    cfg.IntOpt('query_page_size',
+               default=128,
+               help='Number of records per page of the VCD query service'),
+    cfg.FloatOpt('task_poll_initial_interval',
+                 default=0.5,
+                 help='Interval in seconds of the first polls of a VCD task '
+                 'or status, increased exponentially up to '
+                 'task_poll_max_interval'),
+    cfg.FloatOpt('task_poll_max_interval',
+                 default=10,
+                 help='Maximum interval in seconds between two polls of a VCD '
+                 'task or status'),
+    cfg.IntOpt('http_pool_size',
+               default=10,
+               help='Maximum number of the HTTP connections kept open to the '
+               'VCD host'),
+    cfg.BoolOpt('http_keep_alive',
+                default=True,
+                help='Reuse the HTTP connections to the VCD host'),
+    cfg.IntOpt('session_pool_size',
+               default=2,
+               help='Number of the sessions opened to the VCD host, the '
+               'calls are spread over them'),
+    cfg.IntOpt('session_refresh_interval',
+               default=1200,
+               help='Seconds after which a session logs in again in the '
+               'background, lower than the session timeout of the VCD host, '
+               '0 to not refresh the sessions'),
+    cfg.BoolOpt('session_token_cache',
+                default=True,
+                help='Cache the session tokens in session_token_dir to reuse '
+                'them after a restart'),
+    cfg.StrOpt('session_token_dir',
+               default=paths.state_path_def('vcloud'),
+               help='Directory of the cached session tokens, readable by '
+               'the owner only'),
 ]
 
 
@@ -86,6 +140,49 @@ class VCloudDriver(abstract_driver.AbstractHybridNovaDriver):
         image_uuid = self._get_image_uuid(image_meta)
         return self._provider_client.get_item(image_uuid)
 
+    def _import_template(self, img_conv, image_meta, template_name,
+                         inst_st_up):
+        if self._template_exists_in_provider(image_meta):
+            # imported by a concurrent spawn
+            return
+
+        # download the image
+        img_conv.download_image()
+
+        # convert to an exportable format
+        _, (ovf_name,) = img_conv.convert_to_provider_format()
+
+        # upload ovf to vcloud
+        inst_st_up(task_state=hybrid_task_states.IMPORTING)
+
+        self._provider_client.upload_temptale(
+            ovf_name,
+            template_name
+        )
+
+    def _prewarm_image(self, context, image_meta):
+        if self._template_exists_in_provider(image_meta):
+            return
+        template_name = self._get_image_uuid(image_meta)
+        prewarm_st_up = image_prewarmer.PrewarmStateUpdater(template_name)
+        with image_convertor.ImageConvertorToOvf(
+            context,
+            self.conversion_dir,
+            'prewarm-%s' % template_name,
+            template_name,
+            'base-template.vmx',
+            prewarm_st_up,
+            None,
+            image_formats=self.image_formats
+        ) as img_conv:
+            # shared with the spawns of the image started meanwhile
+            self._import_jobs.do('import-%s' % template_name,
+                                 self._import_template,
+                                 img_conv,
+                                 image_meta,
+                                 template_name,
+                                 prewarm_st_up)
+
     def spawn(self,
               context,
               instance,
@@ -107,88 +204,138 @@ class VCloudDriver(abstract_driver.AbstractHybridNovaDriver):
 
         vapp_name = self._get_vm_name(instance)
         template_name = self._get_image_uuid(image_meta_dict)
+        self._image_prewarmer.record_spawn(template_name)
 
         inst_st_up = abstract_driver.InstanceStateUpdater(instance)
-
-        vmx_name = 'base-%s.vmx' % vcloud_flavor_id
-        # choose a default template if it's a specific one is not present
-        if not os.path.exists('%s/vmx/%s' % (self.conversion_dir,
-                                             vmx_name)):
-            vmx_name = 'base-template.vmx'
-
-        LOG.debug('image_meta=%s' % image_meta_dict)
-        with image_convertor.ImageConvertorToOvf(
-            context,
-            self.conversion_dir,
-            instance.uuid,
-            template_name, # image uuid
-            vmx_name,
-            inst_st_up,
-            instance.task_state
-        ) as img_conv:
-
-            # create and upload template only if exists
-            if not self._template_exists_in_provider(image_meta_dict):
-                # download the image
-                img_conv.download_image()
-
-                # convert to an exportable format
-                ovf_name = img_conv.convert_to_ovf_format()
-
-                # upload ovf to vcloud
-                inst_st_up(task_state=hybrid_task_states.IMPORTING)
-
-                self._provider_client.upload_temptale(
-                    ovf_name,
-                    template_name
-                )
-
-            inst_st_up(task_state=hybrid_task_states.VM_CREATING)
-
-            # create the vapp from the template
-            self._provider_client.create_vapp_from_template(
-                vapp_name,
-                template_name,
-                instance.get_flavor().memory_mb,
-                instance.get_flavor().vcpus,
-                net_list
-            )
-
-            # create metadata iso and upload to vcloud
-            conversion_dir = self._get_conversion_dir(instance)
-            user_metadata = self._get_user_metadata(
-                instance, net_list, image_meta_dict)
-            if user_metadata and len(user_metadata) > 0:
-                iso_file = common_tools.create_user_data_iso(
-                    'userdata.iso',
-                    user_metadata,
-                    conversion_dir
-                )
-                media_name = self._provider_client.upload_metadata_iso(
-                    iso_file, vapp_name)
-
-            self._provider_client.wait_for_status(
-                instance,
-                vapp_name,
-                vcloud_client.VCLOUD_STATUS.POWERED_OFF)
-
-            # mount it
-            if user_metadata and len(user_metadata) > 0:
-                self._provider_client.insert_media(vapp_name, media_name)
-
-            # power on it before get net conf to get the external ip
-            self._provider_client.power_on(instance, vapp_name)
-
-            if user_metadata and len(user_metadata) > 0:
-                if 'eth0_ip' in user_metadata and 'eth1_ip' in user_metadata:
-                    self.plug_vifs(context, instance, network_info,
-                                   user_metadata['eth0_ip'],
-                                   user_metadata['eth1_ip'])
-
-            nets_conf = self._provider_client.get_net_conf(
-                instance, net_list, vapp_name)
-
-            self._update_md(instance, network_info, nets_conf)
+        try:
+            vmx_name = 'base-%s.vmx' % vcloud_flavor_id
+            # choose a default template if it's a specific one is not present
+            if not os.path.exists('%s/vmx/%s' % (self.conversion_dir,
+                                                 vmx_name)):
+                vmx_name = 'base-template.vmx'
+
+            LOG.debug('image_meta=%s' % image_meta_dict)
+            with image_convertor.ImageConvertorToOvf(
+                context,
+                self.conversion_dir,
+                instance.uuid,
+                template_name, # image uuid
+                vmx_name,
+                inst_st_up,
+                instance.task_state,
+                flavor=instance.get_flavor(),
+                image_formats=self.image_formats
+            ) as img_conv:
+
+                def import_template(results):
+                    # create and upload template only if exists
+                    if self._template_exists_in_provider(image_meta_dict):
+                        return
+                    # only one of the concurrent spawns of the image imports
+                    # it
+                    inst_st_up(task_state=hybrid_task_states.IMPORTING)
+                    self._import_jobs.do('import-%s' % template_name,
+                                         self._import_template,
+                                         img_conv,
+                                         image_meta_dict,
+                                         template_name,
+                                         inst_st_up)
+
+                def create_vapp(results):
+                    inst_st_up(task_state=hybrid_task_states.VM_CREATING)
+                    # create the vapp from the template
+                    self._provider_client.create_vapp_from_template(
+                        vapp_name,
+                        template_name,
+                        instance.get_flavor().memory_mb,
+                        instance.get_flavor().vcpus,
+                        net_list
+                    )
+
+                def get_user_metadata(results):
+                    return self._get_user_metadata(
+                        instance, net_list, image_meta_dict)
+
+                def upload_metadata_iso(results):
+                    # create metadata iso and upload to vcloud
+                    user_metadata = results['user_metadata']
+                    if not user_metadata:
+                        return None
+                    iso_file = common_tools.create_user_data_iso(
+                        'userdata.iso',
+                        user_metadata,
+                        img_conv.conversion_dir
+                    )
+                    return self._provider_client.upload_metadata_iso(
+                        iso_file, vapp_name)
+
+                def wait_powered_off(results):
+                    self._provider_client.wait_for_status(
+                        instance,
+                        vapp_name,
+                        vcloud_client.VCLOUD_STATUS.POWERED_OFF)
+
+                def set_user_data(results):
+                    user_metadata = results['user_metadata']
+                    if user_metadata:
+                        self._provider_client.set_user_data_properties(
+                            vapp_name, user_metadata)
+
+                def insert_media(results):
+                    # mount it
+                    media_name = results['upload_metadata_iso']
+                    if media_name:
+                        self._provider_client.insert_media(vapp_name,
+                                                           media_name)
+
+                def power_on(results):
+                    # power on it before get net conf to get the external ip
+                    self._provider_client.power_on(instance, vapp_name)
+
+                def plug_vifs(results):
+                    user_metadata = results['user_metadata']
+                    if (user_metadata and 'eth0_ip' in user_metadata and
+                            'eth1_ip' in user_metadata):
+                        self.plug_vifs(context, instance, network_info,
+                                       user_metadata['eth0_ip'],
+                                       user_metadata['eth1_ip'])
+
+                def update_md(results):
+                    nets_conf = self._provider_client.get_net_conf(
+                        instance, net_list, vapp_name)
+                    self._update_md(instance, network_info, nets_conf)
+
+                # the iso and the plug of the vifs overlap with the waits of
+                # the vapp
+                graph = stage_graph.StageGraph('spawn of %s' % instance.uuid)
+                graph.add('import_template', import_template)
+                graph.add('create_vapp', create_vapp,
+                          requires=['import_template'])
+                graph.add('user_metadata', get_user_metadata,
+                          requires=['create_vapp'])
+                graph.add('wait_powered_off', wait_powered_off,
+                          requires=['create_vapp'])
+                if cfg.CONF.vcloud.user_data_delivery == 'guestinfo':
+                    # read by the vm from its OVF environment at power on
+                    graph.add('set_user_data', set_user_data,
+                              requires=['user_metadata'])
+                    graph.add('power_on', power_on,
+                              requires=['set_user_data', 'wait_powered_off'])
+                else:
+                    graph.add('upload_metadata_iso', upload_metadata_iso,
+                              requires=['user_metadata'])
+                    graph.add('insert_media', insert_media,
+                              requires=['upload_metadata_iso',
+                                        'wait_powered_off'])
+                    graph.add('power_on', power_on,
+                              requires=['insert_media'])
+                graph.add('plug_vifs', plug_vifs, requires=['user_metadata'])
+                graph.add('update_md', update_md,
+                          requires=['power_on', 'plug_vifs'])
+                graph.run()
+        finally:
+            # the last state is saved before nova resets it
+            inst_st_up.flush()
 
         LOG.info('end time of vcloud create vm is %s' %
                  (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())))
@@ -0,0 +1,429 @@
+"""
+Benchmark of the image transfer pipeline, offline.
+
+The transfer classes of util (start_transfer, GlanceFileRead, DigestFileRead,
+ThreadSafePipe, JournaledFileWrite, GlanceRangedDownload) are driven with a
+synthetic glance image: an iterator (or an HTTP server process for the
+ranged downloads) with a configurable chunk size, latency per chunk and
+throughput, of random, sparse or zero payload. The data is written to a
+file, a sparse journaled file, a pipe or a null sink.
+
+Every run reports the throughput (MB/s), the cpu time per GB (user + system
+of all the threads, generation of the payload excluded) and the peak RSS of
+the process. It needs nova and the nova_driver package, installed or from
+the root of the tree:
+
+    PYTHONPATH=. python tools/transfer_benchmark.py \\
+        --scenario transfer --sink file --payload sparse --size-mb 1024
+
+--suite runs a matrix of scenarios, sinks and payloads, each in its own
+process for a meaningful peak RSS.
+"""
+import argparse
+import BaseHTTPServer
+import json
+import os
+import random
+import resource
+import SocketServer
+import subprocess
+import sys
+import tempfile
+import time
+
+import eventlet
+from eventlet import greenthread
+from eventlet import patcher
+
+from oslo_config import cfg
+
+from nova_driver.virt.hybrid.common import util
+
+SCENARIOS = ('transfer', 'digest', 'pipe', 'ranged')
+SINKS = ('file', 'sparse', 'pipe', 'null')
+PAYLOADS = ('random', 'sparse', 'zero')
+
+# chunks of payload generated ahead, cycled through during the transfer
+PAYLOAD_VARIANTS = 16
+SPARSE_BLOCK_SIZE = 4096
+PIPE_READ_SIZE = 1024 * 1024
+
+SUITE = [
+    ('transfer', 'null', 'random'),
+    ('transfer', 'file', 'random'),
+    ('transfer', 'sparse', 'sparse'),
+    ('transfer', 'pipe', 'random'),
+    ('digest', 'null', 'random'),
+    ('pipe', 'null', 'random'),
+    ('ranged', 'file', 'random'),
+    ('ranged', 'file', 'sparse'),
+]
+
+
+class SyntheticImage(object):
+    """Content of a synthetic image, generated once by chunk variants."""
+
+    def __init__(self, size, chunk_size, payload, zero_ratio=0.5, seed=0):
+        self.size = size
+        self.chunk_size = chunk_size
+        rnd = random.Random(seed)
+        self._variants = []
+        for _ in range(PAYLOAD_VARIANTS):
+            if payload == 'zero':
+                chunk = '\0' * chunk_size
+            else:
+                chunk = os.urandom(chunk_size)
+            if payload == 'sparse':
+                blocks = [chunk[i:i + SPARSE_BLOCK_SIZE]
+                          if rnd.random() >= zero_ratio
+                          else '\0' * len(chunk[i:i + SPARSE_BLOCK_SIZE])
+                          for i in range(0, chunk_size, SPARSE_BLOCK_SIZE)]
+                chunk = ''.join(blocks)
+            self._variants.append(chunk)
+
+    def chunk(self, index):
+        start = index * self.chunk_size
+        length = max(0, min(self.chunk_size, self.size - start))
+        return self._variants[index % PAYLOAD_VARIANTS][:length]
+
+    def read(self, offset, length):
+        """Return the data at offset (ranged requests)."""
+        data = []
+        end = min(offset + length, self.size)
+        while offset < end:
+            index, start = divmod(offset, self.chunk_size)
+            chunk = self.chunk(index)[start:start + end - offset]
+            data.append(chunk)
+            offset += len(chunk)
+        return ''.join(data)
+
+
+class Throttle(object):
+    """Pace a stream of data to a throughput, with a latency per chunk."""
+
+    def __init__(self, throughput, latency, sleep):
+        self._throughput = throughput
+        self._latency = latency
+        self._sleep = sleep
+        self._start = time.time()
+        self._sent = 0
+
+    def __call__(self, length):
+        if self._latency:
+            self._sleep(self._latency)
+        self._sent += length
+        if self._throughput:
+            ahead = self._sent / self._throughput - (time.time() -
+                                                     self._start)
+            if ahead > 0:
+                self._sleep(ahead)
+
+
+def synthetic_iterator(image, throughput=0, latency=0):
+    """The glance image iterator (ImageBodyIterator) stand-in."""
+    throttle = Throttle(throughput, latency, greenthread.sleep)
+    for index in range((image.size + image.chunk_size - 1) //
+                       image.chunk_size):
+        chunk = image.chunk(index)
+        throttle(len(chunk))
+        yield chunk
+
+
+class NullFileWrite(object):
+    """Write handle discarding the data."""
+
+    def __init__(self):
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+
+    def close(self):
+        pass
+
+
+class PipeFileWrite(object):
+    """Write handle to a pipe drained by a native thread (a consumer
+    process like qemu-img reading its stdin).
+    """
+
+    def __init__(self):
+        threading = patcher.original('threading')
+        self._read_fd, self._write_fd = os.pipe()
+        self._file = os.fdopen(self._write_fd, 'wb', 0)
+        self.written = 0
+        # the drainer thread is native, it uses the original os.read
+        self._read = patcher.original('os').read
+        self._drainer = threading.Thread(target=self._drain)
+        self._drainer.start()
+
+    def _drain(self):
+        while True:
+            data = self._read(self._read_fd, PIPE_READ_SIZE)
+            if not data:
+                break
+            self.written += len(data)
+        os.close(self._read_fd)
+
+    def fileno(self):
+        return self._write_fd
+
+    def write(self, data):
+        self._file.write(data)
+
+    def close(self):
+        self._file.close()
+        self._drainer.join()
+
+
+def _open_sink(sink, work_dir, size):
+    file_name = None
+    if sink == 'null':
+        handle = NullFileWrite()
+    elif sink == 'pipe':
+        handle = PipeFileWrite()
+    else:
+        fd, file_name = tempfile.mkstemp(prefix='transfer-benchmark-',
+                                         dir=work_dir)
+        os.close(fd)
+        if sink == 'file':
+            handle = open(file_name, 'wb')
+        else:
+            journal = util.TransferJournal('%s.journal' % file_name,
+                                           {'size': size})
+            handle = util.JournaledFileWrite(file_name, journal,
+                                             64 * 1024 * 1024)
+    return handle, file_name
+
+
+class _ImageRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """The glance image download (with the range requests) stand-in."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        image = self.server.image
+        start, end = 0, image.size - 1
+        status = 200
+        if 'Range' in self.headers:
+            first, last = self.headers['Range'].split('=')[1].split('-')
+            start, end = int(first), min(int(last), image.size - 1)
+            status = 206
+        self.send_response(status)
+        self.send_header('Content-Length', str(end - start + 1))
+        if status == 206:
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                start, end, image.size))
+        self.end_headers()
+        # every connection gets the throughput
+        throttle = Throttle(self.server.throughput, self.server.latency,
+                            time.sleep)
+        offset = start
+        while offset <= end:
+            data = image.read(offset, min(image.chunk_size, end - offset + 1))
+            throttle(len(data))
+            self.wfile.write(data)
+            offset += len(data)
+
+
+class _ImageServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def serve(args):
+    """Serve the synthetic image until killed, print the url first.
+
+    Runs in its own (not monkey patched) process, its cpu is not measured.
+    """
+    server = _ImageServer(('127.0.0.1', 0), _ImageRequestHandler)
+    server.image = _make_image(args)
+    server.throughput = args.throughput_mb * 1024 * 1024
+    server.latency = args.latency_ms / 1000.0
+    print('http://127.0.0.1:%d' % server.server_address[1])
+    sys.stdout.flush()
+    server.serve_forever()
+
+
+class _Context(object):
+    auth_token = None
+
+
+def _run_transfer(args, image, digest=False):
+    handle, file_name = _open_sink(args.sink, args.dir, image.size)
+    read_handle = util.GlanceFileRead(
+        synthetic_iterator(image, args.throughput_mb * 1024 * 1024,
+                           args.latency_ms / 1000.0))
+    if digest:
+        read_handle = util.DigestFileRead(read_handle, util.ImageDigest())
+    try:
+        util.start_transfer(_Context(), read_handle, image.size,
+                            write_file_handle=handle)
+    finally:
+        if file_name:
+            _remove(file_name)
+
+
+def _run_pipe(args, image):
+    pipe = util.ThreadSafePipe(util.QUEUE_BUFFER_SIZE, image.size)
+
+    def _produce():
+        for chunk in synthetic_iterator(image,
+                                        args.throughput_mb * 1024 * 1024,
+                                        args.latency_ms / 1000.0):
+            pipe.write(chunk)
+
+    producer = greenthread.spawn(_produce)
+    while pipe.read(image.chunk_size):
+        pass
+    producer.wait()
+
+
+def _run_ranged(args, image):
+    server = subprocess.Popen(_command(args, '--serve'),
+                              stdout=subprocess.PIPE)
+    try:
+        url = server.stdout.readline().strip()
+        cfg.CONF.set_override('api_servers', [url], 'glance')
+        fd, file_name = tempfile.mkstemp(prefix='transfer-benchmark-',
+                                         dir=args.dir)
+        os.close(fd)
+        try:
+            download = util.GlanceRangedDownload(
+                _Context(), 'benchmark', file_name, image.size,
+                args.connections, args.part_size_mb * 1024 * 1024,
+                digest=util.ImageDigest())
+            if not download.download():
+                raise RuntimeError('ranged download refused by %s' % url)
+        finally:
+            _remove(file_name)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def _remove(file_name):
+    for name in (file_name, '%s.journal' % file_name):
+        if os.path.exists(name):
+            os.remove(name)
+
+
+def _make_image(args):
+    return SyntheticImage(args.size_mb * 1024 * 1024, args.chunk_kb * 1024,
+                          args.payload, args.zero_ratio)
+
+
+def _command(args, *options):
+    """Return the command running the benchmark with args and options."""
+    command = [sys.executable, os.path.abspath(__file__),
+               '--scenario', args.scenario,
+               '--sink', args.sink,
+               '--payload', args.payload]
+    for option in ('size_mb', 'chunk_kb', 'latency_ms', 'throughput_mb',
+                   'zero_ratio', 'connections', 'part_size_mb', 'dir'):
+        command += ['--%s' % option.replace('_', '-'),
+                    str(getattr(args, option))]
+    return command + list(options)
+
+
+def _cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run(args):
+    """Run one benchmark and return its measures."""
+    cfg.CONF([], project='nova', default_config_files=[])
+
+    image = _make_image(args)
+    start_cpu = _cpu_time()
+    start = time.time()
+    if args.scenario in ('transfer', 'digest'):
+        _run_transfer(args, image, digest=args.scenario == 'digest')
+    elif args.scenario == 'pipe':
+        _run_pipe(args, image)
+    else:
+        _run_ranged(args, image)
+    elapsed = time.time() - start
+    cpu = _cpu_time() - start_cpu
+    return {
+        'scenario': args.scenario,
+        'sink': 'file' if args.scenario == 'ranged' else args.sink,
+        'payload': args.payload,
+        'size_mb': args.size_mb,
+        'seconds': round(elapsed, 3),
+        'mb_s': round(args.size_mb / max(elapsed, 1e-6), 1),
+        'cpu_s_per_gb': round(cpu * 1024 / args.size_mb, 2),
+        # ru_maxrss is in KB on linux
+        'peak_rss_mb': round(resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1),
+    }
+
+
+def _format(result):
+    return ('%(scenario)-9s %(sink)-7s %(payload)-7s %(size_mb)6d MB '
+            '%(mb_s)8.1f MB/s %(cpu_s_per_gb)7.2f cpu s/GB '
+            '%(peak_rss_mb)7.1f MB rss' % result)
+
+
+def run_suite(args):
+    """Run the benchmarks of the suite, each in its own process."""
+    results = []
+    for args.scenario, args.sink, args.payload in SUITE:
+        output = subprocess.check_output(_command(args, '--json'))
+        result = json.loads(output.strip().splitlines()[-1])
+        print(_format(result))
+        sys.stdout.flush()
+        results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark of the image transfer pipeline')
+    parser.add_argument('--scenario', choices=SCENARIOS, default='transfer',
+                        help='start_transfer from the glance iterator '
+                        '(transfer), with the md5 digest (digest), '
+                        'ThreadSafePipe alone (pipe) or GlanceRangedDownload '
+                        'from an HTTP stand-in (ranged)')
+    parser.add_argument('--sink', choices=SINKS, default='null')
+    parser.add_argument('--payload', choices=PAYLOADS, default='random')
+    parser.add_argument('--size-mb', type=int, default=512)
+    parser.add_argument('--chunk-kb', type=int, default=64,
+                        help='size of the chunks of the glance iterator')
+    parser.add_argument('--latency-ms', type=float, default=0,
+                        help='latency per chunk')
+    parser.add_argument('--throughput-mb', type=float, default=0,
+                        help='throughput of the source (per connection), '
+                        '0 for unbounded')
+    parser.add_argument('--zero-ratio', type=float, default=0.5,
+                        help='ratio of zero blocks of the sparse payload')
+    parser.add_argument('--connections', type=int, default=4,
+                        help='connections of the ranged download')
+    parser.add_argument('--part-size-mb', type=int, default=64,
+                        help='part size of the ranged download')
+    parser.add_argument('--dir', default=tempfile.gettempdir(),
+                        help='directory of the file sinks')
+    parser.add_argument('--json', action='store_true',
+                        help='print the measures as json')
+    parser.add_argument('--suite', action='store_true',
+                        help='run the benchmark suite')
+    parser.add_argument('--serve', action='store_true',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args)
+        return
+    # as in nova-compute
+    eventlet.monkey_patch()
+    if args.suite:
+        run_suite(args)
+        return
+    result = run(args)
+    print(json.dumps(result) if args.json else _format(result))
+
+
+if __name__ == '__main__':
+    sys.exit(main())